@@ -0,0 +1,51 @@
+import time
+import typing as tp
+
+import click
+
+from compgraph import operations
+
+
+def generate_rows(rows_count: int) -> tp.Generator[operations.TRow, None, None]:
+    for i in range(rows_count):
+        yield {
+            'weekday': ('Mon', 'Tue', 'Wed')[i * 3 // rows_count],
+            'hour': i * 72 // rows_count % 24,
+            'total_time': (i % 97 + 1) * 1.5,
+            'distance': (i % 89 + 1) * 0.01
+        }
+
+
+def measure(operation: operations.Operation, rows_count: int) -> float:
+    """Return processed rows per second"""
+    start = time.perf_counter()
+    for _ in operation(generate_rows(rows_count)):
+        pass
+    return rows_count / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--rows', default=500000, help='number of rows to process')
+@click.option('--batch-rows', default=operations.columnar.DEFAULT_BATCH_ROWS, help='batch size to compare with')
+def bench_columnar(rows: int, batch_rows: int) -> None:
+    """Compare row and columnar throughput of speed calculation from yandex_maps_graph"""
+    mappers = [
+        operations.MathMapper('total_time', 'total_time / 3600'),
+        operations.MathMapper('speed', 'distance / total_time'),
+        operations.Project(['weekday', 'hour', 'speed'])
+    ]
+    aggregator = operations.MultiAggregate([operations.Sum('total_time'), operations.Sum('distance')])
+    keys = ['weekday', 'hour']
+    cases = [
+        ('map', operations.Map(*mappers), operations.BatchMap(*mappers, batch_rows=batch_rows)),
+        ('reduce', operations.Reduce(aggregator, keys), operations.BatchReduce(aggregator, keys, batch_rows=batch_rows))
+    ]
+    for name, row_operation, batch_operation in cases:
+        per_row = measure(row_operation, rows)
+        batched = measure(batch_operation, rows)
+        print(f'{name:7} rows:     {per_row:12.0f} rows/sec')
+        print(f'{name:7} columnar: {batched:12.0f} rows/sec ({batched / per_row:.1f}x)')
+
+
+if __name__ == '__main__':
+    bench_columnar()
@@ -0,0 +1,34 @@
+import time
+import typing as tp
+
+import click
+
+from compgraph import operations
+
+
+def generate_rows(rows_count: int) -> tp.Generator[operations.TRow, None, None]:
+    for i in range(rows_count):
+        yield {'doc_id': i % 1000, 'text': f'word{(i * 7919) % rows_count}'}
+
+
+def measure(sort: operations.Sort, rows_count: int) -> float:
+    """Return sorted rows per second"""
+    start = time.perf_counter()
+    for _ in sort(generate_rows(rows_count)):
+        pass
+    return rows_count / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option('--rows', default=500000, help='number of rows to sort')
+@click.option('--chunk-bytes', default=operations.external_sort.DEFAULT_CHUNK_BYTES, help='chunk size to compare with')
+def bench_sort_transport(rows: int, chunk_bytes: int) -> None:
+    """Compare ExternalSort throughput with row-by-row and chunked transport"""
+    per_row = measure(operations.Sort(['text'], chunk_bytes=0), rows)
+    chunked = measure(operations.Sort(['text'], chunk_bytes=chunk_bytes), rows)
+    print(f'row by row: {per_row:12.0f} rows/sec')
+    print(f'chunked:    {chunked:12.0f} rows/sec ({chunked / per_row:.1f}x)')
+
+
+if __name__ == '__main__':
+    bench_sort_transport()
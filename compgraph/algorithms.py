@@ -6,17 +6,22 @@ def word_count_graph(
     input_stream_name: str,
     text_column: str = 'text',
     count_column: str = 'count',
-    reversed: bool = False
+    reversed: bool = False,
+    workers: int = 1
 ) -> Graph:
-    """Constructs graph which counts words in text_column of all rows passed"""
-    return Graph \
+    """Constructs graph which counts words in text_column of all rows passed,
+    with several workers words are counted in parallel"""
+    words = Graph \
         .graph_from_iter(input_stream_name) \
         .map(operations.FilterPunctuation(text_column)) \
         .map(operations.LowerCase(text_column)) \
-        .map(operations.Split(text_column)) \
-        .sort(operations.Sort([text_column])) \
-        .reduce(operations.Count(count_column), [text_column]) \
-        .sort(operations.Sort([count_column, text_column], reverse=reversed))
+        .map(operations.Split(text_column))
+
+    if workers > 1:
+        counts = words.parallel_reduce(operations.Count(count_column), [text_column], workers)
+    else:
+        counts = words.hash_reduce(operations.Count(count_column), [text_column])
+    return counts.sort(operations.Sort([count_column, text_column], reverse=reversed))
 
 
 def inverted_index_graph(
@@ -24,8 +29,10 @@ def inverted_index_graph(
     doc_column: str = 'doc_id',
     text_column: str = 'text',
     result_column: str = 'tf_idf',
+    workers: int = 1
 ) -> Graph:
-    """Constructs graph which calculates td-idf for every word/document pair"""
+    """Constructs graph which calculates td-idf for every word/document pair,
+    with several workers reduces and joins are run in parallel"""
     graph_base = Graph.graph_from_iter(input_stream_name)
 
     splited_words = graph_base \
@@ -35,27 +42,43 @@ def inverted_index_graph(
 
     count_docs = graph_base.reduce(operations.Count('count'), tuple())
 
-    tf = splited_words \
-        .sort(operations.Sort([doc_column])) \
-        .reduce(operations.TermFrequency(text_column, 'tf'), [doc_column]) \
-        .sort(operations.Sort([text_column]))
-
-    idf = tf \
-        .reduce(operations.Count('count'), (text_column,)) \
-        .join(
-            operations.InnerJoiner(suffix_a='_word', suffix_b='_doc'),
-            count_docs,
-            tuple()
-        ) \
+    term_frequency = operations.TermFrequency(text_column, 'tf')
+    if workers > 1:
+        # ordered keeps rows of every word in order of documents, as sequential reduce does
+        tf = splited_words.parallel_reduce(term_frequency, [doc_column], workers, ordered=True)
+    else:
+        tf = splited_words.sort(operations.Sort([doc_column])).reduce(term_frequency, [doc_column])
+    tf = tf.sort(operations.Sort([text_column]))
+
+    words_count = tf.reduce(operations.Count('count'), (text_column,))
+    count_joiner = operations.InnerJoiner(suffix_a='_word', suffix_b='_doc')
+    if workers > 1:
+        words_count = words_count.parallel_join(count_joiner, count_docs, tuple(), workers)
+    else:
+        words_count = words_count.broadcast_join(count_joiner, count_docs, tuple())
+
+    idf = words_count \
         .map(operations.MathMapper('idf', 'count_doc / count_word')) \
         .map(operations.LogarithmMap('idf')) \
         .map(operations.Project(['idf', text_column]))
 
-    return tf \
-        .join(operations.InnerJoiner(), idf, (text_column,)) \
+    if workers > 1:
+        # parallel join sorts its partitions itself, so idf may come in any order;
+        # hot words are not salted, so their rows keep the order which breaks ties of TopN below
+        tf_idf = tf.parallel_join(
+            operations.InnerJoiner(), idf, (text_column,), workers, ordered=True, salt_hot_keys=False
+        )
+    else:
+        tf_idf = tf.join(operations.InnerJoiner(), idf, (text_column,))
+
+    tf_idf = tf_idf \
         .map(operations.Product(['idf', 'tf'], result_column)) \
-        .map(operations.Project([doc_column, text_column, result_column])) \
-        .reduce(operations.TopN(result_column, 3), (text_column,))
+        .map(operations.Project([doc_column, text_column, result_column]))
+
+    top_n = operations.TopN(result_column, 3)
+    if workers > 1:
+        return tf_idf.parallel_reduce(top_n, (text_column,), workers, ordered=True).optimize()
+    return tf_idf.reduce(top_n, (text_column,)).optimize()
 
 
 def pmi_graph(
@@ -63,22 +86,32 @@ def pmi_graph(
     doc_column: str = 'doc_id',
     text_column: str = 'text',
     result_column: str = 'pmi',
+    workers: int = 1
 ) -> Graph:
     """Constructs graph which gives for every document
-    the top 10 words ranked by pointwise mutual information"""
+    the top 10 words ranked by pointwise mutual information,
+    with several workers words are counted in parallel"""
     graph_base = Graph.graph_from_iter(input_stream_name)
 
-    words = graph_base \
+    long_words = graph_base \
         .map(operations.FilterPunctuation(text_column)) \
         .map(operations.LowerCase(text_column)) \
         .map(operations.Split(text_column)) \
         .map(operations.Filter(
-            lambda row: len(row[text_column]) > 4
-        )) \
-        .sort(operations.Sort([doc_column, text_column])) \
-        .reduce(operations.Count('doc_count'), [doc_column, text_column]) \
+            lambda row: len(row[text_column]) > 4, [text_column]
+        ))
+
+    word_count = operations.Count('doc_count')
+    if workers > 1:
+        words = long_words.parallel_reduce(word_count, [doc_column, text_column], workers, ordered=True)
+    else:
+        words = long_words \
+            .sort(operations.Sort([doc_column, text_column])) \
+            .reduce(word_count, [doc_column, text_column])
+
+    words = words \
         .map(operations.Filter(
-            lambda row: row['doc_count'] > 1
+            lambda row: row['doc_count'] > 1, ['doc_count']
         ))
 
     tf = words \
@@ -93,11 +126,14 @@ def pmi_graph(
 
     count_words = words.reduce(operations.Sum('doc_count'), tuple())
 
-    idf = words \
-        .sort(operations.Sort([text_column])) \
-        .reduce(operations.Sum('doc_count'), (text_column,)) \
+    if workers > 1:
+        words_total = words.parallel_reduce(operations.Sum('doc_count'), (text_column,), workers, ordered=True)
+    else:
+        words_total = words.sort(operations.Sort([text_column])).reduce(operations.Sum('doc_count'), (text_column,))
+
+    idf = words_total \
         .map(operations.Rename('doc_count', 'overall_count')) \
-        .join(
+        .broadcast_join(
             operations.InnerJoiner(),
             count_words,
             tuple()
@@ -110,9 +146,9 @@ def pmi_graph(
         .map(operations.MathMapper(result_column, 'tf / idf')) \
         .map(operations.LogarithmMap(result_column)) \
         .map(operations.Project([doc_column, text_column, result_column])) \
-        .sort(operations.Sort([result_column], reverse=True)) \
-        .sort(operations.Sort([doc_column])) \
-        .reduce(operations.TopN(result_column, 10), [doc_column])
+        .sort(operations.Sort([(doc_column, 'asc'), (result_column, 'desc')])) \
+        .reduce(operations.TopN(result_column, 10), [doc_column]) \
+        .optimize()
 
 
 def yandex_maps_graph(
@@ -129,12 +165,13 @@ def yandex_maps_graph(
     timezone: str = 'UTC'
 ) -> Graph:
     """Constructs graph which measures average
-    speed in km/h depending on the weekday and hour"""
+    speed in km/h depending on the weekday and hour;
+    edge lengths and travel times are computed concurrently,
+    times are summed and speed is computed by batches of columns"""
 
     edges_len = Graph.graph_from_iter(input_stream_name_length) \
         .map(operations.Haversine(start_coord_column, end_coord_column, 'distance')) \
-        .map(operations.Project(['distance', edge_id_column])) \
-        .sort(operations.Sort([edge_id_column]))
+        .map(operations.Project(['distance', edge_id_column]))
 
     times = Graph.graph_from_iter(input_stream_name_time) \
         .map(operations.ToDatetime(
@@ -147,16 +184,16 @@ def yandex_maps_graph(
             leave_time_column, enter_time_column, 'total_time'
         )) \
         .map(operations.MathMapper('total_time', 'total_time / 3600')) \
-        .sort(operations.Sort([edge_id_column])) \
-        .join(operations.InnerJoiner(), edges_len, [edge_id_column]) \
+        .broadcast_join(operations.InnerJoiner(), edges_len, [edge_id_column]) \
         .sort(operations.Sort([weekday_result_column, hour_result_column]))
 
-    total_time = times \
-        .reduce(operations.Sum('total_time'), [weekday_result_column, hour_result_column])
-    total_distance = times \
-        .reduce(operations.Sum('distance'), [weekday_result_column, hour_result_column])
-
-    return total_time \
-        .join(operations.InnerJoiner(), total_distance, [weekday_result_column, hour_result_column]) \
+    return times \
+        .reduce(
+            operations.MultiAggregate([operations.Sum('total_time'), operations.Sum('distance')]),
+            [weekday_result_column, hour_result_column]
+        ) \
         .map(operations.MathMapper(speed_result_column, 'distance / total_time')) \
-        .map(operations.Project([weekday_result_column, hour_result_column, speed_result_column]))
+        .map(operations.Project([weekday_result_column, hour_result_column, speed_result_column])) \
+        .optimize() \
+        .columnar() \
+        .concurrent()
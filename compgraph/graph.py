@@ -1,6 +1,18 @@
+import itertools
 import typing as tp
 
 from . import operations as ops
+from .operations.columnar import DEFAULT_BATCH_ROWS, HAS_NUMPY
+from .operations.parallel import DEFAULT_PREFETCH
+from .operations.utils import SpillingTee
+
+# rows buffered in memory by every lagging consumer of a shared node in `run_shared`
+SHARED_ROWS_IN_MEMORY = 10000
+
+# operations which move rows through processes or disk, unused columns are dropped before them
+PRUNED_INPUT_OPERATIONS: tuple[type[ops.Operation], ...] = (
+    ops.Sort, ops.Join, ops.BroadcastJoin, ops.GraceHashJoin, ops.ParallelJoin, ops.HashReduce, ops.ParallelReduce
+)
 
 
 class Graph:
@@ -9,35 +21,42 @@ class Graph:
     def __init__(self) -> None:
         self.previos_graphs: list['Graph'] = []
         self.operation: ops.Operation | None = None
+        # known order of output rows
+        self.sorted_by: ops.TOrder = ()
 
     @staticmethod
     def _private_init(operation: ops.Operation, previos_graphs: list['Graph']) -> 'Graph':
         new_graph = Graph()
         new_graph.operation = operation
         new_graph.previos_graphs = previos_graphs
+        new_graph.sorted_by = operation.output_order([graph.sorted_by for graph in previos_graphs])
         return new_graph
 
     @staticmethod
-    def graph_from_iter(name: str) -> 'Graph':
+    def graph_from_iter(name: str, sorted_by: tp.Sequence[ops.TSortKey] = ()) -> 'Graph':
         """Construct new graph which reads data
         from row iterator (in form of sequence of Rows
         from 'kwargs' passed to 'run' method) into graph data-flow
 
         Use ops.ReadIterFactory
         :param name: name of kwarg to use as data source
+        :param sorted_by: keys the rows are known to be sorted by, as in Sort
         """
-        return Graph._private_init(ops.ReadIterFactory(name), [])
+        return Graph._private_init(ops.ReadIterFactory(name, ops.make_order(sorted_by)), [])
 
     @staticmethod
-    def graph_from_file(filename: str, parser: tp.Callable[[str], ops.TRow]) -> 'Graph':
+    def graph_from_file(
+        filename: str, parser: tp.Callable[[str], ops.TRow], sorted_by: tp.Sequence[ops.TSortKey] = ()
+    ) -> 'Graph':
         """Construct new graph extended with operation
         for reading rows from file
 
         Use ops.Read
         :param filename: filename to read from
         :param parser: parser from string to Row
+        :param sorted_by: keys the rows are known to be sorted by, as in Sort
         """
-        return Graph._private_init(ops.ReadIterFile(filename, parser), [])
+        return Graph._private_init(ops.ReadIterFile(filename, parser, ops.make_order(sorted_by)), [])
 
     def _add_operation(self, operation: ops.Operation) -> 'Graph':
         """Extend current graph with map-reduce operation
@@ -45,27 +64,98 @@ class Graph:
         """
         return self._private_init(operation, [self])
 
-    def map(self, mapper: ops.Mapper) -> 'Graph':
+    def map(self, mapper: ops.Mapper, workers: int = 1, ordered: bool = True) -> 'Graph':
         """Construct new graph extended with
-        map operation with particular mapper
+        map operation with particular mapper.
+        Consecutive maps with the same parallelism are fused into one operation
+        when graph is run or optimized, unless the first one has other consumers
         :param mapper: mapper to use
+        :param workers: number of processes to map rows in, see ops.ParallelMap
+        :param ordered: whether parallel map keeps order of rows
         """
+        if workers > 1:
+            return self._add_operation(ops.ParallelMap(mapper, workers=workers, ordered=ordered))
         return self._add_operation(ops.Map(mapper))
 
     def reduce(self, reducer: ops.Reducer, keys: tp.Sequence[str]) -> 'Graph':
         """Construct new graph extended with
-        reduce operation with particular reducer
+        reduce operation with particular reducer.
+        If graph ends with sort by the same keys and reducer is combinable,
+        map-side combiner is inserted before the sort when graph is run or optimized,
+        unless the sort has other consumers
         :param reducer: reducer to use
         :param keys: keys for grouping
         """
         return self._add_operation(ops.Reduce(reducer, keys))
 
-    def sort(self, sort: ops.Sort) -> 'Graph':
-        """Construct new graph extended with sort operation
-        :param keys: sorting keys (typical is tuple of strings)
+    def hash_reduce(self, reducer: ops.Aggregator, keys: tp.Sequence[str]) -> 'Graph':
+        """Construct new graph extended with reduce operation
+        which groups rows in a hash table, so input needs no sort
+        :param reducer: aggregator to use
+        :param keys: keys for grouping
+        """
+        return self._add_operation(ops.HashReduce(reducer, keys))
+
+    def parallel_reduce(
+        self,
+        reducer: ops.Reducer,
+        keys: tp.Sequence[str],
+        workers: int,
+        ordered: bool = False,
+        salt_hot_keys: bool = True
+    ) -> 'Graph':
+        """Construct new graph extended with reduce operation which
+        hash-partitions rows by keys between worker processes; input needs no sort
+        :param reducer: reducer to use, must be picklable
+        :param keys: keys for grouping
+        :param workers: number of worker processes
+        :param ordered: sort result by keys
+        :param salt_hot_keys: spread hot keys between workers, see ops.ParallelReduce
+        """
+        return self._add_operation(ops.ParallelReduce(reducer, keys, workers, ordered, salt_hot_keys))
+
+    def parallel_join(
+        self,
+        joiner: ops.Joiner,
+        join_graph: 'Graph',
+        keys: tp.Sequence[str],
+        workers: int,
+        ordered: bool = False,
+        salt_hot_keys: bool = True
+    ) -> 'Graph':
+        """Construct new graph extended with join operation with another graph,
+        which hash-partitions both graphs by keys between worker processes; inputs need no sort.
+        Keyless join sends the other graph, which should be small, to every worker
+        :param joiner: join strategy to use, must be picklable
+        :param join_graph: other graph to join with
+        :param keys: keys for grouping
+        :param workers: number of worker processes
+        :param ordered: sort result by keys
+        :param salt_hot_keys: spread hot keys between workers, see ops.ParallelJoin.
+            Rows of a salted key lose their input order, so it is off before order-sensitive reducers
+        """
+        return self._private_init(ops.ParallelJoin(joiner, keys, workers, ordered, salt_hot_keys), [self, join_graph])
+
+    def sort(self, sort: ops.Sort, check_sorted: bool = False) -> 'Graph':
+        """Construct new graph extended with sort operation.
+        If rows are already known to be in the sort order,
+        sort is replaced with pass-through
+        :param sort: sort operation
+        :param check_sorted: make pass-through verify the order of rows
         """
+        if ops.implies_order(self.sorted_by, sort.order):
+            return self._add_operation(ops.AssumeSorted(sort.order, check_sorted))
         return self._add_operation(sort)
 
+    def top(self, keys: tp.Sequence[ops.TSortKey], n: int, reverse: bool = False) -> 'Graph':
+        """Construct new graph extended with operation which takes
+        first n rows in sort order; only n rows are kept in memory
+        :param keys: sorting keys, as in Sort
+        :param n: number of rows to take
+        :param reverse: invert direction of all keys
+        """
+        return self._add_operation(ops.Top(keys, n, reverse))
+
     def join(self, joiner: ops.Joiner, join_graph: 'Graph', keys: tp.Sequence[str]) -> 'Graph':
         """Construct new graph extended with join operation with another graph
         :param joiner: join strategy to use
@@ -74,13 +164,362 @@ class Graph:
         """
         return self._private_init(ops.Join(joiner, keys), [self, join_graph])
 
+    def broadcast_join(self, joiner: ops.Joiner, join_graph: 'Graph', keys: tp.Sequence[str]) -> 'Graph':
+        """Construct new graph extended with hash join operation with another graph,
+        which is loaded into memory; inputs need no sort
+        :param joiner: join strategy to use
+        :param join_graph: other graph to join with, should be small
+        :param keys: keys for grouping
+        """
+        return self._private_init(ops.BroadcastJoin(joiner, keys), [self, join_graph])
+
+    def hash_join(self, joiner: ops.Joiner, join_graph: 'Graph', keys: tp.Sequence[str]) -> 'Graph':
+        """Construct new graph extended with partitioned (grace) hash join
+        operation with another graph; inputs need no sort and may exceed memory
+        :param joiner: join strategy to use
+        :param join_graph: other graph to join with
+        :param keys: keys for grouping
+        """
+        return self._private_init(ops.GraceHashJoin(joiner, keys), [self, join_graph])
+
+    def _topological_order(self) -> list['Graph']:
+        """Nodes reachable from this graph, every node goes after all its inputs"""
+        order: list['Graph'] = []
+        visited: set[int] = set()
+        stack: list[tuple['Graph', bool]] = [(self, False)]
+        while stack:
+            node, inputs_done = stack.pop()
+            if inputs_done:
+                order.append(node)
+                continue
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            stack.append((node, True))
+            stack.extend((prev_graph, False) for prev_graph in reversed(node.previos_graphs))
+        return order
+
+    @staticmethod
+    def _input_columns(node: 'Graph', columns: ops.TColumns) -> ops.TColumns:
+        assert node.operation is not None
+        return node.operation.input_columns(columns)
+
+    def _needed_columns(self, order: list['Graph']) -> dict[int, ops.TColumns]:
+        """Columns of every node output read by its consumers, None if all of them"""
+        needed: dict[int, ops.TColumns] = {id(self): None}
+        for node in reversed(order):
+            columns = self._input_columns(node, needed[id(node)])
+            for prev_graph in node.previos_graphs:
+                if id(prev_graph) not in needed:
+                    needed[id(prev_graph)] = None if columns is None else set(columns)
+                else:
+                    prev_columns = needed[id(prev_graph)]
+                    needed[id(prev_graph)] = None if prev_columns is None or columns is None else prev_columns | columns
+        return needed
+
+    @staticmethod
+    def _outputs_only(node: 'Graph', columns: set[str]) -> bool:
+        """Whether node is known to output no columns but given ones"""
+        operation = node.operation
+        if isinstance(operation, (ops.Sort, ops.AssumeSorted)):
+            return Graph._outputs_only(node.previos_graphs[0], columns)
+        if isinstance(operation, ops.Map) and isinstance(operation.mappers[-1], (ops.Project, ops.KeepColumns)):
+            return set(operation.mappers[-1].columns) <= columns
+        if isinstance(operation, (ops.Reduce, ops.HashReduce, ops.ParallelReduce)):
+            output_columns = operation.reducer.output_columns(tuple(operation.keys))
+            return output_columns is not None and output_columns <= columns
+        return isinstance(operation, ops.Combine)
+
+    @staticmethod
+    def _is_pushable(mapper: ops.Mapper) -> bool:
+        # filter which reads no columns may be random or stateful, so it stays where it is
+        return isinstance(mapper, ops.FilterMapper) and bool(mapper.read_columns)
+
+    @staticmethod
+    def _reorder_filters(mappers: tp.Sequence[ops.Mapper]) -> list[ops.Mapper]:
+        """Move every filter of a map chain before mappers which do not write columns it reads,
+        filter which reads only the column of preceding Split is fused into it"""
+        result: list[ops.Mapper] = []
+        for mapper in mappers:
+            position = len(result)
+            if Graph._is_pushable(mapper):
+                assert isinstance(mapper, ops.FilterMapper) and mapper.read_columns is not None
+                read_columns = set(mapper.read_columns)
+                while position > 0:
+                    previous = result[position - 1]
+                    if isinstance(previous, ops.FilterMapper) or previous.written_columns is None or \
+                            read_columns & set(previous.written_columns):
+                        break
+                    position -= 1
+                if position > 0 and isinstance(result[position - 1], ops.Split) and \
+                        read_columns <= {result[position - 1].column}:
+                    split = result[position - 1]
+                    assert isinstance(split, ops.Split)
+                    result[position - 1] = split.with_filter(mapper)
+                    continue
+            result.insert(position, mapper)
+        return result
+
+    def _push_filters(self) -> 'Graph':
+        """Construct new graph where filters are applied as early as their read columns allow"""
+        consumers = self._count_consumers()
+        copies: dict[int, Graph] = {}
+
+        def keeps_rows(operation: ops.Operation, read_columns: set[str]) -> bool:
+            """Whether filter commutes with operation"""
+            if isinstance(operation, (ops.Sort, ops.AssumeSorted)):
+                return True
+            if isinstance(operation, (ops.Reduce, ops.HashReduce, ops.ParallelReduce, ops.Combine,
+                                      ops.Join, ops.BroadcastJoin, ops.GraceHashJoin, ops.ParallelJoin)):
+                # rows of a group are dropped or kept all together
+                return read_columns <= set(operation.keys)
+            return False
+
+        def rebuild(node: Graph) -> Graph:
+            if id(node) in copies:
+                return copies[id(node)]
+            assert node.operation is not None
+            if isinstance(node.operation, ops.Map):
+                mappers = self._reorder_filters(node.operation.mappers)
+                leading = list(itertools.takewhile(self._is_pushable, mappers))
+                prev_graph = node.previos_graphs[0]
+                if leading and consumers[id(prev_graph)] == 1:
+                    result = with_filters(prev_graph, leading)
+                    mappers = mappers[len(leading):]
+                    # map made by with_filters is new and has no other consumers, so it is fused
+                    if mappers and isinstance(result.operation, ops.Map):
+                        mappers = [*result.operation.mappers, *mappers]
+                        result = result.previos_graphs[0]
+                else:
+                    result = rebuild(prev_graph)
+                if mappers:
+                    result = self._private_init(ops.Map(*mappers), [result])
+            else:
+                result = self._private_init(node.operation, [rebuild(prev) for prev in node.previos_graphs])
+            copies[id(node)] = result
+            return result
+
+        def with_filters(node: Graph, filters: list[ops.Mapper]) -> Graph:
+            """Rebuild node followed by filters, which node is the only consumer of"""
+            operation = node.operation
+            assert operation is not None
+            if isinstance(operation, ops.Map):
+                return rebuild(self._private_init(ops.Map(*operation.mappers, *filters), node.previos_graphs))
+            read_columns = {column for mapper in filters for column in mapper.read_columns or ()}
+            if node.previos_graphs and keeps_rows(operation, read_columns):
+                inputs = [
+                    with_filters(prev, filters) if consumers[id(prev)] == 1
+                    else self._private_init(ops.Map(*filters), [rebuild(prev)])
+                    for prev in node.previos_graphs
+                ]
+                return self._private_init(operation, inputs)
+            return self._private_init(ops.Map(*filters), [rebuild(node)])
+
+        return rebuild(self)
+
+    def _prune_columns(self) -> 'Graph':
+        """Construct new graph where columns which are not read downstream
+        are dropped before sorts and joins"""
+        order = self._topological_order()
+        needed = self._needed_columns(order)
+        copies: dict[int, Graph] = {}
+        for node in order:
+            assert node.operation is not None
+            inputs = [copies[id(prev_graph)] for prev_graph in node.previos_graphs]
+            columns = self._input_columns(node, needed[id(node)]) if inputs else None
+            if isinstance(node.operation, PRUNED_INPUT_OPERATIONS) and columns is not None:
+                for i in range(len(inputs)):
+                    if self._outputs_only(inputs[i], columns):
+                        continue
+                    inputs[i] = inputs[i]._add_operation(ops.Map(ops.KeepColumns(columns)))
+            copies[id(node)] = self._private_init(node.operation, inputs)
+        return copies[id(self)]
+
+    @staticmethod
+    def _fused(first: ops.Operation, second: ops.Operation) -> ops.Operation | None:
+        """Map operation which applies both maps in one pass, None if they can not be fused"""
+        # exact types: batched maps are made by `columnar` and kept
+        if type(first) is ops.Map and type(second) is ops.Map:
+            return ops.Map(*first.mappers, *second.mappers)
+        if isinstance(first, ops.ParallelMap) and isinstance(second, ops.ParallelMap) and \
+                (first.workers, first.ordered) == (second.workers, second.ordered):
+            return ops.ParallelMap(
+                *first.mappers, *second.mappers, workers=first.workers, ordered=first.ordered,
+                chunk_rows=first.chunk_rows, prefetch=first.prefetch
+            )
+        return None
+
+    def _insert_combiners(self) -> 'Graph':
+        """Construct new graph where reduce of combinable aggregator after sort by the same keys
+        becomes combiner, sort and merge of partial states. Sort with other consumers is kept,
+        so it is not computed twice"""
+        consumers = self._count_consumers()
+        copies: dict[int, Graph] = {}
+        for node in self._topological_order():
+            operation = node.operation
+            assert operation is not None
+            inputs = [copies[id(prev_graph)] for prev_graph in node.previos_graphs]
+            if (
+                type(operation) is ops.Reduce and isinstance(operation.reducer, ops.Aggregator) and
+                not isinstance(operation.reducer, ops.PartialMerge) and operation.reducer.combinable and
+                operation.keys and consumers[id(node.previos_graphs[0])] == 1
+            ):
+                sort = inputs[0].operation
+                if isinstance(sort, ops.Sort) and list(sort.keys) == list(operation.keys):
+                    combine = ops.Combine(operation.reducer, operation.keys)
+                    copies[id(node)] = self._private_init(combine, inputs[0].previos_graphs) \
+                        ._add_operation(sort) \
+                        ._add_operation(ops.Reduce(ops.PartialMerge(operation.reducer), operation.keys))
+                    continue
+            copies[id(node)] = self._private_init(operation, inputs)
+        return copies[id(self)]
+
+    def _plan(self) -> 'Graph':
+        """Construct new graph with combiners inserted and maps fused, as it is run"""
+        return self._insert_combiners()._fuse_maps()
+
+    def _fuse_maps(self) -> 'Graph':
+        """Construct new graph where every map is fused into the map before it.
+        Map with other consumers is not fused, so its work is not repeated by every consumer"""
+        consumers = self._count_consumers()
+        copies: dict[int, Graph] = {}
+        for node in self._topological_order():
+            operation = node.operation
+            assert operation is not None
+            inputs = [copies[id(prev_graph)] for prev_graph in node.previos_graphs]
+            if len(inputs) == 1 and consumers[id(node.previos_graphs[0])] == 1:
+                assert inputs[0].operation is not None
+                fused = self._fused(inputs[0].operation, operation)
+                if fused is not None:
+                    operation, inputs = fused, inputs[0].previos_graphs
+            copies[id(node)] = self._private_init(operation, inputs)
+        return copies[id(self)]
+
+    def optimize(self) -> 'Graph':
+        """Construct new graph which computes the same result with less work.
+        Combiners are inserted before sorts, consecutive maps are fused,
+        filters are moved as early as columns they read allow (mapper filters must declare them),
+        then columns which are not read downstream are dropped before sorts and joins, so less data is moved
+        """
+        return self._plan()._push_filters()._prune_columns()._fuse_maps()
+
+    def concurrent(self, prefetch: int = DEFAULT_PREFETCH) -> 'Graph':
+        """Construct new graph where inputs of joins which share no nodes with the rest
+        of graph are computed in forked processes (see ops.Prefetch), so independent
+        branches run at the same time and a few chunks ahead of the join
+        :param prefetch: number of row chunks computed ahead by every branch
+        """
+        consumers = self._count_consumers()
+        private: dict[int, bool] = {}
+        copies: dict[int, Graph] = {}
+        for node in self._topological_order():
+            assert node.operation is not None
+            # node and all its inputs are used only by this branch
+            private[id(node)] = all(
+                consumers[id(prev_graph)] == 1 and private[id(prev_graph)] for prev_graph in node.previos_graphs
+            )
+            inputs = [copies[id(prev_graph)] for prev_graph in node.previos_graphs]
+            if len(inputs) > 1:
+                inputs = [
+                    graph._add_operation(ops.Prefetch(prefetch=prefetch))
+                    if private[id(prev_graph)] and consumers[id(prev_graph)] == 1
+                    and not isinstance(prev_graph.operation, ops.Prefetch) else graph
+                    for graph, prev_graph in zip(inputs, node.previos_graphs)
+                ]
+            copies[id(node)] = self._private_init(node.operation, inputs)
+        return copies[id(self)]
+
+    def columnar(self, batch_rows: int = DEFAULT_BATCH_ROWS) -> 'Graph':
+        """Construct new graph where maps of vectorized mappers, reduces and combiners
+        with vectorized aggregators process batches of rows stored by columns
+        (see ops.BatchMap, ops.BatchReduce, ops.BatchCombine). Graph is returned as is without numpy.
+        Combiners are inserted and consecutive maps are fused first;
+        maps are rebuilt by `optimize`, so it goes before this call
+        :param batch_rows: maximum number of rows in batch
+        """
+        if not HAS_NUMPY:
+            return self
+        graph = self._plan()
+        copies: dict[int, Graph] = {}
+        for node in graph._topological_order():
+            operation = node.operation
+            # exact types: parallel and already batched operations are kept
+            if type(operation) is ops.Map and all(mapper.vectorized for mapper in operation.mappers):
+                operation = ops.BatchMap(*operation.mappers, batch_rows=batch_rows)
+            elif type(operation) is ops.Reduce and isinstance(operation.reducer, ops.Aggregator) \
+                    and operation.reducer.vectorized:
+                operation = ops.BatchReduce(operation.reducer, operation.keys, batch_rows=batch_rows)
+            elif type(operation) is ops.Combine and operation.reducer.vectorized:
+                operation = ops.BatchCombine(
+                    operation.reducer, operation.keys, operation.max_groups_in_memory, batch_rows=batch_rows
+                )
+            assert operation is not None
+            inputs = [copies[id(prev_graph)] for prev_graph in node.previos_graphs]
+            copies[id(node)] = self._private_init(operation, inputs)
+        return copies[id(graph)]
+
     def run(self, **kwargs: tp.Any) -> ops.TRowsIterable:
         """Single method to start execution; data sources passed as kwargs"""
+        yield from self._plan()._run(kwargs)
+
+    def _run(self, kwargs: dict[str, tp.Any]) -> tp.Iterator[ops.TRow]:
         if self.operation is None:
             raise ValueError('No operation to perform.')
         if not self.previos_graphs:
             yield from self.operation(**kwargs)
         else:
             yield from self.operation(*[
-                prev_graphs.run(**kwargs) for prev_graphs in self.previos_graphs
+                prev_graph._start(lambda graph: graph._run(kwargs)) for prev_graph in self.previos_graphs
             ])
+
+    def _start(self, run_input: tp.Callable[['Graph'], tp.Iterator[ops.TRow]]) -> tp.Iterator[ops.TRow]:
+        """Rows of the graph, prefetched graph is started at once instead of on first row,
+        so every prefetched input of a join runs while the join reads the other ones
+        :param run_input: function which gives rows of an input graph
+        """
+        if isinstance(self.operation, ops.Prefetch):
+            return self.operation(*[run_input(prev_graph) for prev_graph in self.previos_graphs])
+        return run_input(self)
+
+    def _count_consumers(self) -> dict[int, int]:
+        """Count incoming edges for every node reachable from this graph"""
+        consumers: dict[int, int] = {}
+        stack: list['Graph'] = [self]
+        visited: set[int] = set()
+        while stack:
+            node = stack.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            for prev_graph in node.previos_graphs:
+                consumers[id(prev_graph)] = consumers.get(id(prev_graph), 0) + 1
+                stack.append(prev_graph)
+        return consumers
+
+    def _run_shared(
+        self,
+        consumers: dict[int, int],
+        branches: dict[int, list[tp.Iterator[ops.TRow]]],
+        kwargs: dict[str, tp.Any]
+    ) -> tp.Iterator[ops.TRow]:
+        if id(self) in branches:
+            return branches[id(self)].pop()
+        if self.operation is None:
+            raise ValueError('No operation to perform.')
+        if not self.previos_graphs:
+            rows = self.operation(**kwargs)
+        else:
+            rows = self.operation(*[
+                prev_graph._run_shared(consumers, branches, kwargs) for prev_graph in self.previos_graphs
+            ])
+        if consumers.get(id(self), 0) > 1:
+            branches[id(self)] = SpillingTee(rows, consumers[id(self)], SHARED_ROWS_IN_MEMORY).branches()
+            return branches[id(self)].pop()
+        return rows
+
+    def run_shared(self, **kwargs: tp.Any) -> ops.TRowsIterable:
+        """Same as `run`, but every node used by several consumers is computed once.
+        Its output is fed to consumers through a tee, which spills rows
+        to disk when one consumer lags behind the others"""
+        graph = self._plan()
+        yield from graph._run_shared(graph._count_consumers(), {}, kwargs)
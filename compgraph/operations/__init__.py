@@ -1,9 +1,10 @@
 from .operations_base import (
-    Operation, TRowsGenerator, TRowsIterable, TRow,
+    Operation, TRowsGenerator, TRowsIterable, TRow, TOrder, TColumns, TSortKey, TBatch,
+    make_order, implies_order,
     Read, ReadIterFile, ReadIterFactory,
-    Mapper, Map,
+    Mapper, RowMapper, FilterMapper, Map,
     Joiner, Join,
-    Reducer, Reduce
+    Reducer, Aggregator, Reduce
 )
 from .joiners import (
     InnerJoiner, LeftJoiner, RightJoiner, OuterJoiner
@@ -11,28 +12,35 @@ from .joiners import (
 from .mappers import (
     MathMapper, LowerCase, Filter,
     FilterPunctuation, Split, DummyMapper, Rename,
-    Product, Project, LogarithmMap,
+    Product, Project, KeepColumns, LogarithmMap,
     Haversine, ToDatetime, TimestampDiff
 )
 from .reducers import (
     FirstReducer, TopN, TermFrequency,
-    Count, Sum
+    Count, Sum, Min, Max, Mean, MultiAggregate, PartialMerge
 )
-from .external_sort import ExternalSort as Sort
+from .external_sort import ExternalSort as Sort, AssumeSorted, Top
+from .hash_operations import HashReduce, Combine, BroadcastJoin, GraceHashJoin
+from .parallel import Prefetch, ParallelMap, ParallelReduce, ParallelJoin
+from .columnar import BatchMap, BatchReduce, BatchCombine
 
 
 __all__ = [
-    'Operation', 'TRowsGenerator', 'TRowsIterable', 'TRow',
+    'Operation', 'TRowsGenerator', 'TRowsIterable', 'TRow', 'TOrder', 'TColumns', 'TSortKey', 'TBatch',
+    'make_order', 'implies_order',
     'Read', 'ReadIterFile', 'ReadIterFactory',
-    'Mapper', 'Map',
+    'Mapper', 'RowMapper', 'FilterMapper', 'Map',
     'Joiner', 'Join',
-    'Reducer', 'Reduce',
+    'Reducer', 'Aggregator', 'Reduce',
     'InnerJoiner', 'LeftJoiner', 'RightJoiner', 'OuterJoiner',
     'MathMapper', 'LogarithmMap', 'LowerCase', 'Filter',
     'FilterPunctuation', 'Split', 'DummyMapper', 'Rename',
-    'Product', 'Project', 'LogarithmMap', 'MathMapper',
+    'Product', 'Project', 'KeepColumns', 'LogarithmMap', 'MathMapper',
     'Haversine', 'ToDatetime', 'TimestampDiff',
     'FirstReducer', 'TopN', 'TermFrequency',
-    'Count', 'Sum',
-    'Sort'
+    'Count', 'Sum', 'Min', 'Max', 'Mean', 'MultiAggregate', 'PartialMerge',
+    'Sort', 'AssumeSorted', 'Top',
+    'HashReduce', 'Combine', 'BroadcastJoin', 'GraceHashJoin',
+    'Prefetch', 'ParallelMap', 'ParallelReduce', 'ParallelJoin',
+    'BatchMap', 'BatchReduce', 'BatchCombine'
 ]
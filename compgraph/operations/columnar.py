@@ -0,0 +1,332 @@
+import typing as tp
+from itertools import compress, islice, repeat
+from operator import itemgetter
+
+from compgraph.operations.hash_operations import Combine, DEFAULT_COMBINER_GROUPS
+from compgraph.operations.operations_base import (
+    Aggregator, FilterMapper, Map, Mapper, Reduce, RowMapper, TBatch, TRow, TRowsIterable, TRowsGenerator
+)
+from compgraph.operations.utils import check_key_order
+
+try:
+    import numpy as np
+except ImportError:  # columnar execution is optional
+    np = None
+
+HAS_NUMPY = np is not None
+
+DEFAULT_BATCH_ROWS = 4096
+
+# dtype kinds computed by numpy kernels: bools and objects keep python semantics in row mode
+NUMERIC_KINDS = 'iuf'
+
+
+def _same_columns(part: list[TRow]) -> TBatch | None:
+    """Columns of rows if all of them have columns of the first one, else None"""
+    if len(set(map(len, part))) > 1:
+        return None
+    try:
+        return {column: list(map(itemgetter(column), part)) for column in part[0]}
+    except KeyError:
+        return None
+
+
+def to_batches(
+    rows: TRowsIterable, batch_rows: int, columns: tp.Collection[str] | None = None
+) -> tp.Iterator[tuple[TBatch, int]]:
+    """
+    Store rows by columns, every batch holds rows with the same columns
+    :param rows: rows to store
+    :param batch_rows: maximum number of rows in batch
+    :param columns: columns to keep, all columns of rows if None
+    :return: pairs of batch and its number of rows
+    """
+    rows = iter(rows)
+    while chunk := list(islice(rows, batch_rows)):
+        if columns is not None:
+            yield {column: list(map(itemgetter(column), chunk)) for column in columns}, len(chunk)
+            continue
+        batch = _same_columns(chunk)
+        if batch is not None:
+            yield batch, len(chunk)
+            continue
+        start = 0
+        while start < len(chunk):
+            names = chunk[start].keys()
+            stop = start + 1
+            while stop < len(chunk) and chunk[stop].keys() == names:
+                stop += 1
+            yield {column: [row[column] for row in chunk[start:stop]] for column in names}, stop - start
+            start = stop
+
+
+def to_rows(batch: TBatch, size: int) -> list[TRow]:
+    """
+    :param batch: columns of rows
+    :param size: number of rows in batch
+    """
+    if not batch:
+        return [{} for _ in range(size)]
+    values = [column.tolist() if isinstance(column, np.ndarray) else column for column in batch.values()]
+    return list(map(dict, map(zip, repeat(tuple(batch)), zip(*values))))
+
+
+def from_batches(batches: tp.Iterable[tuple[TBatch, int]]) -> TRowsGenerator:
+    for batch, size in batches:
+        yield from to_rows(batch, size)
+
+
+def as_array(values: tp.Any) -> tp.Any:
+    """Numpy array of numbers, or array of python objects if values are not all numbers"""
+    if isinstance(values, np.ndarray):
+        return values
+    array = np.array(values)
+    if array.ndim == 1 and array.dtype.kind in NUMERIC_KINDS:
+        return array
+    return np.fromiter(values, dtype=object, count=len(values))
+
+
+def is_numeric(array: tp.Any) -> bool:
+    return bool(array.dtype.kind in NUMERIC_KINDS)
+
+
+def take(batch: TBatch, mask: tp.Any) -> tuple[TBatch, int]:
+    """
+    :param batch: columns of rows
+    :param mask: boolean array, rows to keep
+    :return: batch of kept rows and its number of rows
+    """
+    keep = mask.tolist()
+    result = {
+        column: values[mask] if isinstance(values, np.ndarray) else list(compress(values, keep))
+        for column, values in batch.items()
+    }
+    return result, int(np.count_nonzero(mask))
+
+
+def abs_max(array: tp.Any) -> int | None:
+    """Maximum absolute value of integer array, None for float one"""
+    if array.dtype.kind == 'f':
+        return None
+    # abs of the minimal int64 overflows, so python ints are compared
+    return max(-int(array.min()), int(array.max()), 0)
+
+
+def vectorize(
+    kernel: tp.Callable[..., tp.Any],
+    arrays: list[tp.Any],
+    fallback: tp.Callable[[], tp.Any],
+    int_bound: tp.Callable[[list[int | None]], int | float] | None = None
+) -> tp.Any:
+    """
+    Apply numpy kernel to arrays of numbers. When some arrays are not numbers,
+    numpy reports an arithmetic error or integer math may overflow 64 bits
+    (numpy wraps it around silently), values are computed by fallback
+    one by one, so results and errors of python arithmetic are kept
+    :param kernel: function of arrays
+    :param arrays: arguments of kernel, see `as_array`
+    :param fallback: function which computes values in python
+    :param int_bound: function of `abs_max` of every array, which gives maximum absolute value
+        of integer results of kernel, intermediate ones included. Without it kernel
+        is applied only to float arrays
+    """
+    if all(is_numeric(array) for array in arrays) and not (
+        any(array.dtype.kind in 'iu' for array in arrays) and
+        (int_bound is None or not int_bound([abs_max(array) for array in arrays]) <= np.iinfo(np.int64).max)
+    ):
+        try:
+            with np.errstate(all='raise'):
+                return kernel(*arrays)
+        except (ArithmeticError, TypeError, ValueError):
+            pass
+    return fallback()
+
+
+def group_starts(batch: TBatch, keys: tp.Sequence[str], size: int) -> list[int]:
+    """
+    Index of first row of every group of a batch sorted by keys
+    :param batch: columns of rows
+    :param keys: keys for grouping
+    :param size: number of rows in batch
+    """
+    changed = np.zeros(size - 1, dtype=bool)
+    for key in keys:
+        values = np.fromiter(batch[key], dtype=object, count=size)
+        changed |= values[1:] != values[:-1]
+    return [0, *(np.flatnonzero(changed) + 1).tolist()]
+
+
+def group_by_hash(
+    batch: TBatch, keys: tp.Sequence[str], size: int
+) -> tuple[TBatch, list[int], list[tuple[tp.Any, ...]]]:
+    """
+    Reorder rows of batch so rows with equal keys go together,
+    groups go in order of first appearance and rows of a group keep their order
+    :param batch: columns of rows
+    :param keys: keys for grouping
+    :param size: number of rows in batch
+    :return: reordered batch, index of first row of every group and key values of every group
+    """
+    groups: dict[tuple[tp.Any, ...], int] = {}
+    if keys:
+        key_values = zip(*(batch[key] for key in keys))
+        codes = np.fromiter(
+            (groups.setdefault(values, len(groups)) for values in key_values), dtype=np.intp, count=size
+        )
+    else:
+        groups[()] = 0
+        codes = np.zeros(size, dtype=np.intp)
+    order = np.argsort(codes, kind='stable')
+    indices = order.tolist()
+    result = {
+        column: values[order] if isinstance(values, np.ndarray) else list(map(values.__getitem__, indices))
+        for column, values in batch.items()
+    }
+    starts = [0, *np.cumsum(np.bincount(codes))[:-1].tolist()]
+    return result, starts, list(groups)
+
+
+class BatchMap(Map):
+    """
+    Map which applies chain of mappers to batches of rows stored by columns.
+    Consecutive vectorized mappers (see `Mapper.vectorized`) process
+    a whole batch at once with numpy, other mappers are applied row by row
+    as in `Map`, between them rows are converted to batches and back.
+    Rows keep their order
+    """
+
+    def __init__(self, *mappers: Mapper, batch_rows: int = DEFAULT_BATCH_ROWS) -> None:
+        """
+        :param mappers: mappers to apply
+        :param batch_rows: maximum number of rows in batch
+        """
+        if not HAS_NUMPY:
+            raise ImportError('numpy is required for columnar execution')
+        super().__init__(*mappers)
+        self.batch_rows = batch_rows
+        # runs of vectorized mappers and row mappers wrapped into Map
+        self._stages: list[tuple[bool, tp.Sequence[Mapper] | Map]] = []
+        for mapper in mappers:
+            if self._stages and self._stages[-1][0] and mapper.vectorized:
+                tp.cast(list[Mapper], self._stages[-1][1]).append(mapper)
+            elif self._stages and not self._stages[-1][0] and not mapper.vectorized:
+                row_map = tp.cast(Map, self._stages[-1][1])
+                self._stages[-1] = (False, Map(*row_map.mappers, mapper))
+            else:
+                self._stages.append((True, [mapper]) if mapper.vectorized else (False, Map(mapper)))
+
+    @staticmethod
+    def _map_batches(
+        mappers: tp.Sequence[Mapper], batches: tp.Iterable[tuple[TBatch, int]]
+    ) -> tp.Iterator[tuple[TBatch, int]]:
+        for batch, size in batches:
+            for mapper in mappers:
+                if isinstance(mapper, FilterMapper):
+                    batch, size = take(batch, mapper.keep_columns(batch, size))
+                    if not size:
+                        break
+                else:
+                    assert isinstance(mapper, RowMapper)
+                    batch = mapper.map_columns(batch, size)
+            else:
+                yield batch, size
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        stream: tp.Iterable[tp.Any] = rows
+        batched = False
+        for vectorized, stage in self._stages:
+            if vectorized:
+                if not batched:
+                    stream = to_batches(stream, self.batch_rows)
+                stream = self._map_batches(tp.cast(tp.Sequence[Mapper], stage), stream)
+            else:
+                stream = tp.cast(Map, stage)(from_batches(stream) if batched else stream)
+            batched = vectorized
+        yield from from_batches(stream) if batched else stream
+
+
+class BatchReduce(Reduce):
+    """
+    Reduce of rows sorted by keys, which folds batches of rows stored by columns
+    with a vectorized aggregator (see `Aggregator.aggregate_columns`).
+    Only columns read by aggregator are stored, group split by end of batch
+    is carried to the next one and states of its parts are merged.
+    Rows may be sorted by keys in any direction, unsorted rows raise AssertionError as in `Reduce`
+    """
+
+    def __init__(self, reducer: Aggregator, keys: tp.Sequence[str], batch_rows: int = DEFAULT_BATCH_ROWS) -> None:
+        """
+        :param reducer: aggregator to fold rows of every group with
+        :param keys: keys for grouping
+        :param batch_rows: maximum number of rows in batch
+        """
+        if not HAS_NUMPY:
+            raise ImportError('numpy is required for columnar execution')
+        super().__init__(reducer, keys)
+        self.reducer: Aggregator = reducer
+        self.batch_rows = batch_rows
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        group_key = tuple(self.keys)
+        columns = self.reducer.input_columns(group_key, None)
+        last: tuple[tuple[tp.Any, ...], tp.Any] | None = None
+        descending: dict[int, bool] = {}
+        for batch, size in to_batches(rows, self.batch_rows, columns):
+            starts = group_starts(batch, group_key, size)
+            states = self.reducer.aggregate_columns(batch, starts, size)
+            key_values = list(zip(*([batch[key][start] for start in starts] for key in group_key))) \
+                if group_key else [()] * len(starts)
+            ordered_values = key_values if last is None else [last[0], *key_values]
+            for last_values, values in zip(ordered_values, ordered_values[1:]):
+                if values != last_values:
+                    check_key_order(values, last_values, descending)
+            if last is not None:
+                if last[0] == key_values[0]:
+                    states[0] = self.reducer.merge(last[1], states[0])
+                else:
+                    yield from self.reducer.finalize(group_key, *last)
+            for values, state in zip(key_values[:-1], states[:-1]):
+                yield from self.reducer.finalize(group_key, values, state)
+            last = key_values[-1], states[-1]
+        if last is not None:
+            yield from self.reducer.finalize(group_key, *last)
+
+
+class BatchCombine(Combine):
+    """
+    Map-side combiner which folds batches of rows stored by columns
+    with a vectorized aggregator (see `Aggregator.aggregate_columns`),
+    output is the same as of `Combine`
+    """
+
+    def __init__(
+        self,
+        reducer: Aggregator,
+        keys: tp.Sequence[str],
+        max_groups_in_memory: int = DEFAULT_COMBINER_GROUPS,
+        batch_rows: int = DEFAULT_BATCH_ROWS
+    ) -> None:
+        """
+        :param reducer: combinable aggregator
+        :param keys: keys for grouping
+        :param max_groups_in_memory: maximum number of groups in hash table
+        :param batch_rows: maximum number of rows in batch
+        """
+        if not HAS_NUMPY:
+            raise ImportError('numpy is required for columnar execution')
+        super().__init__(reducer, keys, max_groups_in_memory)
+        self.batch_rows = batch_rows
+
+    def __call__(self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
+        states: dict[tuple[tp.Any, ...], tp.Any] = {}
+        columns = self.reducer.input_columns(tuple(self.keys), None)
+        for batch, size in to_batches(rows, self.batch_rows, columns):
+            batch, starts, key_values = group_by_hash(batch, self.keys, size)
+            for values, state in zip(key_values, self.reducer.aggregate_columns(batch, starts, size)):
+                if values in states:
+                    states[values] = self.reducer.merge(states[values], state)
+                    continue
+                if len(states) >= self.max_groups_in_memory:
+                    yield from self._flush(states)
+                states[values] = state
+        yield from self._flush(states)
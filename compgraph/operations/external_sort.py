@@ -1,38 +1,317 @@
+import bisect
+import contextlib
+import heapq
+import itertools
+import pickle
 import typing as tp
-from multiprocessing import Pipe, Process, connection
+from multiprocessing import connection
 from operator import itemgetter
 
-from compgraph.operations.operations_base import Operation, TRowsIterable, TRowsGenerator
+from compgraph.operations.operations_base import (
+    Operation, TColumns, TOrder, TRow, TRowsIterable, TRowsGenerator, TSortKey, is_ordered, make_order
+)
+from compgraph.operations.utils import dump_to_file, load_from_file
+from compgraph.operations.workers import Task, TaskError, worker_session
+
+KiB = 1024
+MiB = 1024 * KiB
+DEFAULT_MAX_BYTES_IN_MEMORY = 64 * MiB
+DEFAULT_CHUNK_BYTES = 256 * KiB
+DEFAULT_SAMPLE_SIZE = 10000
+
+
+class _Descending:
+    """Sort key value wrapper with inverted comparison"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value: tp.Any) -> None:
+        self.value = value
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _Descending) and bool(self.value == other.value)
+
+    def __lt__(self, other: '_Descending') -> bool:
+        return bool(other.value < self.value)
+
+    def __gt__(self, other: '_Descending') -> bool:
+        return bool(other.value > self.value)
+
+
+def sort_key(order: TOrder) -> tuple[tp.Callable[[TRow], tp.Any], bool]:
+    """
+    :param order: order to sort rows in
+    :return: key function and reverse flag for `list.sort`
+    """
+    columns = [column for column, _ in order]
+    directions = {descending for _, descending in order}
+    if len(directions) == 1:
+        return itemgetter(*columns), directions.pop()
+
+    # values of descending keys are wrapped, so any comparable values work
+    def key(row: TRow) -> tuple[tp.Any, ...]:
+        return tuple(_Descending(row[column]) if descending else row[column] for column, descending in order)
+
+    return key, False
+
+
+class RowsSender:
+    """
+    Send rows through connection in pickled chunks instead of one by one.
+    Chunk length adapts so that pickled chunk is about `chunk_bytes` long.
+    Empty chunk marks the end of stream.
+    """
+
+    def __init__(self, endpoint: connection.Connection, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> None:
+        """
+        :param endpoint: connection to send to
+        :param chunk_bytes: desired size of one chunk, 0 sends every row separately
+        """
+        self.endpoint = endpoint
+        self.chunk_bytes = chunk_bytes
+        self.chunk_rows = 1
+        self._buffer: list[TRow] = []
+
+    def send(self, row: TRow) -> None:
+        self._buffer.append(row)
+        if len(self._buffer) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        data = pickle.dumps(self._buffer, protocol=pickle.HIGHEST_PROTOCOL)
+        self.endpoint.send_bytes(data)
+        if self.chunk_bytes > 0:
+            # grow at most twice per chunk, so one huge row does not explode the chunk
+            fitting_rows = self.chunk_bytes * len(self._buffer) // len(data)
+            self.chunk_rows = max(1, min(2 * self.chunk_rows, fitting_rows))
+        self._buffer = []
+
+    def close(self) -> None:
+        """Flush buffered rows and send end of stream"""
+        self.flush()
+        self.endpoint.send_bytes(pickle.dumps([]))
+
+
+def recv_chunks(endpoint: connection.Connection) -> tp.Generator[tuple[list[TRow], int], None, None]:
+    """
+    Receive chunks sent by RowsSender until end of stream
+    :param endpoint: connection to receive from
+    :return: generator of chunk rows and its pickled size
+    """
+    while True:
+        data = endpoint.recv_bytes()
+        chunk = pickle.loads(data)
+        if isinstance(chunk, TaskError):
+            chunk.reraise()
+        if not chunk:
+            return
+        yield chunk, len(data)
+
+
+class SortedRuns:
+    """
+    Out-of-core sort: rows are collected into a run until
+    the memory budget is exceeded, then the run is sorted
+    and written to a temporary file. Resulting rows are produced
+    by k-way heap merge of all runs.
+    Sort is stable, as `list.sort` is.
+    """
+
+    def __init__(
+        self,
+        keys: tp.Sequence[TSortKey],
+        reverse: bool = False,
+        max_rows_in_memory: int | None = None,
+        max_bytes_in_memory: int | None = DEFAULT_MAX_BYTES_IN_MEMORY,
+        tmp_dir: str | None = None
+    ) -> None:
+        """
+        :param keys: sorting keys, with optional direction per key
+        :param reverse: invert direction of all keys
+        :param max_rows_in_memory: maximum number of rows in one run
+        :param max_bytes_in_memory: maximum size of one run (in pickled bytes)
+        :param tmp_dir: directory for run files, system default if None
+        """
+        self.key, self.reverse = sort_key(make_order(keys, reverse))
+        self.max_rows_in_memory = max_rows_in_memory
+        self.max_bytes_in_memory = max_bytes_in_memory
+        self.tmp_dir = tmp_dir
+        self._rows: list[TRow] = []
+        self._rows_bytes = 0
+        self._runs: list[tp.IO[bytes]] = []
+
+    def _budget_exceeded(self) -> bool:
+        return (
+            (self.max_rows_in_memory is not None and len(self._rows) >= self.max_rows_in_memory) or
+            (self.max_bytes_in_memory is not None and self._rows_bytes >= self.max_bytes_in_memory)
+        )
+
+    def _spill(self) -> None:
+        self._rows.sort(key=self.key, reverse=self.reverse)
+        self._runs.append(dump_to_file(self._rows, self.tmp_dir))
+        self._rows = []
+        self._rows_bytes = 0
+
+    @property
+    def runs_count(self) -> int:
+        return len(self._runs)
+
+    def add(self, row: TRow, size: int = 0) -> None:
+        """
+        :param row: row to sort
+        :param size: size of row in bytes, used for memory budget
+        """
+        self._rows.append(row)
+        self._rows_bytes += size
+        if self._budget_exceeded():
+            self._spill()
+
+    def __iter__(self) -> tp.Iterator[TRow]:
+        """Yield all added rows in sorted order"""
+        if not self._runs:
+            self._rows.sort(key=self.key, reverse=self.reverse)
+            rows, self._rows = self._rows, []
+            return iter(rows)
+        if self._rows:
+            self._spill()
+        runs, self._runs = self._runs, []
+        # heapq.merge takes equal rows from earlier runs first, so merge stays stable
+        return heapq.merge(*map(load_from_file, runs), key=self.key, reverse=self.reverse)
 
 
 def do_sort(
     endpoint: connection.Connection,
-    keys: tuple[str, ...],
-    reverse: bool
+    keys: tp.Sequence[TSortKey],
+    reverse: bool,
+    max_rows_in_memory: int | None = None,
+    max_bytes_in_memory: int | None = DEFAULT_MAX_BYTES_IN_MEMORY,
+    tmp_dir: str | None = None,
+    chunk_bytes: int = DEFAULT_CHUNK_BYTES
 ) -> None:
-    rows = []
-    while True:
-        row = endpoint.recv()
-        if row is None:
-            break
-        rows.append(row)
-    rows.sort(key=itemgetter(*keys), reverse=reverse)
-    for row in rows:
-        endpoint.send(row)
-    endpoint.send(None)
+    runs = SortedRuns(keys, reverse, max_rows_in_memory, max_bytes_in_memory, tmp_dir)
+    for chunk, chunk_size in recv_chunks(endpoint):
+        row_size = chunk_size // len(chunk)
+        for row in chunk:
+            runs.add(row, row_size)
+    sender = RowsSender(endpoint, chunk_bytes)
+    for row in runs:
+        sender.send(row)
+    sender.close()
+
+
+class SortTask(Task):
+    def __init__(self, *args: tp.Any) -> None:
+        """
+        :param args: `do_sort` arguments except endpoint
+        """
+        self.args = args
+
+    def run(self, endpoint: connection.Connection) -> None:
+        do_sort(endpoint, *self.args)
 
 
 class ExternalSort(Operation):
     """
     In order to not account materialization
     during sorting in main process memory consumption, we delegate
-    sorting to a separate process.
-    This class illustrates cross-process streaming.
+    sorting to a separate process. Processes are taken from
+    the worker pool shared by all sorts of current process.
+    With `workers` > 1 rows are range-partitioned between several
+    sorting processes: boundaries are chosen from a sample of first rows,
+    and sorted partitions are concatenated. Equal keys always get
+    to the same partition, so result is the same as of a single sort.
+    Child process sorts rows out-of-core: when the memory budget
+    is exceeded, sorted runs are spilled to temporary files
+    and merged back on output.
+    Every key may have its own direction: `[('doc_id', 'asc'), ('pmi', 'desc')]`.
     """
 
-    def __init__(self, keys: tp.Sequence[str], reverse: bool = False):
-        self.keys = keys
+    def __init__(
+        self,
+        keys: tp.Sequence[TSortKey],
+        reverse: bool = False,
+        max_rows_in_memory: int | None = None,
+        max_bytes_in_memory: int | None = DEFAULT_MAX_BYTES_IN_MEMORY,
+        tmp_dir: str | None = None,
+        chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+        workers: int = 1,
+        sample_size: int = DEFAULT_SAMPLE_SIZE
+    ):
+        """
+        :param keys: sorting keys, column name or pair of column name and 'asc' / 'desc'
+        :param reverse: invert direction of all keys
+        :param max_rows_in_memory: maximum number of rows sorted in memory at once
+        :param max_bytes_in_memory: maximum size (in pickled bytes) of rows sorted in memory at once
+        :param tmp_dir: directory for spilled runs, system default if None
+        :param chunk_bytes: approximate size of row chunks sent between processes,
+            0 sends rows one by one
+        :param workers: number of sorting processes
+        :param sample_size: number of first rows used to choose partition boundaries
+        """
+        self.order = make_order(keys, reverse)
+        self.sort_keys = keys
+        self.keys = [column for column, _ in self.order]
         self.reverse = reverse
+        self.max_rows_in_memory = max_rows_in_memory
+        self.max_bytes_in_memory = max_bytes_in_memory
+        self.tmp_dir = tmp_dir
+        self.chunk_bytes = chunk_bytes
+        self.workers = workers
+        self.sample_size = sample_size
+
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        # sort is stable, so rows with equal keys keep the input order
+        order = self.order
+        return order + tuple(item for item in input_orders[0] if item[0] not in self.keys)
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return None if columns is None else columns | set(self.keys)
+
+    def _task(self) -> SortTask:
+        return SortTask(
+            self.sort_keys, self.reverse,
+            self.max_rows_in_memory, self.max_bytes_in_memory, self.tmp_dir,
+            self.chunk_bytes
+        )
+
+    def _partition_boundaries(self, sample: list[TRow]) -> list[tp.Any]:
+        key, _ = sort_key(self.order)
+        sample_keys = sorted(map(key, sample))
+        boundaries: list[tp.Any] = []
+        if not sample_keys:
+            return boundaries
+        for i in range(1, self.workers):
+            boundary = sample_keys[i * len(sample_keys) // self.workers]
+            if not boundaries or boundaries[-1] < boundary:
+                boundaries.append(boundary)
+        return boundaries
+
+    def _parallel_sort(self, rows: TRowsIterable) -> TRowsGenerator:
+        rows = iter(rows)
+        sample = list(itertools.islice(rows, self.sample_size))
+        boundaries = self._partition_boundaries(sample)
+        key, reverse = sort_key(self.order)
+        with contextlib.ExitStack() as stack:
+            endpoints = [
+                stack.enter_context(worker_session(self._task()))
+                for _ in range(len(boundaries) + 1)
+            ]
+            senders = [RowsSender(endpoint, self.chunk_bytes) for endpoint in endpoints]
+            row_count_before = 0
+            for row in itertools.chain(sample, rows):
+                # partition i holds keys from (boundaries[i - 1], boundaries[i]]
+                senders[bisect.bisect_left(boundaries, key(row))].send(row)
+                row_count_before += 1
+            for sender in senders:
+                sender.close()
+            row_count_after = 0
+            for endpoint in (reversed(endpoints) if reverse else endpoints):
+                for chunk, _ in recv_chunks(endpoint):
+                    yield from chunk
+                    row_count_after += len(chunk)
+            assert row_count_before == row_count_after
 
     def __call__(
         self,
@@ -40,23 +319,91 @@ class ExternalSort(Operation):
         *args: tp.Any,
         **kwargs: tp.Any
     ) -> TRowsGenerator:
-        local_endpoint, remote_endpoint = Pipe()
-        process = Process(
-            target=do_sort,
-            args=(remote_endpoint, self.keys, self.reverse)
-        )
-        process.start()
-        row_count_before = 0
+        if self.workers > 1:
+            yield from self._parallel_sort(rows)
+            return
+        with worker_session(self._task()) as endpoint:
+            sender = RowsSender(endpoint, self.chunk_bytes)
+            row_count_before = 0
+            for row in rows:
+                sender.send(row)
+                row_count_before += 1
+            sender.close()
+            row_count_after = 0
+            for chunk, _ in recv_chunks(endpoint):
+                yield from chunk
+                row_count_after += len(chunk)
+            assert row_count_before == row_count_after
+
+
+class AssumeSorted(Operation):
+    """
+    Replacement of a sort whose order is already implied by its input:
+    rows are passed through as is. With `check` every row is compared
+    to the previous one, and unsorted input raises ValueError
+    """
+
+    def __init__(self, order: TOrder, check: bool = False) -> None:
+        """
+        :param order: order the input is known to have
+        :param check: verify the order while passing rows through
+        """
+        self.order = order
+        self.check = check
+
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        return input_orders[0]
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return None if columns is None else columns | {column for column, _ in self.order}
+
+    def __call__(
+        self,
+        rows: TRowsIterable,
+        *args: tp.Any,
+        **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        if not self.check:
+            yield from rows
+            return
+        previous: TRow | None = None
         for row in rows:
-            local_endpoint.send(row)
-            row_count_before += 1
-        local_endpoint.send(None)
-        row_count_after = 0
-        while True:
-            local_endpoint_row = local_endpoint.recv()
-            if local_endpoint_row is None:
-                break
-            yield local_endpoint_row
-            row_count_after += 1
-        assert row_count_before == row_count_after
-        process.join()
+            if previous is not None and not is_ordered(previous, row, self.order):
+                raise ValueError(f'Rows are not sorted by {self.order}: {previous} goes before {row}')
+            previous = row
+            yield row
+
+
+class Top(Operation):
+    """
+    First `n` rows of the table sorted by keys, as `Sort` would give them.
+    Rows are selected with a bounded heap, so only `n` rows are kept in memory
+    and nothing is sent to a sorting process
+    """
+
+    def __init__(self, keys: tp.Sequence[TSortKey], n: int, reverse: bool = False) -> None:
+        """
+        :param keys: sorting keys, column name or pair of column name and 'asc' / 'desc'
+        :param n: number of rows to take
+        :param reverse: invert direction of all keys
+        """
+        self.order = make_order(keys, reverse)
+        self.keys = [column for column, _ in self.order]
+        self.n = n
+
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        return self.order + tuple(item for item in input_orders[0] if item[0] not in self.keys)
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return None if columns is None else columns | set(self.keys)
+
+    def __call__(
+        self,
+        rows: TRowsIterable,
+        *args: tp.Any,
+        **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        key, reverse = sort_key(self.order)
+        # both are stable: equal to sorted(rows, key=key, reverse=reverse)[:n]
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        yield from select(self.n, rows, key=key)
@@ -0,0 +1,256 @@
+import typing as tp
+from itertools import chain, groupby, islice
+
+from compgraph.operations.external_sort import SortedRuns
+from compgraph.operations.operations_base import (
+    Aggregator, Join, Joiner, Operation, TColumns, TRow, TRowsIterable, TRowsGenerator,
+    PARTIAL_STATE_COLUMN, _get_subdict_values
+)
+from compgraph.operations.utils import SpillQueue
+
+DEFAULT_MAX_GROUPS_IN_MEMORY = 100000
+DEFAULT_PARTITIONS = 16
+DEFAULT_COMBINER_GROUPS = 10000
+
+
+def _drain(queue: SpillQueue[TRow]) -> TRowsGenerator:
+    try:
+        while queue:
+            yield queue.popleft()
+    finally:
+        queue.close()
+
+
+class HashReduce(Operation):
+    """
+    Reduce which groups rows in a hash table, so input does not have to be sorted.
+    When the table has `max_groups_in_memory` groups, rows of new groups
+    are hash-partitioned to temporary files, and every partition
+    is aggregated the same way after the table is emitted.
+    Groups are emitted in order of first appearance within a partition.
+    """
+
+    def __init__(
+        self,
+        reducer: Aggregator,
+        keys: tp.Sequence[str],
+        max_groups_in_memory: int = DEFAULT_MAX_GROUPS_IN_MEMORY,
+        partitions: int = DEFAULT_PARTITIONS,
+        tmp_dir: str | None = None
+    ) -> None:
+        """
+        :param reducer: aggregator to fold rows of every group with
+        :param keys: keys for grouping
+        :param max_groups_in_memory: maximum number of groups in hash table
+        :param partitions: number of partitions to spill rows of new groups to
+        :param tmp_dir: directory for spilled partitions, system default if None
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.max_groups_in_memory = max_groups_in_memory
+        self.partitions = partitions
+        self.tmp_dir = tmp_dir
+
+    def _aggregate(self, rows: TRowsIterable, depth: int) -> TRowsGenerator:
+        group_key = tuple(self.keys)
+        states: dict[tuple[tp.Any, ...], tp.Any] = {}
+        spilled: list[SpillQueue[TRow]] = []
+        for row in rows:
+            key_values = _get_subdict_values(row, group_key)
+            if key_values in states:
+                states[key_values] = self.reducer.update(states[key_values], row)
+            elif len(states) < self.max_groups_in_memory:
+                states[key_values] = self.reducer.update(self.reducer.init(), row)
+            else:
+                if not spilled:
+                    spilled = [SpillQueue[TRow](0, self.tmp_dir) for _ in range(self.partitions)]
+                # depth salts the hash, so keys of one partition split up on the next level
+                spilled[hash((depth, key_values)) % self.partitions].append(row)
+
+        for key_values, state in states.items():
+            yield from self.reducer.finalize(group_key, key_values, state)
+        states.clear()
+
+        for partition in spilled:
+            yield from self._aggregate(_drain(partition), depth + 1)
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.reducer.input_columns(tuple(self.keys), columns)
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        yield from self._aggregate(rows, 0)
+
+
+class Combine(Operation):
+    """
+    Map-side combiner: pre-aggregates rows with equal keys
+    in a bounded hash table and emits partial states.
+    When the table is full, all partial states are flushed.
+    Output rows hold key columns and aggregator state
+    in PARTIAL_STATE_COLUMN, they are finalized by `PartialMerge` reducer.
+    """
+
+    def __init__(
+        self,
+        reducer: Aggregator,
+        keys: tp.Sequence[str],
+        max_groups_in_memory: int = DEFAULT_COMBINER_GROUPS
+    ) -> None:
+        """
+        :param reducer: combinable aggregator
+        :param keys: keys for grouping
+        :param max_groups_in_memory: maximum number of groups in hash table
+        """
+        assert reducer.combinable
+        self.reducer = reducer
+        self.keys = keys
+        self.max_groups_in_memory = max_groups_in_memory
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        # output holds only keys and state, whatever is needed downstream
+        return self.reducer.input_columns(tuple(self.keys), None)
+
+    def _flush(self, states: dict[tuple[tp.Any, ...], tp.Any]) -> TRowsGenerator:
+        for key_values, state in states.items():
+            to_yield: TRow = dict(zip(self.keys, key_values))
+            to_yield[PARTIAL_STATE_COLUMN] = state
+            yield to_yield
+        states.clear()
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        states: dict[tuple[tp.Any, ...], tp.Any] = {}
+        for row in rows:
+            key_values = _get_subdict_values(row, self.keys)
+            if key_values in states:
+                states[key_values] = self.reducer.update(states[key_values], row)
+                continue
+            if len(states) >= self.max_groups_in_memory:
+                yield from self._flush(states)
+            states[key_values] = self.reducer.update(self.reducer.init(), row)
+        yield from self._flush(states)
+
+
+class BroadcastJoin(Operation):
+    """
+    Hash join for the case when right table is small: right table
+    is loaded into a hash table and left table is streamed through it.
+    No input needs to be sorted. Joiner semantics and suffixes are the same
+    as in `Join`, unmatched right rows (for right and outer joiners)
+    are emitted after the whole left table.
+    """
+
+    def __init__(self, joiner: Joiner, keys: tp.Sequence[str]) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: join keys
+        """
+        self.joiner = joiner
+        self.keys = keys
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.joiner.input_columns(self.keys, columns)
+
+    def _build(self, rows: TRowsIterable) -> dict[tuple[tp.Any, ...], list[TRow]]:
+        table: dict[tuple[tp.Any, ...], list[TRow]] = {}
+        for row in rows:
+            table.setdefault(_get_subdict_values(row, self.keys), []).append(row)
+        return table
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        assert len(args) > 0
+        assert hasattr(args[0], "__iter__")
+        table = self._build(args[0])
+        matched: set[tuple[tp.Any, ...]] = set()
+        # neighbouring left rows with equal keys are joined at once
+        for key, group in groupby(rows, key=lambda row: _get_subdict_values(row, self.keys)):
+            table_group = table.get(key)
+            if table_group is None:
+                yield from self.joiner(self.keys, group, [])
+            else:
+                matched.add(key)
+                yield from self.joiner(self.keys, group, table_group)
+        for key, table_group in table.items():
+            if key not in matched:
+                yield from self.joiner(self.keys, [], table_group)
+
+
+class GraceHashJoin(Operation):
+    """
+    Partitioned hash join for large unsorted inputs.
+    If right table fits into `max_rows_in_memory`, it is joined as `BroadcastJoin`.
+    Otherwise both tables are hash-partitioned by join keys to temporary files
+    and joined partition by partition, partitions with too large right part
+    are partitioned again. Partition which is still too large after `MAX_DEPTH` levels
+    (e.g. of one hot key) is sorted out of core and merge-joined as in `Join`.
+    Result rows are the same as of `Join`, order differs.
+    """
+
+    MAX_DEPTH = 4
+
+    def __init__(
+        self,
+        joiner: Joiner,
+        keys: tp.Sequence[str],
+        max_rows_in_memory: int = DEFAULT_MAX_GROUPS_IN_MEMORY,
+        partitions: int = DEFAULT_PARTITIONS,
+        tmp_dir: str | None = None
+    ) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: join keys
+        :param max_rows_in_memory: maximum number of right rows in hash table
+        :param partitions: number of partitions on every level
+        :param tmp_dir: directory for partitions, system default if None
+        """
+        self.joiner = joiner
+        self.keys = keys
+        self.max_rows_in_memory = max_rows_in_memory
+        self.partitions = partitions
+        self.tmp_dir = tmp_dir
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.joiner.input_columns(self.keys, columns)
+
+    def _partition(self, rows: TRowsIterable, depth: int) -> list[SpillQueue[TRow]]:
+        partitions = [SpillQueue[TRow](0, self.tmp_dir) for _ in range(self.partitions)]
+        for row in rows:
+            partitions[hash((depth, _get_subdict_values(row, self.keys))) % self.partitions].append(row)
+        return partitions
+
+    def _sorted(self, rows: TRowsIterable) -> tp.Iterator[TRow]:
+        runs = SortedRuns(self.keys, max_rows_in_memory=self.max_rows_in_memory, tmp_dir=self.tmp_dir)
+        for row in rows:
+            runs.add(row)
+        return iter(runs)
+
+    def _join(self, rows_left: TRowsIterable, rows_right: TRowsIterable, depth: int) -> TRowsGenerator:
+        rows_right = iter(rows_right)
+        head = list(islice(rows_right, self.max_rows_in_memory + 1))
+        if len(head) <= self.max_rows_in_memory:
+            yield from BroadcastJoin(self.joiner, self.keys)(rows_left, chain(head, rows_right))
+            return
+        if depth >= self.MAX_DEPTH:
+            # keys are too skewed to be split, so the partition is not loaded into a hash table
+            yield from Join(self.joiner, self.keys)(self._sorted(rows_left), self._sorted(chain(head, rows_right)))
+            return
+
+        partitions_right = self._partition(chain(head, rows_right), depth)
+        partitions_left = self._partition(rows_left, depth)
+        for partition_left, partition_right in zip(partitions_left, partitions_right):
+            if partition_left or partition_right:
+                yield from self._join(_drain(partition_left), _drain(partition_right), depth + 1)
+            partition_left.close()
+            partition_right.close()
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        assert len(args) > 0
+        assert hasattr(args[0], "__iter__")
+        yield from self._join(rows, args[0], 0)
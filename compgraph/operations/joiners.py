@@ -2,9 +2,11 @@ import typing as tp
 
 from compgraph.operations.operations_base import TRowsIterable, TRow, TRowsGenerator, Joiner
 
-from .utils import PeekableIterator
+from .utils import PeekableIterator, SpillList
 
 TRowsIterator = tp.Iterator[TRow]
+# right rows which can be replayed as they are, e.g. groups of a hash table
+TRowsMaterialized = list[TRow] | SpillList[TRow]
 
 
 def _plug_iter() -> TRowsIterator:
@@ -12,25 +14,41 @@ def _plug_iter() -> TRowsIterator:
     return iter((empty_dict,))
 
 
+def _plug_list() -> list[TRow]:
+    return [{}]
+
+
 class InnerJoiner(Joiner):
-    """Join with inner strategy"""
+    """
+    Join with inner strategy.
+    Right group is replayed for every left row; large right groups
+    are spilled to disk, so memory is bounded even for hot keys.
+    Right rows given as list or SpillList are replayed without a copy
+    """
 
     def _merge_matching_rows(
         self,
         keys: tp.Sequence[str],
         rows_a: TRowsIterator,
-        rows_b: TRowsIterator
+        rows_b: TRowsIterator | TRowsMaterialized
     ) -> TRowsGenerator:
-        rows_b_list = list(rows_b)
-        for row_left in rows_a:
-            for row_right in rows_b_list:
-                yield self._merge_rows_with_suffixes(keys, row_left, row_right)
+        if isinstance(rows_b, (list, SpillList)):
+            for row_left in rows_a:
+                for row_right in rows_b:
+                    yield self._merge_rows_with_suffixes(keys, row_left, row_right)
+            return
+        rows_b_list = SpillList[TRow](self.max_rows_in_memory)
+        try:
+            rows_b_list.extend(rows_b)
+            yield from self._merge_matching_rows(keys, rows_a, rows_b_list)
+        finally:
+            rows_b_list.close()
 
     def _handle_empty_iterators(
         self,
         keys: tp.Sequence[str],
         rows_a: PeekableIterator[TRow],
-        rows_b: PeekableIterator[TRow]
+        rows_b: PeekableIterator[TRow] | TRowsMaterialized
     ) -> TRowsGenerator:
         yield from self._merge_matching_rows(keys, rows_a, rows_b)
 
@@ -41,7 +59,9 @@ class InnerJoiner(Joiner):
         rows_b: TRowsIterable,
     ) -> TRowsGenerator:
         yield from self._handle_empty_iterators(
-            keys, PeekableIterator(iter(rows_a)), PeekableIterator(iter(rows_b))
+            keys,
+            PeekableIterator(iter(rows_a)),
+            rows_b if isinstance(rows_b, (list, SpillList)) else PeekableIterator(iter(rows_b))
         )
 
 
@@ -52,12 +72,12 @@ class OuterJoiner(InnerJoiner):
         self,
         keys: tp.Sequence[str],
         rows_a: PeekableIterator[TRow],
-        rows_b: PeekableIterator[TRow]
+        rows_b: PeekableIterator[TRow] | TRowsMaterialized
     ) -> TRowsGenerator:
         yield from super()._merge_matching_rows(
             keys,
             rows_a if rows_a else _plug_iter(),
-            rows_b if rows_b else _plug_iter()
+            rows_b if rows_b else _plug_list()
         )
 
 
@@ -68,12 +88,12 @@ class LeftJoiner(InnerJoiner):
         self,
         keys: tp.Sequence[str],
         rows_a: PeekableIterator[TRow],
-        rows_b: PeekableIterator[TRow]
+        rows_b: PeekableIterator[TRow] | TRowsMaterialized
     ) -> TRowsGenerator:
         yield from super()._merge_matching_rows(
             keys,
             rows_a,
-            rows_b if rows_b else _plug_iter()
+            rows_b if rows_b else _plug_list()
         )
 
 
@@ -84,7 +104,7 @@ class RightJoiner(InnerJoiner):
         self,
         keys: tp.Sequence[str],
         rows_a: PeekableIterator[TRow],
-        rows_b: PeekableIterator[TRow]
+        rows_b: PeekableIterator[TRow] | TRowsMaterialized
     ) -> TRowsGenerator:
         yield from super()._merge_matching_rows(
             keys,
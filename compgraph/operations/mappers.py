@@ -1,23 +1,34 @@
+import functools
 import math
 import re
 import string
 import typing as tp
 import datetime
 import ast
-import operator
 import zoneinfo
 
-from compgraph.operations.operations_base import Mapper, TRow, TRowsGenerator
+from compgraph.operations.columnar import as_array, np, vectorize
+from compgraph.operations.operations_base import (
+    FilterMapper, Mapper, RowMapper, TBatch, TColumns, TOrder, TRow, TRowsGenerator, order_prefix
+)
 
 
-class DummyMapper(Mapper):
+class DummyMapper(RowMapper):
     """Yield exactly the row passed"""
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        yield row
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return ()
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return ()
+
+    def map_row(self, row: TRow) -> TRow:
+        return row
 
 
-class FilterPunctuation(Mapper):
+class FilterPunctuation(RowMapper):
     """Left only non-punctuation symbols"""
 
     maping_filer = str.maketrans('', '', string.punctuation)
@@ -28,12 +39,20 @@ class FilterPunctuation(Mapper):
         """
         self.column = column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.column] = row[self.column].translate(self.maping_filer)
-        yield row
+        return row
 
 
-class LowerCase(Mapper):
+class LowerCase(RowMapper):
     """Replace column value with value in lower case"""
 
     def __init__(self, column: str):
@@ -46,21 +65,46 @@ class LowerCase(Mapper):
     def _lower_case(txt: str) -> str:
         return txt.lower()
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.column] = self._lower_case(row[self.column])
-        yield row
+        return row
 
 
 class Split(Mapper):
     """Split row on multiple rows by separator"""
 
-    def __init__(self, column: str, separator: str | None = None) -> None:
+    def __init__(
+        self, column: str, separator: str | None = None,
+        condition: tp.Callable[[TRow], bool] | None = None
+    ) -> None:
         """
         :param column: name of column to split
         :param separator: string to separate by
+        :param condition: if given, only parts satisfying it are yielded;
+            it gets a row holding only the split column, so no row is copied for skipped parts
         """
         self.column = column
         self.separator = separator
+        self.condition = condition
+
+    def with_filter(self, mapper: FilterMapper) -> 'Split':
+        """
+        :param mapper: filter which reads only the split column
+        :return: split which applies the filter to every part
+        """
+        assert mapper.read_columns is not None and set(mapper.read_columns) <= {self.column}
+        condition = self.condition
+        if condition is None:
+            return Split(self.column, self.separator, mapper.keep)
+        return Split(self.column, self.separator, lambda row: condition(row) and mapper.keep(row))
 
     @staticmethod
     def _word_generator(
@@ -72,18 +116,30 @@ class Split(Mapper):
             start = pattern.end()
         yield text[start:]
 
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
     def __call__(self, row: TRow) -> TRowsGenerator:
         for word in self._word_generator(
             row[self.column], self.separator or "\\s+"
         ):
+            if self.condition is not None and not self.condition({self.column: word}):
+                continue
             to_yield = row.copy()
             to_yield[self.column] = word
             yield to_yield
 
 
-class Product(Mapper):
+class Product(RowMapper):
     """Calculates product of multiple columns"""
 
+    vectorized = True
+
     def __init__(
         self, columns: tp.Sequence[str], result_column: str = "product"
     ) -> None:
@@ -94,43 +150,138 @@ class Product(Mapper):
         self.columns = columns
         self.result_column = result_column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return self.columns
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.result_column,)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.result_column] = math.prod(
             row[column] for column in self.columns
         )
-        yield row
+        return row
+
+    def map_columns(self, batch: TBatch, size: int) -> TBatch:
+        result = dict(batch)
+        if not self.columns:
+            result[self.result_column] = [1] * size
+            return result
+        result[self.result_column] = vectorize(
+            lambda *arrays: functools.reduce(np.multiply, arrays),
+            [as_array(batch[column]) for column in self.columns],
+            lambda: [math.prod(values) for values in zip(*(batch[column] for column in self.columns))],
+            # every partial product is bounded by the product of all integer factors
+            lambda bounds: math.prod(max(bound, 1) for bound in bounds if bound is not None)
+        )
+        return result
 
 
-class Filter(Mapper):
-    """Remove records that don't satisfy some condition"""
+class Filter(FilterMapper):
+    """
+    Remove records that don't satisfy some condition.
+    Vectorized filter calls condition for a batch as well: with mapping
+    of columns to numpy arrays, and gets boolean array, e.g.
+    `lambda row: row['speed'] > 0` works both ways
+    """
 
-    def __init__(self, condition: tp.Callable[[TRow], bool]) -> None:
+    def __init__(
+        self,
+        condition: tp.Callable[[TRow], bool],
+        columns: tp.Sequence[str] | None = None,
+        vectorized: bool = False
+    ) -> None:
         """
         :param condition: if condition is not true - remove record
+        :param columns: columns read by condition, None if unknown
+        :param vectorized: whether condition can be called for columns of a batch
         """
+        if vectorized and columns is None:
+            raise ValueError('vectorized filter must declare columns it reads')
         self.condition = condition
+        self.columns = columns
+        self.vectorized = vectorized
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        if self.condition(row):
-            yield row
+    @property
+    def read_columns(self) -> tp.Collection[str] | None:
+        return self.columns
 
+    def keep(self, row: TRow) -> bool:
+        return self.condition(row)
 
-class Project(Mapper):
+    def keep_columns(self, batch: TBatch, size: int) -> tp.Any:
+        assert self.columns is not None
+        mask = self.condition({column: as_array(batch[column]) for column in self.columns})
+        return np.broadcast_to(np.asarray(mask, dtype=bool), (size,))
+
+
+class Project(RowMapper):
     """Leave only mentioned columns"""
 
+    vectorized = True
+
     def __init__(self, columns: tp.Sequence[str]) -> None:
         """
         :param columns: names of columns
         """
         self.columns = columns
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        yield {column: row[column] for column in self.columns}
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return self.columns
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        # every projected column is read, even if it is not needed downstream
+        return set(self.columns)
+
+    def output_order(self, order: TOrder) -> TOrder:
+        return order_prefix(order, self.columns)
+
+    def map_row(self, row: TRow) -> TRow:
+        return {column: row[column] for column in self.columns}
+
+    def map_columns(self, batch: TBatch, size: int) -> TBatch:
+        return {column: batch[column] for column in self.columns}
+
+
+class KeepColumns(RowMapper):
+    """
+    Leave only mentioned columns, keeping their order in the row.
+    Unlike Project, columns missing in the row are skipped
+    """
+
+    vectorized = True
+
+    def __init__(self, columns: tp.Collection[str]) -> None:
+        """
+        :param columns: names of columns
+        """
+        self.columns = frozenset(columns)
 
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return self.columns
 
-class LogarithmMap(Mapper):
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return set(self.columns) if columns is None else set(self.columns) & columns
+
+    def output_order(self, order: TOrder) -> TOrder:
+        return order_prefix(order, self.columns)
+
+    def map_row(self, row: TRow) -> TRow:
+        return {column: value for column, value in row.items() if column in self.columns}
+
+    def map_columns(self, batch: TBatch, size: int) -> TBatch:
+        return {column: values for column, values in batch.items() if column in self.columns}
+
+
+class LogarithmMap(RowMapper):
     """Replace columns by its logarithm"""
 
+    vectorized = True
+
     def __init__(self, column: str, base: float | None = None) -> None:
         """
         :param columns: columns with logarithm argument
@@ -138,14 +289,34 @@ class LogarithmMap(Mapper):
         self.column = column
         self._args = [] if base is None else [base]
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.column] = math.log(row[self.column], *self._args)
-        yield row
+        return row
+
+    def map_columns(self, batch: TBatch, size: int) -> TBatch:
+        result = dict(batch)
+        result[self.column] = vectorize(
+            lambda array: np.log(array) / math.log(*self._args) if self._args else np.log(array),
+            [as_array(batch[self.column])],
+            lambda: [math.log(value, *self._args) for value in batch[self.column]],
+            lambda bounds: 0
+        )
+        return result
 
 
-class Rename(Mapper):
+class Rename(RowMapper):
     """Rename column"""
 
+    vectorized = True
+
     def __init__(self, column_from: str, column_to: str) -> None:
         """
         :param column_from: column to rename
@@ -154,13 +325,27 @@ class Rename(Mapper):
         self.column_from = column_from
         self.column_to = column_to
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return (self.column_from,)
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.column_from, self.column_to)
+
+    def map_row(self, row: TRow) -> TRow:
         row[self.column_to] = row[self.column_from]
         row.pop(self.column_from)
-        yield row
+        return row
 
+    def map_columns(self, batch: TBatch, size: int) -> TBatch:
+        result = dict(batch)
+        result[self.column_to] = batch[self.column_from]
+        result.pop(self.column_from)
+        return result
 
-class Haversine(Mapper):
+
+class Haversine(RowMapper):
     """Calculate haversine distance"""
 
     EARTH_RADIUS = 6373
@@ -170,13 +355,21 @@ class Haversine(Mapper):
         self.end_column = end_column
         self.result_columns = result_columns
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return (self.start_columns, self.end_column)
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.result_columns,)
+
+    def map_row(self, row: TRow) -> TRow:
         to_yield = row.copy()
         to_yield[self.result_columns] = self.haversine_distance(
             *row[self.start_columns],
             *row[self.end_column]
         )
-        yield to_yield
+        return to_yield
 
     @staticmethod
     def haversine_distance(
@@ -206,7 +399,7 @@ class Haversine(Mapper):
         return 2 * Haversine.EARTH_RADIUS * math.asin(math.sqrt(x))
 
 
-class ToDatetime(Mapper):
+class ToDatetime(RowMapper):
     """Convert column to datetime"""
 
     def __init__(
@@ -233,7 +426,15 @@ class ToDatetime(Mapper):
             if date_column is not None:
                 self.kwargs[date_column] = symbol
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return (self.column,)
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return tuple(self.kwargs)
+
+    def map_row(self, row: TRow) -> TRow:
         date = datetime.datetime.fromisoformat(row[self.column] + '+00:00').astimezone(self.timezone)
         to_yield = row.copy()
         for date_column, symbol in self.kwargs.items():
@@ -241,10 +442,10 @@ class ToDatetime(Mapper):
             if symbol != 'a':
                 x = int(x)
             to_yield[date_column] = x
-        yield to_yield
+        return to_yield
 
 
-class TimestampDiff(Mapper):
+class TimestampDiff(RowMapper):
     """Convert column to datetime"""
 
     def __init__(
@@ -257,54 +458,205 @@ class TimestampDiff(Mapper):
         self.left_timestamp_column = left_timestamp_column
         self.right_timestamp_column = right_timestamp_column
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return (self.left_timestamp_column, self.right_timestamp_column)
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.result_column,)
+
+    def map_row(self, row: TRow) -> TRow:
         to_yield = row.copy()
         to_yield[self.result_column] = (
             datetime.datetime.fromisoformat(row[self.left_timestamp_column]) -
             datetime.datetime.fromisoformat(row[self.right_timestamp_column])
         ).total_seconds()
-        yield to_yield
+        return to_yield
 
 
-class MathMapper(Mapper):
-    """Evaluates simple math opeartions over columns"""
+class MathMapper(RowMapper):
+    """
+    Evaluates simple math opeartions over columns.
+    Equation is parsed once and compiled into a function
+    which reads columns straight from the row.
+    For a batch the same function is applied to numpy arrays,
+    unless integer results may overflow 64 bits
+    """
 
-    operators: dict[type, tp.Any] = {
-        ast.Add: operator.add,
-        ast.Sub: operator.sub,
-        ast.Mult: operator.mul,
-        ast.Div: operator.truediv,
-        ast.Pow: operator.pow,
-        ast.BitXor: operator.xor,
-        ast.USub: operator.neg
-    }
+    vectorized = True
+
+    operators: tuple[type, ...] = (
+        ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.BitXor, ast.USub, ast.UAdd
+    )
 
     @staticmethod
-    def math_eval(node: ast.expr) -> int | float | complex:
-        if isinstance(node, ast.Num):  # <number>
-            return node.n
-        elif isinstance(node, ast.BinOp):  # <left> <operator> <right>
-            return MathMapper.operators[type(node.op)](
-                MathMapper.math_eval(node.left), MathMapper.math_eval(node.right)
-            )
-        elif isinstance(node, ast.UnaryOp):  # <operator> <operand> e.g., -1
-            return MathMapper.operators[type(node.op)](MathMapper.math_eval(node.operand))
+    def _validate(node: ast.AST, columns: list[str]) -> None:
+        """Check that equation uses only numbers, columns and allowed operators,
+        collect column names in order of appearance"""
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float, complex)) \
+                and not isinstance(node.value, bool):  # <number>
+            return
+        elif isinstance(node, ast.Name):  # <column>
+            if node.id not in columns:
+                columns.append(node.id)
+        elif isinstance(node, ast.BinOp) and isinstance(node.op, MathMapper.operators):  # <left> <operator> <right>
+            MathMapper._validate(node.left, columns)
+            MathMapper._validate(node.right, columns)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, MathMapper.operators):  # e.g., -1
+            MathMapper._validate(node.operand, columns)
         else:
             raise TypeError(node)
 
     @staticmethod
-    def replace_names(equation: str, row: TRow) -> str:
-        for column in re.findall('[a-zA-Z_]+', equation):
-            equation = re.sub(column, '{}', equation, count=1).format(row[column])
-        return equation
+    def _compile(body: ast.expr, args: list[str], source: str) -> tp.Callable[..., tp.Any]:
+        lambda_node = ast.Lambda(
+            args=ast.arguments(
+                posonlyargs=[], args=[ast.arg(arg=arg) for arg in args],
+                kwonlyargs=[], kw_defaults=[], defaults=[]
+            ),
+            body=body
+        )
+        code = compile(ast.fix_missing_locations(ast.Expression(lambda_node)), source, 'eval')
+        function: tp.Callable[..., tp.Any] = eval(code, {'__builtins__': {}})
+        return function
+
+    @staticmethod
+    def _int_bound(node: ast.expr, bounds: tp.Mapping[str, int | None], found: list[int | float]) -> int | float | None:
+        """Maximum absolute value of integer result of node given the one of every integer column,
+        None if result is not integer; bounds of all integer results of subexpressions are collected into found"""
+        bound: int | float | None
+        if isinstance(node, ast.Constant):
+            bound = abs(node.value) if isinstance(node.value, int) else None
+        elif isinstance(node, ast.Name):
+            bound = bounds[node.id]
+        elif isinstance(node, ast.UnaryOp):
+            bound = MathMapper._int_bound(node.operand, bounds, found)
+        else:
+            assert isinstance(node, ast.BinOp)
+            left = MathMapper._int_bound(node.left, bounds, found)
+            right = MathMapper._int_bound(node.right, bounds, found)
+            if left is None or right is None or isinstance(node.op, ast.Div):
+                bound = None
+            elif max(left, right) > np.iinfo(np.int64).max:
+                bound = math.inf
+            elif isinstance(node.op, (ast.Add, ast.Sub)):
+                bound = left + right
+            elif isinstance(node.op, ast.Mult):
+                bound = left * right
+            elif isinstance(node.op, ast.Pow):
+                bound = math.inf if left > 1 and right > 64 else max(left, 1) ** right
+            else:  # ast.BitXor
+                bound = 1 << int(max(left, right)).bit_length()
+        if bound is not None:
+            found.append(bound)
+        return bound
+
+    def _build(self) -> None:
+        tree = ast.parse(self.equation, mode='eval')
+        self._tree = tree.body
+        self.columns: list[str] = []
+        self._validate(tree.body, self.columns)
+        local_names = {column: f'_column_{i}' for i, column in enumerate(self.columns)}
+
+        class _RowLookup(ast.NodeTransformer):
+            def visit_Name(self, node: ast.Name) -> ast.expr:
+                return ast.Subscript(
+                    value=ast.Name(id='_row', ctx=ast.Load()), slice=ast.Constant(node.id), ctx=ast.Load()
+                )
+
+        class _LocalLookup(ast.NodeTransformer):
+            def visit_Name(self, node: ast.Name) -> ast.expr:
+                return ast.Name(id=local_names[node.id], ctx=ast.Load())
+
+        # row -> value
+        self._evaluate = self._compile(
+            _RowLookup().visit(ast.parse(self.equation, mode='eval')).body, ['_row'], self.equation
+        )
+        # column values -> list of values, one comprehension for the whole batch
+        batch_body = ast.ListComp(
+            elt=_LocalLookup().visit(ast.parse(self.equation, mode='eval')).body,
+            generators=[ast.comprehension(
+                target=ast.Tuple(elts=[ast.Name(id=name, ctx=ast.Store()) for name in local_names.values()],
+                                 ctx=ast.Store()),
+                iter=ast.Call(
+                    func=ast.Name(id='_zip', ctx=ast.Load()),
+                    args=[ast.Name(id=name, ctx=ast.Load()) for name in local_names.values()],
+                    keywords=[]
+                ),
+                ifs=[], is_async=0
+            )]
+        )
+        self._evaluate_batch = self._compile(
+            batch_body, ['_zip', *local_names.values()], self.equation
+        )
 
     def __init__(self, result_column: str, equation: str) -> None:
+        """
+        :param result_column: column to save result in
+        :param equation: arithmetic expression over column names, e.g. 'tf / idf'
+        """
         self.result_column = result_column
         self.equation = equation
+        self._build()
 
-    def __call__(self, row: TRow) -> TRowsGenerator:
-        equation = self.replace_names(self.equation, row)
-        value = self.math_eval(ast.parse(equation, mode='eval').body)
+    def __getstate__(self) -> dict[str, tp.Any]:
+        # compiled functions are not picklable, they are rebuilt on load
+        return {'result_column': self.result_column, 'equation': self.equation}
+
+    def __setstate__(self, state: dict[str, tp.Any]) -> None:
+        self.__dict__.update(state)
+        self._build()
+
+    def evaluate(self, row: TRow) -> tp.Any:
+        return self._evaluate(row)
+
+    def evaluate_batch(self, columns: tp.Mapping[str, tp.Sequence[tp.Any]], size: int) -> list[tp.Any]:
+        """
+        Evaluate equation for a batch of rows given by columns
+        :param columns: values of every used column
+        :param size: number of rows in batch
+        """
+        if not self.columns:
+            return [self._evaluate({})] * size
+        return self._evaluate_batch(zip, *(columns[column] for column in self.columns))
+
+    def map_batch(self, rows: tp.Sequence[TRow]) -> list[TRow]:
+        """Same as calling mapper for every row, but for a whole chunk at once"""
+        columns = {column: [row[column] for row in rows] for column in self.columns}
+        values = self.evaluate_batch(columns, len(rows))
+        result = [row.copy() for row in rows]
+        for to_yield, value in zip(result, values):
+            to_yield[self.result_column] = value
+        return result
+
+    @property
+    def read_columns(self) -> tp.Collection[str]:
+        return self.columns
+
+    @property
+    def written_columns(self) -> tp.Collection[str]:
+        return (self.result_column,)
+
+    def map_row(self, row: TRow) -> TRow:
         to_yield = row.copy()
-        to_yield[self.result_column] = value
-        yield to_yield
+        to_yield[self.result_column] = self._evaluate(row)
+        return to_yield
+
+    def map_columns(self, batch: TBatch, size: int) -> TBatch:
+        result = dict(batch)
+        if not self.columns:
+            result[self.result_column] = self.evaluate_batch(batch, size)
+            return result
+        result[self.result_column] = vectorize(
+            lambda *arrays: self._evaluate(dict(zip(self.columns, arrays))),
+            [as_array(batch[column]) for column in self.columns],
+            lambda: self.evaluate_batch(batch, size),
+            self._result_bound
+        )
+        return result
+
+    def _result_bound(self, bounds: list[int | None]) -> int | float:
+        found: list[int | float] = []
+        self._int_bound(self._tree, dict(zip(self.columns, bounds)), found)
+        return max(found, default=0)
@@ -1,4 +1,5 @@
 from abc import abstractmethod, ABC
+import itertools
 import typing as tp
 
 from .utils import sorted_groupby
@@ -7,12 +8,72 @@ TRow = dict[str, tp.Any]
 TRowsIterable = tp.Iterable[TRow]
 TRowsGenerator = tp.Generator[TRow, None, None]
 TRowGroup = tuple[tuple[str, ...], TRowsIterable]
+# known order of table rows: (column, descending) pairs, most significant first
+TOrder = tuple[tuple[str, bool], ...]
+# set of needed columns, None if all columns are needed
+TColumns = set[str] | None
+# sort key: column name (ascending) or pair of column name and 'asc' / 'desc'
+TSortKey = str | tuple[str, str]
+# batch of rows stored by columns: lists or numpy arrays of equal length
+TBatch = dict[str, tp.Any]
+
+SORT_DIRECTIONS = {'asc': False, 'desc': True}
+
+# right group rows which joiner keeps in memory before spilling to disk
+DEFAULT_JOIN_GROUP_ROWS_IN_MEMORY = 10000
+
+# column holding aggregator state in rows produced by map-side combiner
+PARTIAL_STATE_COLUMN = '__state__'
 
 
 def _get_subdict_values(row: TRow, keys: tp.Sequence[str]) -> tuple[tp.Any, ...]:
     return tuple(row[k] for k in keys)
 
 
+def make_order(keys: tp.Sequence[TSortKey], reverse: bool = False) -> TOrder:
+    """
+    :param keys: sorting keys, with optional direction per key
+    :param reverse: invert direction of all keys
+    :return: order of rows sorted by keys
+    """
+    order: list[tuple[str, bool]] = []
+    for key in keys:
+        if isinstance(key, str):
+            order.append((key, reverse))
+            continue
+        column, direction = key
+        if direction not in SORT_DIRECTIONS:
+            raise ValueError(f'Unknown sort direction {direction!r} of {column!r}, expected asc or desc')
+        order.append((column, SORT_DIRECTIONS[direction] != reverse))
+    return tuple(order)
+
+
+def order_prefix(order: TOrder, columns: tp.Container[str]) -> TOrder:
+    """
+    :param order: known order of rows
+    :param columns: columns which are still valid
+    :return: longest prefix of order which uses only valid columns
+    """
+    for i, (column, _) in enumerate(order):
+        if column not in columns:
+            return order[:i]
+    return order
+
+
+def implies_order(order: TOrder, required: TOrder) -> bool:
+    """Whether rows with known order are also sorted in required order"""
+    return len(required) > 0 and order[:len(required)] == required
+
+
+def is_ordered(row_a: TRow, row_b: TRow, order: TOrder) -> bool:
+    """Whether row_a may precede row_b in given order"""
+    for column, descending in order:
+        value_a, value_b = row_a[column], row_b[column]
+        if value_a != value_b:
+            return bool(value_a > value_b) if descending else bool(value_a < value_b)
+    return True
+
+
 class Operation(ABC):
     @abstractmethod
     def __call__(
@@ -20,17 +81,41 @@ class Operation(ABC):
     ) -> TRowsGenerator:
         pass
 
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        """
+        :param input_orders: known orders of input tables
+        :return: known order of output rows, empty if unknown
+        """
+        return ()
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        """
+        :param columns: output columns needed downstream
+        :return: columns of every input table needed to produce them
+        """
+        return None
+
 
 class Read(Operation):
+    def __init__(self, sorted_by: TOrder = ()) -> None:
+        """
+        :param sorted_by: order of rows declared by the source
+        """
+        self.sorted_by = sorted_by
+
     @abstractmethod
     def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
         pass
 
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        return self.sorted_by
+
 
 class ReadIterFile(Read):
     def __init__(
-        self, filename: str, parser: tp.Callable[[str], TRow]
+        self, filename: str, parser: tp.Callable[[str], TRow], sorted_by: TOrder = ()
     ) -> None:
+        super().__init__(sorted_by)
         self.filename = filename
         self.parser = parser
 
@@ -41,7 +126,8 @@ class ReadIterFile(Read):
 
 
 class ReadIterFactory(Read):
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, sorted_by: TOrder = ()) -> None:
+        super().__init__(sorted_by)
         self.name = name
 
     def __call__(self, *args: tp.Any, **kwargs: tp.Any) -> TRowsGenerator:
@@ -52,25 +138,156 @@ class ReadIterFactory(Read):
 # Map
 
 class Mapper(ABC):
-    """Base class for mappers"""
+    """
+    Base class for mappers.
+    Vectorized mappers also process batches of rows stored by columns,
+    see `columnar.BatchMap`
+    """
+
+    vectorized: bool = False
+
+    @abstractmethod
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        """
+        :param row: one table row
+        """
+        pass
+
+    @property
+    def written_columns(self) -> tp.Collection[str] | None:
+        """Columns which mapper may change, None if any column may change"""
+        return None
+
+    @property
+    def read_columns(self) -> tp.Collection[str] | None:
+        """Columns which mapper reads, None if any column may be read"""
+        return None
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        """
+        :param columns: output columns needed downstream
+        :return: input columns needed to produce them
+        """
+        if columns is None or self.written_columns is None or self.read_columns is None:
+            return None
+        return (columns - set(self.written_columns)) | set(self.read_columns)
+
+    def output_order(self, order: TOrder) -> TOrder:
+        """
+        :param order: known order of input rows
+        :return: part of the order kept by mapper
+        """
+        if self.written_columns is None:
+            return ()
+        written_columns = self.written_columns
+        return tuple(itertools.takewhile(lambda item: item[0] not in written_columns, order))
+
+
+class RowMapper(Mapper):
+    """Base class for mappers which yield exactly one row for every row"""
 
     @abstractmethod
+    def map_row(self, row: TRow) -> TRow:
+        """
+        :param row: one table row
+        :return: resulting row
+        """
+        pass
+
+    def map_columns(self, batch: TBatch, size: int) -> TBatch:
+        """
+        Same as `map_row` for every row of batch, required for vectorized mappers
+        :param batch: columns of rows
+        :param size: number of rows in batch
+        :return: columns of resulting rows
+        """
+        raise NotImplementedError(f'{type(self).__name__} is not vectorized')
+
     def __call__(self, row: TRow) -> TRowsGenerator:
+        yield self.map_row(row)
+
+
+class FilterMapper(Mapper):
+    """Base class for mappers which yield either the row itself or nothing"""
+
+    @property
+    def written_columns(self) -> tp.Collection[str] | None:
+        return ()
+
+    @abstractmethod
+    def keep(self, row: TRow) -> bool:
         """
         :param row: one table row
+        :return: whether row passes filter
         """
         pass
 
+    def keep_columns(self, batch: TBatch, size: int) -> tp.Any:
+        """
+        Same as `keep` for every row of batch, required for vectorized filters
+        :param batch: columns of rows
+        :param size: number of rows in batch
+        :return: boolean numpy mask of rows which pass filter
+        """
+        raise NotImplementedError(f'{type(self).__name__} is not vectorized')
+
+    def __call__(self, row: TRow) -> TRowsGenerator:
+        if self.keep(row):
+            yield row
+
 
 class Map(Operation):
-    def __init__(self, mapper: Mapper) -> None:
-        self.mapper = mapper
+    """
+    Apply chain of mappers to every row in one pass.
+    Row mappers and filters are applied in a plain loop,
+    generator is created only for other mappers (e.g. Split)
+    """
+
+    def __init__(self, *mappers: Mapper) -> None:
+        self.mappers = mappers
+        # chain is cut into segments: one-row stages followed by generic mapper (or None)
+        self._segments: list[tuple[list[tuple[bool, tp.Callable[[TRow], tp.Any]]], Mapper | None]] = []
+        stages: list[tuple[bool, tp.Callable[[TRow], tp.Any]]] = []
+        for mapper in mappers:
+            if isinstance(mapper, RowMapper):
+                stages.append((False, mapper.map_row))
+            elif isinstance(mapper, FilterMapper):
+                stages.append((True, mapper.keep))
+            else:
+                self._segments.append((stages, mapper))
+                stages = []
+        self._segments.append((stages, None))
+
+    def _process(self, rows: TRowsIterable, index: int) -> TRowsGenerator:
+        stages, mapper = self._segments[index]
+        for row in rows:
+            for is_filter, function in stages:
+                if is_filter:
+                    if not function(row):
+                        break
+                else:
+                    row = function(row)
+            else:
+                if mapper is None:
+                    yield row
+                else:
+                    yield from self._process(mapper(row), index + 1)
 
     def __call__(
         self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
     ) -> TRowsGenerator:
-        for row in rows:
-            yield from self.mapper(row)
+        yield from self._process(rows, 0)
+
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        order = input_orders[0]
+        for mapper in self.mappers:
+            order = mapper.output_order(order)
+        return order
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        for mapper in reversed(self.mappers):
+            columns = mapper.input_columns(columns)
+        return columns
 
 # Reduce
 
@@ -87,6 +304,109 @@ class Reducer(ABC):
         """
         pass
 
+    def input_columns(self, group_key: tuple[str, ...], columns: TColumns) -> TColumns:
+        """
+        :param group_key: names of key columns
+        :param columns: output columns needed downstream
+        :return: input columns needed to produce them
+        """
+        return None
+
+    def output_columns(self, group_key: tuple[str, ...]) -> TColumns:
+        """
+        :param group_key: names of key columns
+        :return: all columns of output rows, None if unknown
+        """
+        return None
+
+
+class Aggregator(Reducer):
+    """
+    Base class for reducers which fold rows of a group
+    one by one into a state. Such reducers do not need
+    whole group at once, so they can work on unsorted input.
+    The same aggregator runs on sorted groups (`Reduce`), in a hash table
+    (`HashReduce`) and on partial states of parts of a group (`PartialMerge`),
+    the latter needs `merge`.
+    Combinable aggregators have small states which can be merged,
+    so rows may be pre-aggregated before sort.
+    Result of commutative aggregators does not depend on order of rows,
+    so rows of a group may be split between partial states arbitrarily.
+    Vectorized aggregators fold batches of rows stored by columns
+    with numpy, see `columnar.BatchReduce`
+    """
+
+    combinable: bool = False
+    commutative: bool = False
+    vectorized: bool = False
+
+    @abstractmethod
+    def init(self) -> tp.Any:
+        """
+        :return: state of an empty group
+        """
+        pass
+
+    @abstractmethod
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        """
+        :param state: current state of the group
+        :param row: next row of the group
+        :return: new state of the group
+        """
+        pass
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        """
+        Required for combinable aggregators
+        :param state_a: state of one part of the group
+        :param state_b: state of another part of the group
+        :return: state of the whole group
+        """
+        raise NotImplementedError(f'{type(self).__name__} states can not be merged')
+
+    def aggregate_columns(self, batch: TBatch, starts: tp.Sequence[int], size: int) -> list[tp.Any]:
+        """
+        Fold every group of a batch sorted by keys into a state.
+        Rows are folded one by one here, vectorized aggregators do it with numpy
+        :param batch: columns of rows
+        :param starts: index of first row of every group
+        :param size: number of rows in batch
+        :return: state of every group
+        """
+        rows = [dict(zip(batch, values)) for values in zip(*batch.values())] if batch else [{}] * size
+        bounds = [*starts, size]
+        states = []
+        for start, stop in zip(bounds, bounds[1:]):
+            state = self.init()
+            for row in rows[start:stop]:
+                state = self.update(state, row)
+            states.append(state)
+        return states
+
+    @abstractmethod
+    def finalize(
+        self, group_key: tuple[str, ...], key_values: tuple[tp.Any, ...], state: tp.Any
+    ) -> TRowsGenerator:
+        """
+        :param group_key: names of key columns
+        :param key_values: values of key columns
+        :param state: final state of the group
+        """
+        pass
+
+    def __call__(
+        self, group_key: tuple[str, ...], rows: TRowsIterable
+    ) -> TRowsGenerator:
+        state = self.init()
+        key_values = None
+        for row in rows:
+            if key_values is None:
+                key_values = _get_subdict_values(row, group_key)
+            state = self.update(state, row)
+        if key_values is not None:
+            yield from self.finalize(group_key, key_values, state)
+
 
 class Reduce(Operation):
     def __init__(self, reducer: Reducer, keys: tp.Sequence[str]) -> None:
@@ -96,20 +416,38 @@ class Reduce(Operation):
     def __call__(
         self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
     ) -> TRowsGenerator:
+        # rows may be sorted by keys in any direction, see Sort
         for _, group in sorted_groupby(
-            rows, key=lambda row: _get_subdict_values(row, self.keys)
+            rows, key=lambda row: _get_subdict_values(row, self.keys), any_direction=True
         ):
             yield from self.reducer(tuple(self.keys), group)
 
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        # groups are emitted in input order
+        return order_prefix(input_orders[0], self.keys)
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.reducer.input_columns(tuple(self.keys), columns)
+
 # Join
 
 
 class Joiner(ABC):
     """Base class for joiners"""
 
-    def __init__(self, suffix_a: str = "_1", suffix_b: str = "_2") -> None:
+    def __init__(
+        self, suffix_a: str = "_1", suffix_b: str = "_2",
+        max_rows_in_memory: int = DEFAULT_JOIN_GROUP_ROWS_IN_MEMORY
+    ) -> None:
+        """
+        :param suffix_a: suffix for left columns present in both tables
+        :param suffix_b: suffix for right columns present in both tables
+        :param max_rows_in_memory: right group rows kept in memory,
+            rows of larger groups are spilled to disk
+        """
         self._a_suffix = suffix_a
         self._b_suffix = suffix_b
+        self.max_rows_in_memory = max_rows_in_memory
 
     def _merge_rows_with_suffixes(
         self, keys: tp.Sequence[str], row_a: TRow, row_b: TRow
@@ -125,6 +463,24 @@ class Joiner(ABC):
                     to_yield[field + suffix] = value
         return to_yield
 
+    def input_columns(self, keys: tp.Sequence[str], columns: TColumns) -> TColumns:
+        """
+        Columns of both tables needed to produce given output columns.
+        Column is kept in both tables if it is needed with any suffix,
+        so that suffixes of the other table do not change
+        :param keys: join keys
+        :param columns: output columns needed downstream
+        """
+        if columns is None:
+            return None
+        needed = set(keys)
+        for column in columns:
+            needed.add(column)
+            for suffix in (self._a_suffix, self._b_suffix):
+                if suffix and column.endswith(suffix):
+                    needed.add(column[:-len(suffix)])
+        return needed
+
     @abstractmethod
     def __call__(
         self,
@@ -150,6 +506,13 @@ class Join(Operation):
             rows, key=lambda row: _get_subdict_values(row, self.keys)
         )
 
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        # merge join requires inputs sorted by keys, groups are emitted in that order
+        return make_order(self.keys)
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.joiner.input_columns(self.keys, columns)
+
     @staticmethod
     def next_or_none(iter: tp.Iterator[TRowGroup]) -> TRowGroup | tuple[None, None]:
         return next(iter, (None, None))
@@ -0,0 +1,584 @@
+import concurrent.futures
+import contextlib
+import heapq
+import itertools
+import multiprocessing
+import queue
+import typing as tp
+from collections import Counter, deque
+from multiprocessing import connection
+from operator import itemgetter
+
+from compgraph.operations.external_sort import (
+    DEFAULT_CHUNK_BYTES, DEFAULT_MAX_BYTES_IN_MEMORY, DEFAULT_SAMPLE_SIZE, RowsSender, SortedRuns, recv_chunks
+)
+from compgraph.operations.hash_operations import HashReduce, _drain
+from compgraph.operations.joiners import OuterJoiner, RightJoiner
+from compgraph.operations.operations_base import (
+    Aggregator, Join, Joiner, Map, Mapper, Operation, Reduce, Reducer, TColumns, TOrder, TRow, TRowsIterable,
+    TRowsGenerator, PARTIAL_STATE_COLUMN, _get_subdict_values, make_order
+)
+from compgraph.operations.reducers import PartialMerge
+from compgraph.operations.utils import SpillQueue
+from compgraph.operations.workers import Task, worker_session
+
+DEFAULT_CHUNK_ROWS = 1024
+# chunks in flight per worker: one is processed while the next one waits, so worker does not idle
+DEFAULT_PREFETCH = 2
+
+# key is hot when it alone takes more than this part of the rows one worker should get
+HOT_KEY_LOAD = 0.5
+
+# forked workers inherit operations instead of unpickling them, so mappers may hold lambdas
+FORK_CONTEXT = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+
+def chunked(rows: TRowsIterable, chunk_rows: int) -> tp.Iterator[list[TRow]]:
+    """
+    :param rows: rows to split
+    :param chunk_rows: number of rows in every chunk but the last one
+    """
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, chunk_rows)):
+        yield chunk
+
+
+_worker_operation: Map | None = None
+
+
+def _init_map_worker(operation: Map) -> None:
+    global _worker_operation
+    _worker_operation = operation
+
+
+def _map_chunk(chunk: list[TRow]) -> list[TRow]:
+    assert _worker_operation is not None
+    return list(_worker_operation(chunk))
+
+
+def _produce(rows: TRowsIterable, chunks: tp.Any, chunk_rows: int) -> None:
+    try:
+        for chunk in chunked(rows, chunk_rows):
+            chunks.put(chunk)
+    except Exception as error:
+        chunks.put(error)
+    else:
+        chunks.put(None)
+
+
+class Prefetch(Operation):
+    """
+    Compute input rows in a forked process while they are consumed.
+    Producer process is started right when operation is called, before
+    the first row is requested, and input iterator is not started yet,
+    so the whole upstream branch runs in that process.
+    Rows come back in chunks through a queue of `prefetch` chunks,
+    so producer stops when consumer lags behind.
+    Upstream must not share nodes with the rest of graph run by `run_shared`,
+    or their rows would be computed twice
+    """
+
+    POLL_INTERVAL = 1.
+
+    def __init__(self, chunk_rows: int = DEFAULT_CHUNK_ROWS, prefetch: int = DEFAULT_PREFETCH) -> None:
+        """
+        :param chunk_rows: number of rows sent at once
+        :param prefetch: number of chunks computed ahead of consumer
+        """
+        self.chunk_rows = chunk_rows
+        self.prefetch = prefetch
+
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        return input_orders[0]
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return columns
+
+    def _get(self, chunks: tp.Any, process: tp.Any) -> tp.Any:
+        while True:
+            try:
+                return chunks.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f'Prefetch process exited with code {process.exitcode}')
+
+    def _consume(self, rows: TRowsIterable) -> tp.Generator[tp.Any, None, None]:
+        """Yield None once the producer is started, then rows"""
+        if FORK_CONTEXT is None:
+            yield None
+            yield from rows
+            return
+        chunks = FORK_CONTEXT.Queue(self.prefetch)
+        # not a daemon, so upstream may start worker processes of its own
+        process = FORK_CONTEXT.Process(target=_produce, args=(rows, chunks, self.chunk_rows))
+        process.start()
+        try:
+            yield None
+            while (chunk := self._get(chunks, process)) is not None:
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield from chunk
+            process.join()
+        finally:
+            # consumer may stop early, then producer is blocked on full queue
+            if process.is_alive():
+                process.terminate()
+                process.join()
+            chunks.close()
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        consumer = self._consume(rows)
+        # producer starts now, and closing the consumer stops it even if no row was read
+        next(consumer)
+        return consumer
+
+
+class ParallelMap(Operation):
+    """
+    Map which applies mappers in a pool of worker processes.
+    Rows are sent to workers in chunks, at most `prefetch` chunks
+    per worker are in flight, so memory stays bounded when
+    workers or consumer are slow. With `ordered` rows are yielded
+    in input order, otherwise every chunk is yielded as soon as it is ready
+    """
+
+    def __init__(
+        self,
+        *mappers: Mapper,
+        workers: int,
+        ordered: bool = True,
+        chunk_rows: int = DEFAULT_CHUNK_ROWS,
+        prefetch: int = DEFAULT_PREFETCH
+    ) -> None:
+        """
+        :param mappers: chain of mappers to apply
+        :param workers: number of worker processes
+        :param ordered: keep input order of rows
+        :param chunk_rows: number of rows sent to worker at once
+        :param prefetch: number of chunks in flight per worker
+        """
+        self.map = Map(*mappers)
+        self.workers = workers
+        self.ordered = ordered
+        self.chunk_rows = chunk_rows
+        self.prefetch = prefetch
+
+    @property
+    def mappers(self) -> tuple[Mapper, ...]:
+        return self.map.mappers
+
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        return self.map.output_order(input_orders) if self.ordered else ()
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.map.input_columns(columns)
+
+    def _ordered(self, executor: concurrent.futures.Executor, rows: TRowsIterable) -> TRowsGenerator:
+        pending: deque[concurrent.futures.Future[list[TRow]]] = deque()
+        for chunk in chunked(rows, self.chunk_rows):
+            if len(pending) >= self.workers * self.prefetch:
+                yield from pending.popleft().result()
+            pending.append(executor.submit(_map_chunk, chunk))
+        while pending:
+            yield from pending.popleft().result()
+
+    def _unordered(self, executor: concurrent.futures.Executor, rows: TRowsIterable) -> TRowsGenerator:
+        pending: set[concurrent.futures.Future[list[TRow]]] = set()
+        for chunk in chunked(rows, self.chunk_rows):
+            if len(pending) >= self.workers * self.prefetch:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+            pending.add(executor.submit(_map_chunk, chunk))
+        for future in concurrent.futures.as_completed(pending):
+            yield from future.result()
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=FORK_CONTEXT, initializer=_init_map_worker, initargs=(self.map,)
+        )
+        try:
+            yield from (self._ordered if self.ordered else self._unordered)(executor, rows)
+        finally:
+            # consumer may stop early, chunks which are not started yet are dropped
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def recv_rows(endpoint: connection.Connection) -> TRowsGenerator:
+    """
+    Receive rows sent by RowsSender until end of stream
+    :param endpoint: connection to receive from
+    """
+    for chunk, _ in recv_chunks(endpoint):
+        yield from chunk
+
+
+def recv_partitions(
+    endpoints: tp.Sequence[connection.Connection],
+    keys: tp.Sequence[str],
+    ordered: bool,
+    own_rows: tp.Sequence[TRow] = ()
+) -> TRowsGenerator:
+    """
+    Receive results of workers one after another,
+    or merge them by keys if every one is sorted by keys
+    :param endpoints: connections to workers
+    :param keys: keys results are sorted by
+    :param ordered: merge results by keys
+    :param own_rows: rows computed by the owner, sorted by keys if ordered
+    """
+    partitions: list[tp.Iterable[TRow]] = [recv_rows(endpoint) for endpoint in endpoints]
+    partitions.append(own_rows)
+    if ordered and keys:
+        yield from heapq.merge(*partitions, key=itemgetter(*keys))
+    else:
+        for partition in partitions:
+            yield from partition
+
+
+def find_hot_keys(sample: tp.Sequence[TRow], keys: tp.Sequence[str], workers: int) -> frozenset[tuple[tp.Any, ...]]:
+    """
+    Keys which take more than HOT_KEY_LOAD of the rows one worker should get,
+    e.g. frequent words: worker of such key would work longer than the others
+    :param sample: rows to count keys in
+    :param keys: partitioning keys
+    :param workers: number of workers
+    """
+    if workers <= 1:
+        return frozenset()
+    counts = Counter(_get_subdict_values(row, keys) for row in sample)
+    threshold = HOT_KEY_LOAD * len(sample) / workers
+    return frozenset(key_values for key_values, count in counts.items() if count > threshold)
+
+
+class ReduceTask(Task):
+    """
+    Reduce one partition in a worker: aggregators are run in a hash table,
+    other reducers on groups of the sorted partition.
+    With `ordered` result is sorted by keys.
+    Rows of hot keys, which are spread between all workers, are only
+    folded into partial states, those are sent before the result
+    """
+
+    def __init__(
+        self,
+        reducer: Reducer,
+        keys: tp.Sequence[str],
+        ordered: bool,
+        hot_keys: frozenset[tuple[tp.Any, ...]],
+        max_bytes_in_memory: int | None,
+        tmp_dir: str | None,
+        chunk_bytes: int
+    ) -> None:
+        self.reducer = reducer
+        self.keys = keys
+        self.ordered = ordered
+        self.hot_keys = hot_keys
+        self.max_bytes_in_memory = max_bytes_in_memory
+        self.tmp_dir = tmp_dir
+        self.chunk_bytes = chunk_bytes
+
+    def _sorted(self, rows: tp.Iterable[tuple[TRow, int]]) -> tp.Iterator[TRow]:
+        runs = SortedRuns(self.keys, max_bytes_in_memory=self.max_bytes_in_memory, tmp_dir=self.tmp_dir)
+        for row, size in rows:
+            runs.add(row, size)
+        return iter(runs)
+
+    def _split(
+        self, rows: tp.Iterable[tuple[TRow, int]], hot_states: dict[tuple[tp.Any, ...], tp.Any]
+    ) -> tp.Iterator[tuple[TRow, int]]:
+        """Fold rows of hot keys into hot_states, yield the others"""
+        for row, size in rows:
+            key_values = _get_subdict_values(row, self.keys)
+            if key_values not in self.hot_keys:
+                yield row, size
+                continue
+            assert isinstance(self.reducer, Aggregator)
+            state = hot_states[key_values] if key_values in hot_states else self.reducer.init()
+            hot_states[key_values] = self.reducer.update(state, row)
+
+    def _reduce(self, rows: tp.Iterable[tuple[TRow, int]]) -> tp.Iterator[TRow]:
+        if not isinstance(self.reducer, Aggregator):
+            return Reduce(self.reducer, self.keys)(self._sorted(rows))
+        # bytes and number of input rows
+        read = [0, 0]
+
+        def measured() -> TRowsGenerator:
+            for row, size in rows:
+                read[0] += size
+                read[1] += 1
+                yield row
+
+        result = HashReduce(self.reducer, self.keys, tmp_dir=self.tmp_dir)(measured())
+        if not self.ordered or not self.keys:
+            return result
+        # result is sorted instead of input, it is not larger for aggregators but may be as large
+        # (e.g. TermFrequency); size of its rows is unknown, so every one counts as an average input row
+        return self._sorted((row, read[0] // max(read[1], 1)) for row in result)
+
+    def run(self, endpoint: connection.Connection) -> None:
+        hot_states: dict[tuple[tp.Any, ...], tp.Any] = {}
+        rows = ((row, size // len(chunk)) for chunk, size in recv_chunks(endpoint) for row in chunk)
+        result = self._reduce(self._split(rows, hot_states))
+        # reduce reads its whole input before the first result, so hot states are complete after it
+        head = list(itertools.islice(result, 1))
+
+        sender = RowsSender(endpoint, self.chunk_bytes)
+        for key_values, state in hot_states.items():
+            partial: TRow = dict(zip(self.keys, key_values))
+            partial[PARTIAL_STATE_COLUMN] = state
+            sender.send(partial)
+        sender.close()
+
+        sender = RowsSender(endpoint, self.chunk_bytes)
+        for row in itertools.chain(head, result):
+            sender.send(row)
+        sender.close()
+
+
+class ParallelReduce(Operation):
+    """
+    Reduce which hash-partitions rows by keys between worker processes
+    of the shared pool, every worker reduces its own partition.
+    Input does not have to be sorted. Partitions are concatenated,
+    with `ordered` they are merged so that result is sorted by keys.
+    Reducer is sent to workers, so it must be picklable.
+    Commutative aggregators are salted: keys which are hot in a sample
+    of first rows are spread between all workers, which compute
+    partial states of them, and the states are merged at the end
+    """
+
+    def __init__(
+        self,
+        reducer: Reducer,
+        keys: tp.Sequence[str],
+        workers: int,
+        ordered: bool = False,
+        salt_hot_keys: bool = True,
+        sample_size: int = DEFAULT_SAMPLE_SIZE,
+        max_bytes_in_memory: int | None = DEFAULT_MAX_BYTES_IN_MEMORY,
+        tmp_dir: str | None = None,
+        chunk_bytes: int = DEFAULT_CHUNK_BYTES
+    ) -> None:
+        """
+        :param reducer: reducer to use
+        :param keys: keys for grouping
+        :param workers: number of worker processes
+        :param ordered: sort result by keys
+        :param salt_hot_keys: spread hot keys between workers, if reducer is a commutative aggregator
+        :param sample_size: number of first rows used to find hot keys
+        :param max_bytes_in_memory: memory budget of a worker sorting its partition
+        :param tmp_dir: directory for spilled rows, system default if None
+        :param chunk_bytes: approximate size of row chunks sent between processes
+        """
+        self.reducer = reducer
+        self.keys = keys
+        self.workers = workers
+        self.ordered = ordered
+        self.salt_hot_keys = salt_hot_keys
+        self.sample_size = sample_size
+        self.max_bytes_in_memory = max_bytes_in_memory
+        self.tmp_dir = tmp_dir
+        self.chunk_bytes = chunk_bytes
+
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        return make_order(self.keys) if self.ordered else ()
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.reducer.input_columns(tuple(self.keys), columns)
+
+    def _task(self, hot_keys: frozenset[tuple[tp.Any, ...]]) -> ReduceTask:
+        return ReduceTask(
+            self.reducer, self.keys, self.ordered, hot_keys, self.max_bytes_in_memory, self.tmp_dir, self.chunk_bytes
+        )
+
+    def _merge_hot(self, endpoints: list[connection.Connection]) -> list[TRow]:
+        """Receive partial states of hot keys from all workers and finalize them"""
+        partials = [row for endpoint in endpoints for row in recv_rows(endpoint)]
+        if not partials:
+            return []
+        assert isinstance(self.reducer, Aggregator)
+        result = list(HashReduce(PartialMerge(self.reducer), self.keys)(partials))
+        if self.ordered:
+            result.sort(key=itemgetter(*self.keys))
+        return result
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        # keyless reduce is a single group
+        workers = self.workers if self.keys else 1
+        rows = iter(rows)
+        salted = self.salt_hot_keys and isinstance(self.reducer, Aggregator) and self.reducer.commutative
+        sample = list(itertools.islice(rows, self.sample_size)) if salted else []
+        hot_keys = find_hot_keys(sample, self.keys, workers)
+        with contextlib.ExitStack() as stack:
+            endpoints = [stack.enter_context(worker_session(self._task(hot_keys))) for _ in range(workers)]
+            senders = [RowsSender(endpoint, self.chunk_bytes) for endpoint in endpoints]
+            # workers send nothing until their input ends, so sending can not deadlock
+            for i, row in enumerate(itertools.chain(sample, rows)):
+                key_values = _get_subdict_values(row, self.keys)
+                senders[i % workers if key_values in hot_keys else hash(key_values) % workers].send(row)
+            for sender in senders:
+                sender.close()
+            hot_result = self._merge_hot(endpoints)
+            yield from recv_partitions(endpoints, self.keys, self.ordered, hot_result)
+
+
+class JoinTask(Task):
+    """
+    Join one partition in a worker: right rows are received first, then left rows,
+    both are sorted by keys and merged with `Join`.
+    Result is sorted by keys
+    """
+
+    def __init__(
+        self,
+        joiner: Joiner,
+        keys: tp.Sequence[str],
+        max_bytes_in_memory: int | None,
+        tmp_dir: str | None,
+        chunk_bytes: int
+    ) -> None:
+        self.joiner = joiner
+        self.keys = keys
+        self.max_bytes_in_memory = max_bytes_in_memory
+        self.tmp_dir = tmp_dir
+        self.chunk_bytes = chunk_bytes
+
+    def _collect(self, endpoint: connection.Connection) -> tp.Iterator[TRow]:
+        """Store whole input stream, so result is not sent while owner still sends rows"""
+        if not self.keys:
+            queue = SpillQueue[TRow](self.joiner.max_rows_in_memory, self.tmp_dir)
+            for chunk, _ in recv_chunks(endpoint):
+                for row in chunk:
+                    queue.append(row)
+            return _drain(queue)
+        runs = SortedRuns(self.keys, max_bytes_in_memory=self.max_bytes_in_memory, tmp_dir=self.tmp_dir)
+        for chunk, size in recv_chunks(endpoint):
+            for row in chunk:
+                runs.add(row, size // len(chunk))
+        return iter(runs)
+
+    def run(self, endpoint: connection.Connection) -> None:
+        rows_right = self._collect(endpoint)
+        rows_left = self._collect(endpoint)
+        sender = RowsSender(endpoint, self.chunk_bytes)
+        for row in Join(self.joiner, self.keys)(rows_left, rows_right):
+            sender.send(row)
+        sender.close()
+
+
+class ParallelJoin(Operation):
+    """
+    Join which hash-partitions both tables by join keys between worker
+    processes of the shared pool, every worker joins its own partitions
+    with `Join`, so inputs do not have to be sorted.
+    Inner and left joins are salted: keys which are hot in a sample of
+    first left rows are spread between all workers, and right rows
+    of these keys, which are expected to be few, are sent to every worker.
+    Keyless join is a single hot key, so the whole right table is sent
+    to every worker. Right and outer joins are not salted, as their unmatched
+    right rows must be emitted once, their keyless join runs in one worker.
+    Partitions are concatenated, with `ordered` they are merged
+    so that result is sorted by keys, rows of a hot key are not in input order then.
+    Joiner must be picklable
+    """
+
+    def __init__(
+        self,
+        joiner: Joiner,
+        keys: tp.Sequence[str],
+        workers: int,
+        ordered: bool = False,
+        salt_hot_keys: bool = True,
+        sample_size: int = DEFAULT_SAMPLE_SIZE,
+        max_bytes_in_memory: int | None = DEFAULT_MAX_BYTES_IN_MEMORY,
+        tmp_dir: str | None = None,
+        chunk_bytes: int = DEFAULT_CHUNK_BYTES
+    ) -> None:
+        """
+        :param joiner: join strategy to use
+        :param keys: join keys
+        :param workers: number of worker processes
+        :param ordered: sort result by keys
+        :param salt_hot_keys: spread hot keys of left table between workers, for inner and left joiners
+        :param sample_size: number of first left rows used to find hot keys
+        :param max_bytes_in_memory: memory budget of a worker sorting one table of its partition
+        :param tmp_dir: directory for spilled rows, system default if None
+        :param chunk_bytes: approximate size of row chunks sent between processes
+        """
+        self.joiner = joiner
+        self.keys = keys
+        self.workers = workers
+        self.ordered = ordered
+        self.salt_hot_keys = salt_hot_keys
+        self.sample_size = sample_size
+        self.max_bytes_in_memory = max_bytes_in_memory
+        self.tmp_dir = tmp_dir
+        self.chunk_bytes = chunk_bytes
+
+    def output_order(self, input_orders: list[TOrder]) -> TOrder:
+        return make_order(self.keys) if self.ordered else ()
+
+    def input_columns(self, columns: TColumns) -> TColumns:
+        return self.joiner.input_columns(self.keys, columns)
+
+    @property
+    def replicates_right(self) -> bool:
+        """Whether right rows may be sent to several workers"""
+        return not isinstance(self.joiner, (RightJoiner, OuterJoiner))
+
+    def _task(self) -> JoinTask:
+        return JoinTask(self.joiner, self.keys, self.max_bytes_in_memory, self.tmp_dir, self.chunk_bytes)
+
+    def _send(
+        self,
+        rows: TRowsIterable,
+        endpoints: list[connection.Connection],
+        hot_keys: frozenset[tuple[tp.Any, ...]],
+        right: bool
+    ) -> None:
+        """Rows of hot keys are sent to every worker if they are right and round-robin otherwise,
+        other rows go to the worker of their key"""
+        senders = [RowsSender(endpoint, self.chunk_bytes) for endpoint in endpoints]
+        for i, row in enumerate(rows):
+            key_values = _get_subdict_values(row, self.keys)
+            if key_values not in hot_keys:
+                senders[hash(key_values) % len(senders)].send(row)
+            elif right:
+                for sender in senders:
+                    sender.send(row)
+            else:
+                senders[i % len(senders)].send(row)
+        for sender in senders:
+            sender.close()
+
+    def __call__(
+        self, rows: TRowsIterable, *args: tp.Any, **kwargs: tp.Any
+    ) -> TRowsGenerator:
+        assert len(args) > 0
+        assert hasattr(args[0], "__iter__")
+        rows = iter(rows)
+        sample: list[TRow] = []
+        hot_keys: frozenset[tuple[tp.Any, ...]] = frozenset()
+        if not self.replicates_right:
+            workers = self.workers if self.keys else 1
+        elif not self.keys:
+            workers = self.workers
+            hot_keys = frozenset({()})
+        else:
+            workers = self.workers
+            if self.salt_hot_keys:
+                sample = list(itertools.islice(rows, self.sample_size))
+                hot_keys = find_hot_keys(sample, self.keys, workers)
+        with contextlib.ExitStack() as stack:
+            endpoints = [stack.enter_context(worker_session(self._task())) for _ in range(workers)]
+            # workers send nothing until both their inputs end, so sending can not deadlock
+            self._send(args[0], endpoints, hot_keys, right=True)
+            self._send(itertools.chain(sample, rows), endpoints, hot_keys, right=False)
+            yield from recv_partitions(endpoints, self.keys, self.ordered)
@@ -1,15 +1,19 @@
 import typing as tp
 import heapq
-from collections import Counter, defaultdict
+from collections import Counter
 
-from compgraph.operations.operations_base import Reducer, TRowsGenerator, TRowsIterable, TRow
-
-from .utils import PeekableIterator
+from compgraph.operations.columnar import abs_max, as_array, is_numeric, np
+from compgraph.operations.operations_base import (
+    Aggregator, Reducer, TBatch, TColumns, TRowsGenerator, TRowsIterable, TRow, PARTIAL_STATE_COLUMN
+)
 
 
 class FirstReducer(Reducer):
     """Yield only first row from passed ones"""
 
+    def input_columns(self, group_key: tuple[str, ...], columns: TColumns) -> TColumns:
+        return None if columns is None else columns | set(group_key)
+
     def __call__(
         self, group_key: tuple[str, ...], rows: TRowsIterable
     ) -> TRowsGenerator:
@@ -18,8 +22,14 @@ class FirstReducer(Reducer):
             break
 
 
-class TopN(Reducer):
-    """Calculate top N by value"""
+class TopN(Aggregator):
+    """
+    Calculate top N by value.
+    Rows are yielded from the largest value, rows with equal values
+    keep their input order, and earlier rows win a tie at the N-th place.
+    State holds up to N whole rows of the group, so it is mergeable
+    but not combinable: partial states would carry the rows through the sort once more
+    """
 
     def __init__(self, column: str, n: int) -> None:
         """
@@ -29,29 +39,55 @@ class TopN(Reducer):
         self.column_max = column
         self.n = n
 
-    def __call__(
-        self, group_key: tuple[str, ...], rows: TRowsIterable
-    ) -> TRowsGenerator:
-        result: list[tp.Any] = []
-        hash_table: defaultdict[tp.Any, list[TRow]] = defaultdict(list)
-        for row in rows:
-            value = row[self.column_max]
-            if len(result) < self.n:
-                heapq.heappush(result, value)
-                hash_table[value].append(row)
-            elif result[0] < value:
-                hash_table[result[0]].pop()
-                if hash_table[result[0]]:
-                    hash_table.pop(result[0])
-                heapq.heappushpop(result, value)
-                hash_table[value].append(row)
+    def input_columns(self, group_key: tuple[str, ...], columns: TColumns) -> TColumns:
+        return None if columns is None else columns | set(group_key) | {self.column_max}
+
+    def init(self) -> tuple[int, list[tuple[tp.Any, int, TRow]]]:
+        # number of rows seen and min-heap of the best rows,
+        # negative index makes later row of a tie go first
+        return 0, []
+
+    def update(
+        self, state: tuple[int, list[tuple[tp.Any, int, TRow]]], row: TRow
+    ) -> tuple[int, list[tuple[tp.Any, int, TRow]]]:
+        seen, heap = state
+        entry = (row[self.column_max], -seen, row)
+        if len(heap) < self.n:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+        return seen + 1, heap
 
-        for top_rows in hash_table.values():
-            yield from top_rows
+    def merge(
+        self,
+        state_a: tuple[int, list[tuple[tp.Any, int, TRow]]],
+        state_b: tuple[int, list[tuple[tp.Any, int, TRow]]]
+    ) -> tuple[int, list[tuple[tp.Any, int, TRow]]]:
+        """Rows of state_b are considered to go after rows of state_a"""
+        seen_a, heap_a = state_a
+        seen_b, heap_b = state_b
+        entries = heap_a + [(value, index - seen_a, row) for value, index, row in heap_b]
+        heap = heapq.nlargest(self.n, entries, key=lambda entry: entry[:2])
+        heapq.heapify(heap)
+        return seen_a + seen_b, heap
+
+    def finalize(
+        self,
+        group_key: tuple[str, ...],
+        key_values: tuple[tp.Any, ...],
+        state: tuple[int, list[tuple[tp.Any, int, TRow]]]
+    ) -> TRowsGenerator:
+        _, heap = state
+        for _, _, row in sorted(heap, key=lambda entry: entry[:2], reverse=True):
+            yield row
 
 
-class TermFrequency(Reducer):
-    """Calculate frequency of values in column"""
+class TermFrequency(Aggregator):
+    """
+    Calculate frequency of values in column.
+    State counts every distinct value of the group, so it is mergeable
+    but not combinable: pre-aggregation does not make it small
+    """
 
     def __init__(self, words_column: str, result_column: str = "tf") -> None:
         """
@@ -61,23 +97,71 @@ class TermFrequency(Reducer):
         self.words_column = words_column
         self.result_column = result_column
 
-    def __call__(
-        self, group_key: tuple[str, ...], rows: TRowsIterable
+    def input_columns(self, group_key: tuple[str, ...], columns: TColumns) -> TColumns:
+        return set(group_key) | {self.words_column}
+
+    def output_columns(self, group_key: tuple[str, ...]) -> TColumns:
+        return set(group_key) | {self.words_column, self.result_column}
+
+    def init(self) -> Counter[tp.Any]:
+        return Counter()
+
+    def update(self, state: Counter[tp.Any], row: TRow) -> Counter[tp.Any]:
+        state[row[self.words_column]] += 1
+        return state
+
+    def merge(self, state_a: Counter[tp.Any], state_b: Counter[tp.Any]) -> Counter[tp.Any]:
+        state_a.update(state_b)
+        return state_a
+
+    def finalize(
+        self, group_key: tuple[str, ...], key_values: tuple[tp.Any, ...], state: Counter[tp.Any]
     ) -> TRowsGenerator:
-        rows = PeekableIterator(iter(rows))
-        first_row = rows.peek()
-        assert first_row is not None
-        to_yield_template = {key: first_row[key] for key in group_key}
-        counter = Counter((row[self.words_column] for row in rows))
-        overall = sum(counter.values())
-        for word, count in counter.items():
+        to_yield_template = dict(zip(group_key, key_values))
+        overall = sum(state.values())
+        for word, count in state.items():
             to_yield = to_yield_template.copy()
             to_yield[self.words_column] = word
             to_yield[self.result_column] = count / overall
             yield to_yield
 
 
-class Count(Reducer):
+class PartialMerge(Aggregator):
+    """
+    Merge partial states produced by `Combine` operation
+    and finalize them with original aggregator
+    """
+
+    def __init__(self, aggregator: Aggregator) -> None:
+        """
+        :param aggregator: aggregator which produced partial states
+        """
+        self.aggregator = aggregator
+        self.combinable = aggregator.combinable
+        self.commutative = aggregator.commutative
+
+    def input_columns(self, group_key: tuple[str, ...], columns: TColumns) -> TColumns:
+        return set(group_key) | {PARTIAL_STATE_COLUMN}
+
+    def output_columns(self, group_key: tuple[str, ...]) -> TColumns:
+        return self.aggregator.output_columns(group_key)
+
+    def init(self) -> tp.Any:
+        return self.aggregator.init()
+
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        return self.aggregator.merge(state, row[PARTIAL_STATE_COLUMN])
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        return self.aggregator.merge(state_a, state_b)
+
+    def finalize(
+        self, group_key: tuple[str, ...], key_values: tuple[tp.Any, ...], state: tp.Any
+    ) -> TRowsGenerator:
+        yield from self.aggregator.finalize(group_key, key_values, state)
+
+
+class Count(Aggregator):
     """
     Count records by key
     Example for group_key=('a',) and column='d'
@@ -87,25 +171,116 @@ class Count(Reducer):
         {'a': 1, 'd': 2}
     """
 
+    combinable = True
+    commutative = True
+    vectorized = True
+
     def __init__(self, column: str) -> None:
         """
         :param column: name for result column
         """
         self.column = column
 
-    def __call__(
-        self, group_key: tuple[str, ...], rows: TRowsIterable
+    def input_columns(self, group_key: tuple[str, ...], columns: TColumns) -> TColumns:
+        return set(group_key)
+
+    def output_columns(self, group_key: tuple[str, ...]) -> TColumns:
+        return set(group_key) | {self.column}
+
+    def init(self) -> int:
+        return 0
+
+    def update(self, state: int, row: TRow) -> int:
+        return state + 1
+
+    def merge(self, state_a: int, state_b: int) -> int:
+        return state_a + state_b
+
+    def aggregate_columns(self, batch: TBatch, starts: tp.Sequence[int], size: int) -> list[int]:
+        counts: list[int] = np.diff(starts, append=size).tolist()
+        return counts
+
+    def finalize(
+        self, group_key: tuple[str, ...], key_values: tuple[tp.Any, ...], state: int
     ) -> TRowsGenerator:
-        rows = iter(rows)
-        first_row = next(rows)
-        to_yield: TRow = {key: first_row[key] for key in group_key}
-        to_yield[self.column] = 1
-        for _ in rows:
-            to_yield[self.column] += 1
+        to_yield: TRow = dict(zip(group_key, key_values))
+        to_yield[self.column] = state
         yield to_yield
 
 
-class Sum(Reducer):
+class _ColumnAggregator(Aggregator):
+    """
+    Aggregate values of one column into one value of the group.
+    State is None until the first value, values are merged by `_merge_values`
+    in python and by `_ufunc` in a vectorized batch
+    """
+
+    combinable = True
+    commutative = True
+    vectorized = True
+    # numpy function folding values of every group, None if values are folded in python
+    _ufunc: tp.Any = None
+
+    def __init__(self, column: str, result_column: str | None = None) -> None:
+        """
+        :param column: name for aggregated column
+        :param result_column: name for result column, same as column if None
+        """
+        self.column = column
+        self.result_column = result_column or column
+
+    def input_columns(self, group_key: tuple[str, ...], columns: TColumns) -> TColumns:
+        return set(group_key) | {self.column}
+
+    def output_columns(self, group_key: tuple[str, ...]) -> TColumns:
+        return set(group_key) | {self.result_column}
+
+    def _merge_values(self, value_a: tp.Any, value_b: tp.Any) -> tp.Any:
+        """Merge two values, required when state is None or a value"""
+        raise NotImplementedError(f'{type(self).__name__} does not merge values')
+
+    def init(self) -> tp.Any:
+        # start from the first value, not from 0, to sum non-numbers as well
+        return None
+
+    def update(self, state: tp.Any, row: TRow) -> tp.Any:
+        return self.merge(state, row[self.column])
+
+    def merge(self, state_a: tp.Any, state_b: tp.Any) -> tp.Any:
+        if state_a is None:
+            return state_b
+        if state_b is None:
+            return state_a
+        return self._merge_values(state_a, state_b)
+
+    def _is_foldable(self, values: tp.Any, size: int) -> bool:
+        """Whether numpy folds values the same way as python"""
+        return is_numeric(values)
+
+    def _fold(self, values: tp.Any, starts: tp.Sequence[int], size: int) -> list[tp.Any]:
+        """Fold numeric values of every group into its state"""
+        states: list[tp.Any] = self._ufunc.reduceat(values, starts).tolist()
+        return states
+
+    def aggregate_columns(self, batch: TBatch, starts: tp.Sequence[int], size: int) -> list[tp.Any]:
+        values = as_array(batch[self.column])
+        if not self._is_foldable(values, size):
+            return super().aggregate_columns(batch, starts, size)
+        return self._fold(values, starts, size)
+
+    def _result(self, state: tp.Any) -> tp.Any:
+        """Value of result column for the state of the group"""
+        return state
+
+    def finalize(
+        self, group_key: tuple[str, ...], key_values: tuple[tp.Any, ...], state: tp.Any
+    ) -> TRowsGenerator:
+        to_yield: TRow = dict(zip(group_key, key_values))
+        to_yield[self.result_column] = self._result(state)
+        yield to_yield
+
+
+class Sum(_ColumnAggregator):
     """
     Sum values aggregated by key
     Example for key=('a',) and column='b'
@@ -115,19 +290,130 @@ class Sum(Reducer):
         {'a': 1, 'b': 5}
     """
 
-    def __init__(self, column: str) -> None:
+    _ufunc = None if np is None else np.add
+
+    def _merge_values(self, value_a: tp.Any, value_b: tp.Any) -> tp.Any:
+        return value_a + value_b
+
+    def _is_foldable(self, values: tp.Any, size: int) -> bool:
+        if not is_numeric(values):
+            return False
+        if values.dtype.kind == 'f':
+            return True
+        # integer sum of a group must not overflow, abs of int64 min wraps in numpy
+        return tp.cast(int, abs_max(values)) * size <= np.iinfo(np.int64).max
+
+
+class Min(_ColumnAggregator):
+    """Minimum of values aggregated by key"""
+
+    _ufunc = None if np is None else np.minimum
+
+    def _merge_values(self, value_a: tp.Any, value_b: tp.Any) -> tp.Any:
+        return min(value_a, value_b)
+
+    def _is_foldable(self, values: tp.Any, size: int) -> bool:
+        # python comparisons skip nan depending on its position
+        return is_numeric(values) and not np.isnan(values).any()
+
+
+class Max(_ColumnAggregator):
+    """Maximum of values aggregated by key"""
+
+    _ufunc = None if np is None else np.maximum
+
+    def _merge_values(self, value_a: tp.Any, value_b: tp.Any) -> tp.Any:
+        return max(value_a, value_b)
+
+    def _is_foldable(self, values: tp.Any, size: int) -> bool:
+        # python comparisons skip nan depending on its position
+        return is_numeric(values) and not np.isnan(values).any()
+
+
+class Mean(_ColumnAggregator):
+    """Arithmetic mean of values aggregated by key"""
+
+    def init(self) -> tuple[float, int]:
+        return 0., 0
+
+    def update(self, state: tuple[float, int], row: TRow) -> tuple[float, int]:
+        return state[0] + row[self.column], state[1] + 1
+
+    def merge(self, state_a: tuple[float, int], state_b: tuple[float, int]) -> tuple[float, int]:
+        return state_a[0] + state_b[0], state_a[1] + state_b[1]
+
+    def _fold(self, values: tp.Any, starts: tp.Sequence[int], size: int) -> list[tp.Any]:
+        totals = np.add.reduceat(values.astype(float), starts).tolist()
+        counts = np.diff(starts, append=size).tolist()
+        return list(zip(totals, counts))
+
+    def _result(self, state: tuple[float, int]) -> float:
+        total, count = state
+        return total / count
+
+
+class MultiAggregate(Aggregator):
+    """
+    Compute several aggregates in one pass over a group
+    and yield them in one row.
+    Every aggregator must yield exactly one row per group
+    Example for key=('a',) and aggregators=[Sum('b'), Count('n'), Max('b', 'b_max')]
+        {'a': 1, 'b': 2}
+        {'a': 1, 'b': 3}
+        =>
+        {'a': 1, 'b': 5, 'n': 2, 'b_max': 3}
+    """
+
+    def __init__(self, aggregators: tp.Sequence[Aggregator]) -> None:
         """
-        :param column: name for sum column
+        :param aggregators: aggregators to compute
         """
-        self.column = column
+        self.aggregators = aggregators
+        self.combinable = all(aggregator.combinable for aggregator in aggregators)
+        self.commutative = all(aggregator.commutative for aggregator in aggregators)
+        self.vectorized = all(aggregator.vectorized for aggregator in aggregators)
 
-    def __call__(
-        self, group_key: tuple[str, ...], rows: TRowsIterable
+    def input_columns(self, group_key: tuple[str, ...], columns: TColumns) -> TColumns:
+        result: set[str] = set(group_key)
+        for aggregator in self.aggregators:
+            aggregator_columns = aggregator.input_columns(group_key, columns)
+            if aggregator_columns is None:
+                return None
+            result |= aggregator_columns
+        return result
+
+    def output_columns(self, group_key: tuple[str, ...]) -> TColumns:
+        result: set[str] = set(group_key)
+        for aggregator in self.aggregators:
+            aggregator_columns = aggregator.output_columns(group_key)
+            if aggregator_columns is None:
+                return None
+            result |= aggregator_columns
+        return result
+
+    def init(self) -> list[tp.Any]:
+        return [aggregator.init() for aggregator in self.aggregators]
+
+    def update(self, state: list[tp.Any], row: TRow) -> list[tp.Any]:
+        for i, aggregator in enumerate(self.aggregators):
+            state[i] = aggregator.update(state[i], row)
+        return state
+
+    def merge(self, state_a: list[tp.Any], state_b: list[tp.Any]) -> list[tp.Any]:
+        return [
+            aggregator.merge(part_a, part_b)
+            for aggregator, part_a, part_b in zip(self.aggregators, state_a, state_b)
+        ]
+
+    def aggregate_columns(self, batch: TBatch, starts: tp.Sequence[int], size: int) -> list[list[tp.Any]]:
+        parts = [aggregator.aggregate_columns(batch, starts, size) for aggregator in self.aggregators]
+        return [list(state) for state in zip(*parts)]
+
+    def finalize(
+        self, group_key: tuple[str, ...], key_values: tuple[tp.Any, ...], state: list[tp.Any]
     ) -> TRowsGenerator:
-        rows = iter(rows)
-        first_row = next(rows)
-        to_yield: TRow = {key: first_row[key] for key in group_key}
-        to_yield[self.column] = first_row[self.column]
-        for row in rows:
-            to_yield[self.column] += row[self.column]
+        to_yield: TRow = dict(zip(group_key, key_values))
+        for aggregator, part in zip(self.aggregators, state):
+            for row in aggregator.finalize(group_key, key_values, part):
+                to_yield.update(row)
         yield to_yield
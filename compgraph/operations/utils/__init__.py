@@ -1,7 +1,14 @@
-from .groupby import sorted_groupby
+from .groupby import check_key_order, sorted_groupby
 from .peekable_iterator import PeekableIterator
+from .spill import SpillQueue, SpillList, SpillingTee, dump_to_file, load_from_file
 
 __all__ = [
+    'check_key_order',
     'sorted_groupby',
     'PeekableIterator',
+    'SpillQueue',
+    'SpillList',
+    'SpillingTee',
+    'dump_to_file',
+    'load_from_file',
 ]
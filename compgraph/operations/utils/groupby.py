@@ -2,21 +2,42 @@ import typing as tp
 from itertools import groupby
 
 
+def check_key_order(key: tuple[tp.Any, ...], last_key: tuple[tp.Any, ...], descending: dict[int, bool]) -> None:
+    """
+    Assert that key may go after last_key in rows sorted by keys in any direction
+    :param key: key values
+    :param last_key: previous different key values
+    :param descending: direction of every position, taken from its first change; filled by this function
+    """
+    for position, (value, last_value) in enumerate(zip(key, last_key)):
+        if value == last_value:
+            continue
+        is_descending = value < last_value
+        if descending.setdefault(position, is_descending) != is_descending:
+            raise AssertionError(f"Keys are not sorted: {key} after {last_key}")
+        return
+
+
 def sorted_groupby(
-    iterable: tp.Iterable[tp.Any], key: tp.Callable[..., tp.Any] | None = None
+    iterable: tp.Iterable[tp.Any], key: tp.Callable[..., tp.Any] | None = None, any_direction: bool = False
 ) -> tp.Iterator[tp.Tuple[tp.Any, tp.Iterator[tp.Any]]]:
     """
     Group elements of iterable by key.
     Assert error if keys are not sorted.
     :param iterable: iterable of elements
     :param key: function to get key from element
+    :param any_direction: keys are tuples and every their position may be sorted in descending order,
+        as by Sort with descending keys
     """
     last_key = None
+    descending: dict[int, bool] = {}
     for key, group in groupby(iterable, key):
+        if any_direction and last_key is not None:
+            check_key_order(key, last_key, descending)
         # mypy saying
         # Right operand of "and" is never evaluated
         # which is not true
-        if last_key is not None and key < last_key:  # type: ignore
+        elif last_key is not None and key < last_key:  # type: ignore
             raise AssertionError(f"Keys are not sorted: {key} < {last_key}")
         yield key, group
         last_key = key
@@ -0,0 +1,246 @@
+import pickle
+import tempfile
+import typing as tp
+from collections import deque
+
+T = tp.TypeVar('T')
+
+
+class SpillQueue(tp.Generic[T]):
+    """
+    FIFO queue which keeps first `max_items_in_memory` items in memory
+    and appends the rest to a temporary file.
+    Items must be picklable.
+    """
+
+    def __init__(self, max_items_in_memory: int, tmp_dir: str | None = None) -> None:
+        """
+        :param max_items_in_memory: number of items kept in memory before spilling
+        :param tmp_dir: directory for spill file, system default if None
+        """
+        self.max_items_in_memory = max_items_in_memory
+        self.tmp_dir = tmp_dir
+        self._memory: deque[T] = deque()
+        self._file: tp.IO[bytes] | None = None
+        self._read_pos = 0
+        self._write_pos = 0
+        self._items_on_disk = 0
+
+    def __len__(self) -> int:
+        return len(self._memory) + self._items_on_disk
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def append(self, item: T) -> None:
+        # once something is on disk, new items go to disk too to keep FIFO order
+        if not self._items_on_disk and len(self._memory) < self.max_items_in_memory:
+            self._memory.append(item)
+            return
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.tmp_dir)
+        self._file.seek(self._write_pos)
+        pickle.dump(item, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._write_pos = self._file.tell()
+        self._items_on_disk += 1
+
+    def popleft(self) -> T:
+        if self._memory:
+            return self._memory.popleft()
+        if not self._items_on_disk:
+            raise IndexError('pop from an empty SpillQueue')
+        assert self._file is not None
+        self._file.seek(self._read_pos)
+        item: T = pickle.load(self._file)
+        self._read_pos = self._file.tell()
+        self._items_on_disk -= 1
+        if not self._items_on_disk:
+            # file is drained, reuse it from the beginning
+            self._file.truncate(0)
+            self._read_pos = self._write_pos = 0
+        return item
+
+    def close(self) -> None:
+        self._memory.clear()
+        self._items_on_disk = 0
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SpillList(tp.Generic[T]):
+    """
+    Append-only list which keeps first `max_items_in_memory` items in memory
+    and the rest in a temporary file. Unlike SpillQueue, it can be
+    iterated over many times. Items must be picklable.
+    """
+
+    def __init__(self, max_items_in_memory: int, tmp_dir: str | None = None) -> None:
+        """
+        :param max_items_in_memory: number of items kept in memory before spilling
+        :param tmp_dir: directory for spill file, system default if None
+        """
+        self.max_items_in_memory = max_items_in_memory
+        self.tmp_dir = tmp_dir
+        self._memory: list[T] = []
+        self._file: tp.IO[bytes] | None = None
+        self._items_on_disk = 0
+
+    def __len__(self) -> int:
+        return len(self._memory) + self._items_on_disk
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def append(self, item: T) -> None:
+        if len(self._memory) < self.max_items_in_memory:
+            self._memory.append(item)
+            return
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(dir=self.tmp_dir)
+        self._file.seek(0, 2)
+        pickle.dump(item, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._items_on_disk += 1
+
+    def extend(self, items: tp.Iterable[T]) -> None:
+        for item in items:
+            self.append(item)
+
+    def __iter__(self) -> tp.Iterator[T]:
+        yield from self._memory
+        position = 0
+        for _ in range(self._items_on_disk):
+            assert self._file is not None
+            # other iterations may move the file cursor in between
+            self._file.seek(position)
+            item: T = pickle.load(self._file)
+            position = self._file.tell()
+            yield item
+
+    def close(self) -> None:
+        self._memory.clear()
+        self._items_on_disk = 0
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SpillingTee:
+    """
+    Split one row iterator into `n` independent iterators.
+    Rows which are consumed by one branch but not yet by the others
+    are buffered per branch in SpillQueue, so lagging branch spills
+    to disk instead of growing memory.
+    Every branch receives its own shallow copy of a row,
+    so in-place mappers in one branch do not affect the others.
+    Branch which is closed or garbage collected, even before its first row,
+    drops its buffer and stops receiving rows.
+    """
+
+    def __init__(
+        self,
+        iterable: tp.Iterable[dict[str, tp.Any]],
+        n: int,
+        max_rows_in_memory: int,
+        tmp_dir: str | None = None
+    ) -> None:
+        """
+        :param iterable: source of rows
+        :param n: number of branches
+        :param max_rows_in_memory: rows kept in memory by every lagging branch
+        :param tmp_dir: directory for spill files
+        """
+        self._iterable = iterable
+        self._iterator: tp.Iterator[dict[str, tp.Any]] | None = None
+        self._exhausted = False
+        self._queues = [SpillQueue[dict[str, tp.Any]](max_rows_in_memory, tmp_dir) for _ in range(n)]
+        self._active = [True] * n
+
+    def _branch(self, index: int) -> tp.Generator[dict[str, tp.Any], None, None]:
+        queue = self._queues[index]
+        try:
+            while True:
+                if queue:
+                    yield queue.popleft()
+                    continue
+                if self._exhausted:
+                    return
+                if self._iterator is None:
+                    self._iterator = iter(self._iterable)
+                try:
+                    row = next(self._iterator)
+                except StopIteration:
+                    self._exhausted = True
+                    return
+                for other, other_queue in enumerate(self._queues):
+                    if other != index and self._active[other]:
+                        other_queue.append(row.copy())
+                yield row
+        finally:
+            self._drop(index)
+
+    def _drop(self, index: int) -> None:
+        self._active[index] = False
+        self._queues[index].close()
+
+    def branches(self) -> list[tp.Iterator[dict[str, tp.Any]]]:
+        return [_TeeBranch(self, index) for index in range(len(self._queues))]
+
+
+class _TeeBranch:
+    """
+    Branch of SpillingTee. Unlike a generator, which runs no cleanup
+    when it is closed before the first row, it drops its buffer on close
+    """
+
+    def __init__(self, tee: SpillingTee, index: int) -> None:
+        self._tee = tee
+        self._index = index
+        self._rows = tee._branch(index)
+
+    def __iter__(self) -> '_TeeBranch':
+        return self
+
+    def __next__(self) -> dict[str, tp.Any]:
+        return next(self._rows)
+
+    def close(self) -> None:
+        self._rows.close()
+        self._tee._drop(self._index)
+
+    def __del__(self) -> None:
+        self.close()
+
+
+def dump_to_file(items: tp.Iterable[tp.Any], tmp_dir: str | None = None) -> tp.IO[bytes]:
+    """
+    Pickle items one by one into a new temporary file
+    :param items: items to dump
+    :param tmp_dir: directory for file, system default if None
+    :return: file positioned at the beginning
+    """
+    file = tempfile.TemporaryFile(dir=tmp_dir)
+    for item in items:
+        pickle.dump(item, file, protocol=pickle.HIGHEST_PROTOCOL)
+    file.seek(0)
+    return file
+
+
+def load_from_file(file: tp.IO[bytes]) -> tp.Generator[tp.Any, None, None]:
+    """
+    Stream items dumped by `dump_to_file`, file is closed at the end
+    :param file: file to read from
+    """
+    try:
+        while True:
+            try:
+                yield pickle.load(file)
+            except EOFError:
+                return
+    finally:
+        file.close()
@@ -0,0 +1,221 @@
+import atexit
+import contextlib
+import multiprocessing
+import os
+import pickle
+import traceback
+import typing as tp
+import weakref
+from abc import ABC, abstractmethod
+from multiprocessing import connection
+
+# workers are forked from the caller, so the main module of a script is not imported again
+# and needs no `if __name__ == '__main__'` guard; spawn is used where fork is missing
+START_METHOD = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+MAX_IDLE_WORKERS = os.cpu_count() or 1
+
+
+class Task(ABC):
+    """Unit of work sent to pool worker, must be picklable"""
+
+    @abstractmethod
+    def run(self, endpoint: connection.Connection) -> None:
+        """
+        Communicate with the task owner through endpoint.
+        Worker is reused after `run` returns, so task must read
+        everything owner sends to it.
+        :param endpoint: worker side of connection
+        """
+        pass
+
+
+class TaskError:
+    """
+    Exception raised by a task, worker sends it pickled in place of the next message,
+    the owner raises it again (see `recv_chunks`)
+    """
+
+    def __init__(self, error: Exception) -> None:
+        self.traceback = ''.join(traceback.format_exception(error))
+        try:
+            pickle.dumps(error)
+            self.error = error
+        except Exception:
+            self.error = RuntimeError(repr(error))
+
+    def reraise(self) -> tp.NoReturn:
+        self.error.add_note(f'Raised in worker process:\n{self.traceback}')
+        raise self.error
+
+
+def _worker_loop(endpoint: connection.Connection) -> None:
+    while True:
+        try:
+            task = endpoint.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        try:
+            task.run(endpoint)
+        except Exception as error:
+            # state of connection is unknown, so worker exits after the error is sent
+            try:
+                endpoint.send_bytes(pickle.dumps(TaskError(error), protocol=pickle.HIGHEST_PROTOCOL))
+            except OSError:
+                pass
+            return
+
+
+def _pending_error(endpoint: connection.Connection) -> TaskError | None:
+    """Error sent by worker which failed while the owner was sending to it"""
+    try:
+        while endpoint.poll():
+            message = pickle.loads(endpoint.recv_bytes())
+            if isinstance(message, TaskError):
+                return message
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    return None
+
+
+# workers started by this process, forked children close their connections (see _forget_pool)
+_workers: 'weakref.WeakSet[Worker]' = weakref.WeakSet()
+
+
+class Worker:
+    """Process running tasks one after another"""
+
+    def __init__(self, context: tp.Any) -> None:
+        self.endpoint, remote_endpoint = multiprocessing.Pipe()
+        # registered before start, so the new worker closes its copy of the owner side too
+        _workers.add(self)
+        self.process = context.Process(target=_worker_loop, args=(remote_endpoint,), daemon=True)
+        self.process.start()
+        remote_endpoint.close()
+
+    def is_alive(self) -> bool:
+        return bool(self.process.is_alive())
+
+    def stop(self, timeout: float = 1.) -> None:
+        """Ask worker to exit and kill it if it does not"""
+        try:
+            self.endpoint.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        self.terminate()
+
+    def terminate(self) -> None:
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.endpoint.close()
+
+
+class WorkerPool:
+    """
+    Pool of reusable worker processes.
+    Worker is taken for exclusive use with `acquire` and given back
+    with `release`, new worker is started when no idle one is left.
+    """
+
+    def __init__(self, start_method: str = START_METHOD, max_idle_workers: int = MAX_IDLE_WORKERS) -> None:
+        """
+        :param start_method: multiprocessing start method for workers
+        :param max_idle_workers: maximum number of idle workers kept alive
+        """
+        self.context = multiprocessing.get_context(start_method)
+        self.max_idle_workers = max_idle_workers
+        self._idle: list[Worker] = []
+
+    @property
+    def idle_workers(self) -> int:
+        return len(self._idle)
+
+    def acquire(self) -> Worker:
+        while self._idle:
+            worker = self._idle.pop()
+            if worker.is_alive():
+                return worker
+            worker.terminate()
+        return Worker(self.context)
+
+    def release(self, worker: Worker) -> None:
+        """Give back worker which finished its task"""
+        if len(self._idle) < self.max_idle_workers and worker.is_alive():
+            self._idle.append(worker)
+        else:
+            worker.stop()
+
+    def discard(self, worker: Worker) -> None:
+        """Kill worker whose task was interrupted, its connection state is unknown"""
+        worker.terminate()
+
+    def shutdown(self) -> None:
+        idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+
+_pool: WorkerPool | None = None
+_pool_start_method = START_METHOD
+
+
+def get_pool() -> WorkerPool:
+    """Pool shared by all operations of current process"""
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(_pool_start_method)
+    return _pool
+
+
+def shutdown_pool() -> None:
+    """Stop all idle workers of shared pool"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def _forget_pool() -> None:
+    # forked child must not talk to workers of its parent, nor to a fork server
+    # the parent may have started, so it forks workers of its own
+    global _pool, _pool_start_method
+    _pool = None
+    _pool_start_method = 'fork'
+    # inherited owner sides of connections would keep workers of the parent
+    # from seeing end of file when the parent exits
+    for worker in list(_workers):
+        worker.endpoint.close()
+    _workers.clear()
+
+
+atexit.register(shutdown_pool)
+os.register_at_fork(after_in_child=_forget_pool)
+
+
+@contextlib.contextmanager
+def worker_session(task: Task) -> tp.Iterator[connection.Connection]:
+    """
+    Run task on a worker of shared pool
+    :param task: task to send to worker
+    :return: owner side of connection to the task
+    """
+    pool = get_pool()
+    worker = pool.acquire()
+    try:
+        worker.endpoint.send(task)
+        yield worker.endpoint
+    except OSError:
+        task_error = _pending_error(worker.endpoint)
+        pool.discard(worker)
+        if task_error is not None:
+            task_error.reraise()
+        raise
+    except BaseException:
+        # includes GeneratorExit of a consumer which stopped early
+        pool.discard(worker)
+        raise
+    else:
+        pool.release(worker)
@@ -1,10 +1,16 @@
+import copy
+import itertools
+import multiprocessing
 import typing as tp
 import tempfile
 import ast
 
 import pytest
+from pytest import approx
 
 from compgraph import operations as ops
+from compgraph import algorithms
+from compgraph import graph as graph_module
 from compgraph.graph import Graph
 from .graph_cases import GPAPH_CASES, GraphCase
 from .utils import _Key
@@ -138,3 +144,491 @@ def test_read_from_multiple_files() -> None:
     graph_output = graph.run()
 
     assert check_sorted(graph_output, ground_truth, ('id', 'group_id', 'name'))
+
+
+def test_run_shared_reads_input_once() -> None:
+    data = [{'id': i, 'group_id': i % 3} for i in range(100)]
+    calls = []
+
+    def factory() -> tp.Iterator[ops.TRow]:
+        calls.append(1)
+        return iter(data)
+
+    graph_base = Graph.graph_from_iter('data')
+    graph_count = graph_base \
+        .sort(ops.Sort(('group_id',))) \
+        .reduce(ops.Count('count'), ('group_id',))
+    graph = graph_base \
+        .sort(ops.Sort(('group_id',))) \
+        .join(ops.InnerJoiner(), graph_count, ('group_id',))
+
+    expected = list(graph.run(data=factory))
+    assert len(calls) == 2
+
+    calls.clear()
+    assert list(graph.run_shared(data=factory)) == expected
+    assert len(calls) == 1
+
+
+def test_run_shared_spills_lagging_consumer(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(graph_module, 'SHARED_ROWS_IN_MEMORY', 3)
+    data = [{'id': i, 'text': 'A B'} for i in range(50)]
+
+    graph_base = Graph.graph_from_iter('data')
+    graph_lower = graph_base.map(ops.LowerCase('text'))
+    graph_count = graph_base.reduce(ops.Count('count'), tuple())
+    graph = graph_lower.join(ops.InnerJoiner(), graph_count, tuple())
+
+    result = list(graph.run_shared(data=lambda: ({**row} for row in data)))
+    assert result == [{'id': i, 'text': 'a b', 'count': 50} for i in range(50)]
+
+
+@pytest.mark.parametrize('graph_builder', [
+    algorithms.word_count_graph,
+    algorithms.inverted_index_graph,
+    algorithms.pmi_graph,
+])
+def test_run_shared_algorithms(graph_builder: tp.Callable[[str], Graph]) -> None:
+    docs = [
+        {'doc_id': 1, 'text': 'hello, little world'},
+        {'doc_id': 2, 'text': 'little'},
+        {'doc_id': 3, 'text': 'little little little'},
+        {'doc_id': 4, 'text': 'little? hello little world'},
+        {'doc_id': 5, 'text': 'HELLO HELLO! WORLD...'},
+        {'doc_id': 6, 'text': 'world? world... world!!! WORLD!!! HELLO!!!'}
+    ]
+    graph = graph_builder('docs')
+
+    def factory() -> tp.Iterator[ops.TRow]:
+        return (row.copy() for row in docs)
+
+    assert list(graph.run_shared(docs=factory)) == list(graph.run(docs=factory))
+
+
+def test_map_fusion() -> None:
+    data = [{'text': 'Hello, World', 'n': 1}, {'text': 'b, c', 'n': 2}]
+    source = Graph.graph_from_iter('data')
+    graph = source \
+        .map(ops.FilterPunctuation('text')) \
+        .map(ops.Split('text')) \
+        .map(ops.Filter(lambda row: row['n'] > 1)) \
+        .map(ops.LowerCase('text'))
+    fused = graph.optimize()
+
+    assert isinstance(fused.operation, ops.Map)
+    assert len(fused.operation.mappers) == 4
+    assert [type(node.operation) for node in fused._topological_order()] == [ops.ReadIterFactory, ops.Map]
+    for result in [graph.run(data=lambda: iter(data)), fused.run(data=lambda: iter(data))]:
+        assert list(result) == [
+            {'text': 'b', 'n': 2},
+            {'text': 'c', 'n': 2},
+        ]
+
+
+def test_map_fusion_keeps_shared_map() -> None:
+    calls: list[int] = []
+    data = [{'n': i} for i in range(4)]
+    shared = Graph.graph_from_iter('data').map(ops.Filter(lambda row: calls.append(row['n']) is None))
+    graph = shared.map(ops.Filter(lambda row: row['n'] > 1)) \
+        .join(ops.InnerJoiner(), shared.map(ops.Rename('n', 'key')).map(ops.Rename('key', 'n')), ['n'])
+    optimized = graph.optimize()
+
+    left, right = optimized.previos_graphs
+    assert left.previos_graphs[0] is right.previos_graphs[0]
+    assert len(right.operation.mappers) == 2
+    assert isinstance(left.previos_graphs[0].operation, ops.Map)
+    assert len(left.previos_graphs[0].operation.mappers) == 1
+
+    # shared map is computed once, not copied into every consumer
+    assert list(graph.run_shared(data=lambda: iter(data))) == [{'n': 2}, {'n': 3}]
+    assert calls == [0, 1, 2, 3]
+
+
+def test_sort_order_tracking() -> None:
+    graph = Graph.graph_from_iter('data') \
+        .sort(ops.Sort(['doc_id', 'text'])) \
+        .reduce(ops.FirstReducer(), ['doc_id', 'text']) \
+        .map(ops.Filter(lambda row: row['count'] > 1)) \
+        .map(ops.Project(['doc_id', 'count']))
+    assert graph.sorted_by == (('doc_id', False),)
+
+    resorted = graph.sort(ops.Sort(['doc_id']))
+    assert isinstance(resorted.operation, ops.AssumeSorted)
+    assert isinstance(graph.sort(ops.Sort(['doc_id'], reverse=True)).operation, ops.Sort)
+    assert isinstance(graph.sort(ops.Sort(['doc_id', 'count'])).operation, ops.Sort)
+    assert isinstance(graph.map(ops.LowerCase('doc_id')).sort(ops.Sort(['doc_id'])).operation, ops.Sort)
+
+    data = [{'doc_id': i % 3, 'text': 'abc'[i % 2], 'count': i} for i in range(10)]
+    assert list(resorted.run(data=lambda: iter(data))) == list(
+        graph.sort(ops.Sort(['doc_id'])).operation(graph.run(data=lambda: iter(data)))
+    )
+
+
+def test_sort_declared_by_source() -> None:
+    data = [{'key': 1}, {'key': 3}, {'key': 2}]
+    graph = Graph.graph_from_iter('data', sorted_by=['key'])
+
+    assert isinstance(graph.sort(ops.Sort(['key'])).operation, ops.AssumeSorted)
+    assert list(graph.sort(ops.Sort(['key'])).run(data=lambda: iter(data))) == data
+    with pytest.raises(ValueError):
+        list(graph.sort(ops.Sort(['key']), check_sorted=True).run(data=lambda: iter(data)))
+
+
+def test_optimize_drops_unused_columns() -> None:
+    data = [{'id': i % 4, 'value': i, 'payload': 'x' * i, 'name': str(i)} for i in range(10)]
+    names = [{'id': i, 'name': f'name{i}', 'payload': 'y'} for i in range(4)]
+    graph = Graph.graph_from_iter('data') \
+        .map(ops.Filter(lambda row: row['value'] > 2, ['value'])) \
+        .sort(ops.Sort(['id'])) \
+        .join(ops.InnerJoiner(), Graph.graph_from_iter('names').sort(ops.Sort(['id'])), ['id']) \
+        .map(ops.Project(['id', 'value', 'name_2']))
+    optimized = graph.optimize()
+
+    sort_input = optimized.previos_graphs[0].previos_graphs[0].previos_graphs[0]
+    assert isinstance(sort_input.operation, ops.Map)
+    assert isinstance(sort_input.operation.mappers[-1], ops.KeepColumns)
+    # name is kept in both tables, so name_2 keeps its suffix
+    assert sort_input.operation.mappers[-1].columns == {'id', 'value', 'name', 'name_2'}
+
+    kwargs = {'data': lambda: iter(copy.deepcopy(data)), 'names': lambda: iter(names)}
+    assert list(optimized.run(**kwargs)) == list(graph.run(**kwargs))
+
+
+def test_optimize_keeps_projected_columns() -> None:
+    data = [{'a': i % 3, 'b': i, 'c': 'x'} for i in range(9)]
+    graph = Graph.graph_from_iter('data') \
+        .sort(ops.Sort(['a'])) \
+        .map(ops.Project(['a', 'b'])) \
+        .reduce(ops.Count('count'), ['a'])
+
+    # b is not read by reduce, but Project fails without it
+    assert list(graph.optimize().run(data=lambda: iter(data))) == list(graph.run(data=lambda: iter(data)))
+
+
+def test_optimize_keeps_all_columns_of_result() -> None:
+    data = [{'id': i % 2, 'value': i} for i in range(4)]
+    graph = Graph.graph_from_iter('data') \
+        .map(ops.Filter(lambda row: row['value'] > 0)) \
+        .sort(ops.Sort(['id']))
+    optimized = graph.optimize()
+
+    assert optimized is not graph
+    assert isinstance(optimized.previos_graphs[0].operation, ops.Map)
+    assert len(optimized.previos_graphs[0].operation.mappers) == 1
+    assert list(optimized.run(data=lambda: iter(data))) == list(graph.run(data=lambda: iter(data)))
+
+
+def test_optimize_pushes_filters() -> None:
+    data = [{'doc_id': i % 3, 'text': 'a bb ccc dddd' * (i % 2), 'n': i} for i in range(6)]
+    graph = Graph.graph_from_iter('data') \
+        .map(ops.LowerCase('text')) \
+        .map(ops.Split('text')) \
+        .map(ops.Filter(lambda row: len(row['text']) > 1, ['text'])) \
+        .map(ops.Filter(lambda row: row['n'] > 0, ['n'])) \
+        .sort(ops.Sort(['doc_id'])) \
+        .reduce(ops.Count('count'), ['doc_id', 'text']) \
+        .map(ops.Filter(lambda row: row['doc_id'] != 1, ['doc_id'])) \
+        .map(ops.Filter(lambda row: row['count'] > 1))
+    optimized = graph.optimize()
+
+    # only filter of unknown columns is left after reduce
+    assert [type(mapper) for mapper in optimized.operation.mappers] == [ops.Filter]
+    source_map = optimized.previos_graphs[0].previos_graphs[0].previos_graphs[0].operation
+    assert [type(mapper) for mapper in source_map.mappers] == [
+        ops.Filter, ops.Filter, ops.LowerCase, ops.Split, ops.KeepColumns
+    ]
+    assert source_map.mappers[3].condition is not None
+
+    assert list(optimized.run(data=lambda: iter(data))) == list(graph.run(data=lambda: iter(data)))
+
+
+def test_optimize_keeps_filter_without_columns() -> None:
+    data = [{'key': i % 3, 'n': i} for i in range(9)]
+    passed = itertools.count()
+    graph = Graph.graph_from_iter('data') \
+        .sort(ops.Sort(['key'])) \
+        .reduce(ops.Count('count'), ['key']) \
+        .map(ops.Filter(lambda row: next(passed) % 2 == 0, []))
+    optimized = graph.optimize()
+
+    assert isinstance(optimized.operation, ops.Map)
+    assert [type(mapper) for mapper in optimized.operation.mappers] == [ops.Filter]
+    assert list(optimized.run(data=lambda: iter(data))) == [{'key': 0, 'count': 3}, {'key': 2, 'count': 3}]
+
+
+def test_optimize_does_not_push_into_shared_node() -> None:
+    sorted_data = Graph.graph_from_iter('data').sort(ops.Sort(['key']))
+    graph = sorted_data \
+        .map(ops.Filter(lambda row: row['key'] > 1, ['key'])) \
+        .join(ops.InnerJoiner(), sorted_data, ['key'])
+    optimized = graph.optimize()
+
+    left, right = optimized.previos_graphs
+    assert isinstance(left.operation, ops.Map)
+    assert left.previos_graphs[0] is right
+
+    data = [{'key': i % 4} for i in range(8)]
+    assert list(optimized.run(data=lambda: iter(data))) == list(graph.run(data=lambda: iter(data)))
+
+
+def test_top() -> None:
+    data = [{'text': word, 'count': len(word)} for word in 'to be or not to be that is the question'.split()]
+    graph = Graph.graph_from_iter('data').top([('count', 'desc'), 'text'], 3)
+
+    assert graph.sorted_by == (('count', True), ('text', False))
+    assert list(graph.run(data=lambda: iter(data))) == [
+        {'text': 'question', 'count': 8},
+        {'text': 'that', 'count': 4},
+        {'text': 'not', 'count': 3},
+    ]
+
+
+def test_parallel_map_fusion() -> None:
+    data = [{'text': 'Hello, World', 'n': i} for i in range(100)]
+    source = Graph.graph_from_iter('data')
+    graph = source \
+        .map(ops.FilterPunctuation('text'), workers=2) \
+        .map(ops.Split('text'), workers=2) \
+        .map(ops.LowerCase('text'), workers=2, ordered=False)
+    fused = graph.optimize()
+
+    assert isinstance(fused.operation, ops.ParallelMap)
+    assert len(fused.operation.mappers) == 1
+    assert len(fused.previos_graphs[0].operation.mappers) == 2
+    assert isinstance(fused.previos_graphs[0].previos_graphs[0].operation, ops.ReadIterFactory)
+    assert fused.sorted_by == graph.sorted_by == ()
+
+    expected = Graph.graph_from_iter('data') \
+        .map(ops.FilterPunctuation('text')).map(ops.Split('text')).map(ops.LowerCase('text'))
+    key_func = _Key('n', 'text')
+    assert sorted(graph.run(data=lambda: iter(data)), key=key_func) == \
+        sorted(expected.run(data=lambda: iter(data)), key=key_func)
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_parallel_reduce(ordered: bool) -> None:
+    data = [{'doc_id': i % 7, 'text': f'w{i % 5}'} for i in range(100)]
+    graph = Graph.graph_from_iter('data') \
+        .parallel_reduce(ops.TermFrequency('text'), ['doc_id'], workers=3, ordered=ordered)
+    expected = Graph.graph_from_iter('data') \
+        .sort(ops.Sort(['doc_id'])) \
+        .reduce(ops.TermFrequency('text'), ['doc_id'])
+
+    assert graph.sorted_by == (ops.make_order(['doc_id']) if ordered else ())
+    result = list(graph.run(data=lambda: iter(data)))
+    expected_result = list(expected.run(data=lambda: iter(data)))
+    if ordered:
+        assert result == expected_result
+    else:
+        key_func = _Key('doc_id', 'text')
+        assert sorted(result, key=key_func) == sorted(expected_result, key=key_func)
+
+
+def test_parallel_join() -> None:
+    words = [{'doc_id': i % 4, 'text': f'w{i % 6}'} for i in range(40)]
+    source = Graph.graph_from_iter('words')
+    counts = source.hash_reduce(ops.Count('count'), ['text'])
+    total = source.reduce(ops.Count('total'), tuple())
+    graph = source \
+        .parallel_join(ops.InnerJoiner(), counts, ['text'], workers=3, ordered=True) \
+        .parallel_join(ops.InnerJoiner(), total, tuple(), workers=2)
+    expected = source \
+        .sort(ops.Sort(['text'])) \
+        .join(ops.InnerJoiner(), counts.sort(ops.Sort(['text'])), ['text']) \
+        .broadcast_join(ops.InnerJoiner(), total, tuple())
+
+    assert graph.previos_graphs[0].sorted_by == ops.make_order(['text'])
+    assert graph.sorted_by == ()
+    key_func = _Key('text', 'doc_id')
+    assert sorted(graph.run_shared(words=lambda: iter(words)), key=key_func) == \
+        sorted(expected.run_shared(words=lambda: iter(words)), key=key_func)
+
+
+@pytest.mark.parametrize('run_shared', [False, True])
+def test_concurrent(run_shared: bool) -> None:
+    context = multiprocessing.get_context('fork')
+    started = {'left': context.Event(), 'right': context.Event()}
+
+    def source(name: str, other: str, rows: int) -> tp.Callable[[], tp.Iterator[ops.TRow]]:
+        def rows_factory() -> tp.Iterator[ops.TRow]:
+            started[name].set()
+            # both branches run at the same time only if the other one starts too
+            overlapped = started[other].wait(10)
+            for i in range(rows):
+                yield {'id': i % 5, f'{name}_overlapped': overlapped}
+        return rows_factory
+
+    graph = Graph.graph_from_iter('left') \
+        .map(ops.Rename('id', 'key')) \
+        .broadcast_join(ops.InnerJoiner(), Graph.graph_from_iter('right').map(ops.Rename('id', 'key')), ['key'])
+    concurrent = graph.concurrent()
+    assert [type(prev.operation) for prev in concurrent.previos_graphs] == [ops.Prefetch, ops.Prefetch]
+
+    run = concurrent.run_shared if run_shared else concurrent.run
+    # broadcast join reads its right input to the end before the left one
+    result = list(run(left=source('left', 'right', 50), right=source('right', 'left', 5)))
+    assert len(result) == 50
+    assert all(row['left_overlapped'] and row['right_overlapped'] for row in result)
+
+
+def test_columnar() -> None:
+    data = [{'id': i % 5, 'time': i % 7 + 1, 'length': i * 0.5, 'text': 'a b'} for i in range(50)]
+    graph = Graph.graph_from_iter('data') \
+        .map(ops.MathMapper('speed', 'length / time')) \
+        .map(ops.Project(['id', 'speed', 'time'])) \
+        .sort(ops.Sort(['id'])) \
+        .reduce(ops.MultiAggregate([ops.Sum('speed'), ops.Count('count')]), ['id']) \
+        .map(ops.Rename('speed', 'total'))
+    grouped = Graph.graph_from_iter('data') \
+        .map(ops.Split('text')) \
+        .map(ops.Product(['id', 'time'])) \
+        .sort(ops.Sort(['id'])) \
+        .reduce(ops.Sum('product'), ['id'])
+
+    columnar = graph.columnar()
+    # combiner is inserted before the sort, see Graph.reduce
+    assert [type(node.operation) for node in columnar._topological_order()] == [
+        ops.ReadIterFactory, ops.BatchMap, ops.BatchCombine, ops.Sort, ops.Reduce, ops.BatchMap
+    ]
+    assert columnar.sorted_by == graph.sorted_by
+    # split is not vectorized, so its map is kept
+    assert [type(node.operation) for node in grouped.columnar()._topological_order()] == [
+        ops.ReadIterFactory, ops.Map, ops.BatchCombine, ops.Sort, ops.Reduce
+    ]
+
+    for expected in [graph, grouped]:
+        result = list(expected.columnar(batch_rows=8).run(data=lambda: (row.copy() for row in data)))
+        assert result == [approx(row) for row in expected.run(data=lambda: (row.copy() for row in data))]
+
+
+@pytest.mark.parametrize('graph_builder', [algorithms.word_count_graph, algorithms.pmi_graph])
+def test_parallel_algorithms(graph_builder: tp.Callable[..., Graph]) -> None:
+    # frequent words are salted, results are the same as of sequential graph
+    docs = [{'doc_id': i % 7, 'text': 'these words, these words ' + f'rare{i % 11}ly ' * (i % 3)} for i in range(60)]
+    expected = list(graph_builder('docs').run(docs=lambda: (row.copy() for row in docs)))
+    graph = graph_builder('docs', workers=3)
+    assert list(graph.run(docs=lambda: (row.copy() for row in docs))) == expected
+
+
+def test_parallel_inverted_index() -> None:
+    docs = [{'doc_id': i, 'text': ' '.join(f'w{j}' for j in range(i % 6 + 1))} for i in range(30)]
+    expected = list(algorithms.inverted_index_graph('docs').run(docs=lambda: (row.copy() for row in docs)))
+    graph = algorithms.inverted_index_graph('docs', workers=3)
+    result = list(graph.run(docs=lambda: (row.copy() for row in docs)))
+    assert result == expected
+
+
+def test_hash_reduce() -> None:
+    data = [{'group_id': i % 3, 'value': i} for i in range(10)]
+    graph = Graph.graph_from_iter('data') \
+        .hash_reduce(ops.Sum('value'), ('group_id',)) \
+        .sort(ops.Sort(('group_id',)))
+
+    assert list(graph.run(data=lambda: iter(data))) == [
+        {'group_id': 0, 'value': 18},
+        {'group_id': 1, 'value': 12},
+        {'group_id': 2, 'value': 15},
+    ]
+
+
+def test_reduce_inserts_combiner() -> None:
+    data = [{'text': word} for word in 'a b a c b a a'.split()]
+    graph = Graph.graph_from_iter('data') \
+        .sort(ops.Sort(('text',))) \
+        .reduce(ops.Count('count'), ('text',))
+
+    optimized = graph.optimize()
+    assert isinstance(optimized.operation, ops.Reduce)
+    assert isinstance(optimized.operation.reducer, ops.PartialMerge)
+    assert isinstance(optimized.previos_graphs[0].previos_graphs[0].operation, ops.Combine)
+    assert [type(node.operation) for node in optimized.optimize()._topological_order()] == [
+        ops.ReadIterFactory, ops.Combine, ops.Sort, ops.Reduce
+    ]
+    assert list(graph.run(data=lambda: iter(data))) == [
+        {'text': 'a', 'count': 4},
+        {'text': 'b', 'count': 2},
+        {'text': 'c', 'count': 1},
+    ]
+
+
+def test_reduce_keeps_shared_sort(monkeypatch: pytest.MonkeyPatch) -> None:
+    data = [{'text': word} for word in 'a b a c b a a'.split()]
+    graph_sorted = Graph.graph_from_iter('data').sort(ops.Sort(('text',)))
+    counts = graph_sorted.reduce(ops.Count('count'), ('text',))
+    graph = counts.join(ops.InnerJoiner(), graph_sorted, ('text',))
+
+    # sort has other consumer, so combiner would make a second copy of it
+    assert [type(node.operation) for node in graph.optimize()._topological_order()] == [
+        ops.ReadIterFactory, ops.Sort, ops.Reduce, ops.Join
+    ]
+
+    calls: list[int] = []
+    original = ops.Sort.__call__
+    monkeypatch.setattr(ops.Sort, '__call__', lambda self, rows: calls.append(1) or original(self, rows))
+    result = list(graph.run_shared(data=lambda: iter(data)))
+    assert len(calls) == 1
+    assert [(row['text'], row['count']) for row in result] == [('a', 4)] * 4 + [('b', 2)] * 2 + [('c', 1)]
+
+
+@pytest.mark.parametrize('reducer', [ops.Count('count'), ops.FirstReducer()])
+def test_reduce_after_descending_sort(reducer: ops.Reducer) -> None:
+    data = [{'text': word, 'n': i} for i, word in enumerate('a b a c b a a'.split())]
+    graph = Graph.graph_from_iter('data').sort(ops.Sort([('text', 'desc'), 'n'])).reduce(reducer, ('text', 'n'))
+    expected = sorted(Graph.graph_from_iter('data').sort(ops.Sort(['text', 'n'])).reduce(reducer, ('text', 'n'))
+                      .run(data=lambda: iter(data)), key=lambda row: row['text'], reverse=True)
+    assert list(graph.run(data=lambda: iter(data))) == expected
+
+    graph = Graph.graph_from_iter('data').sort(ops.Sort(['text'], reverse=True)).reduce(reducer, ('text',))
+    assert [row['text'] for row in graph.run(data=lambda: iter(data))] == ['c', 'b', 'a']
+
+    with pytest.raises(AssertionError):
+        list(Graph.graph_from_iter('data').reduce(reducer, ('text',)).run(data=lambda: iter(data)))
+
+
+def test_reduce_without_combiner() -> None:
+    graph_sorted = Graph.graph_from_iter('data').sort(ops.Sort(('text',)))
+
+    graph = graph_sorted.reduce(ops.TermFrequency('text'), ('text',))
+    assert graph.previos_graphs[0] is graph_sorted
+
+    graph = graph_sorted.reduce(ops.Count('count'), ('doc_id',))
+    assert graph.previos_graphs[0] is graph_sorted
+
+    # top rows are not pre-aggregated, they would go through the sort as partial states
+    graph = graph_sorted.reduce(ops.TopN('n', 2), ('text',))
+    assert [type(node.operation) for node in graph.optimize()._topological_order()] == [
+        ops.ReadIterFactory, ops.Sort, ops.Reduce
+    ]
+
+
+def test_broadcast_join() -> None:
+    data = [{'id': i, 'group_id': i % 3} for i in range(7)]
+    names = [{'group_id': 2, 'name': 'b'}, {'group_id': 0, 'name': 'a'}]
+    graph = Graph.graph_from_iter('data') \
+        .broadcast_join(ops.LeftJoiner(), Graph.graph_from_iter('names'), ('group_id',))
+
+    result = graph.run(data=lambda: iter(data), names=lambda: iter(names))
+    assert list(result) == [
+        {'id': 0, 'group_id': 0, 'name': 'a'},
+        {'id': 1, 'group_id': 1},
+        {'id': 2, 'group_id': 2, 'name': 'b'},
+        {'id': 3, 'group_id': 0, 'name': 'a'},
+        {'id': 4, 'group_id': 1},
+        {'id': 5, 'group_id': 2, 'name': 'b'},
+        {'id': 6, 'group_id': 0, 'name': 'a'},
+    ]
+
+
+def test_hash_join() -> None:
+    data = [{'id': i, 'group_id': i % 3} for i in range(6)]
+    names = [{'group_id': 2, 'name': 'b'}, {'group_id': 0, 'name': 'a'}]
+    graph = Graph.graph_from_iter('data') \
+        .hash_join(ops.InnerJoiner(), Graph.graph_from_iter('names'), ('group_id',))
+
+    result = graph.run(data=lambda: iter(data), names=lambda: iter(names))
+    assert check_sorted(result, [
+        {'id': 0, 'group_id': 0, 'name': 'a'},
+        {'id': 2, 'group_id': 2, 'name': 'b'},
+        {'id': 3, 'group_id': 0, 'name': 'a'},
+        {'id': 5, 'group_id': 2, 'name': 'b'},
+    ], ('id', 'group_id', 'name'))
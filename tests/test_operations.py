@@ -1,12 +1,23 @@
+import copy
 import dataclasses
 import typing as tp
 import math
 import datetime
+import multiprocessing
+import os
+import pathlib
+import pickle
+import subprocess
+import sys
 
 import pytest
 from pytest import approx
 
 from compgraph import operations as ops
+from compgraph.operations import parallel, workers
+from compgraph.operations.external_sort import RowsSender, SortedRuns, recv_chunks
+from compgraph.operations.utils import SpillList, SpillQueue, SpillingTee
+from .correctness import test_operations as correctness_operations
 from .utils import _Key
 
 
@@ -90,7 +101,7 @@ MAP_CASES = [
         ],
         ground_truth=[
             {'left_edge': 1, 'right_edge': 1, 'result': approx(1.4142, abs=0.0001)},
-            {'left_edge': 1, 'right_edge': -1, 'result': 0},
+            {'left_edge': 1, 'right_edge': -1, 'result': approx(1.4142, abs=0.0001)},
             {'left_edge': 3, 'right_edge': 4, 'result': approx(5, abs=0.0001)},
             {'left_edge': 12, 'right_edge': 5, 'result': approx(13, abs=0.0001)},
         ],
@@ -106,6 +117,18 @@ MAP_CASES = [
         ],
         cmp_keys=('x', 'y')
     ),
+    MapCase(
+        mapper=ops.MathMapper('ratio', 'count_2 / count_10 - -x'),
+        data=[
+            {'count_2': 1, 'count_10': 4, 'x': 1},
+            {'count_2': 6, 'count_10': 3, 'x': 0},
+        ],
+        ground_truth=[
+            {'count_2': 1, 'count_10': 4, 'x': 1, 'ratio': 1.25},
+            {'count_2': 6, 'count_10': 3, 'x': 0, 'ratio': 2.},
+        ],
+        cmp_keys=('count_2', 'count_10', 'x', 'ratio')
+    ),
     MapCase(
         mapper=ops.ToDatetime(
             'datetime',
@@ -131,6 +154,146 @@ def test_mapper(case: MapCase) -> None:
     assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
 
 
+def test_map_chain() -> None:
+    mappers = [
+        ops.Split('text'),
+        ops.Filter(lambda row: row['text'] != 'b'),
+        ops.Product(['n', 'n'], 'square'),
+        ops.Split('text', 'a'),
+        ops.Project(['text', 'square'])
+    ]
+    data = [{'text': 'a b cac', 'n': 1}, {'text': 'b', 'n': 2}, {'text': 'bab', 'n': 3}]
+
+    expected = copy.deepcopy(data)
+    for mapper in mappers:
+        expected = list(ops.Map(mapper)(iter(expected)))
+    assert list(ops.Map(*mappers)(iter(copy.deepcopy(data)))) == expected
+
+
+PARALLEL_MAP_DATA = [{'text': 'a bb ccc ' * (i % 5), 'n': i} for i in range(300)]
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_parallel_map(ordered: bool) -> None:
+    mappers = [ops.Split('text'), ops.Filter(lambda row: len(row['text']) > 1), ops.Product(['n', 'n'], 'square')]
+    expected = list(ops.Map(*mappers)(iter(copy.deepcopy(PARALLEL_MAP_DATA))))
+
+    result = list(ops.ParallelMap(*mappers, workers=3, ordered=ordered, chunk_rows=7)(iter(PARALLEL_MAP_DATA)))
+    if ordered:
+        assert result == expected
+    else:
+        key_func = _Key('n', 'text')
+        assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+def test_parallel_map_raises_mapper_error() -> None:
+    parallel_map = ops.ParallelMap(ops.LogarithmMap('n'), workers=2, chunk_rows=10)
+    with pytest.raises(ValueError):
+        list(parallel_map(iter(PARALLEL_MAP_DATA)))
+
+
+def test_parallel_map_closed_early() -> None:
+    result = ops.ParallelMap(ops.Split('text'), workers=2, chunk_rows=10, prefetch=1)(iter(PARALLEL_MAP_DATA))
+    assert next(result) == {'text': '', 'n': 0}
+    result.close()
+
+
+def test_prefetch() -> None:
+    result = ops.Prefetch(chunk_rows=7, prefetch=1)(ops.Map(ops.Split('text'))(iter(PARALLEL_MAP_DATA)))
+    assert list(result) == list(ops.Map(ops.Split('text'))(iter(copy.deepcopy(PARALLEL_MAP_DATA))))
+
+
+def test_prefetch_raises_upstream_error() -> None:
+    prefetch = ops.Prefetch(chunk_rows=10)
+    with pytest.raises(ValueError):
+        list(prefetch(ops.Map(ops.LogarithmMap('n'))(iter(PARALLEL_MAP_DATA))))
+
+
+def test_prefetch_closed_early() -> None:
+    result = ops.Prefetch(chunk_rows=10, prefetch=1)(iter(PARALLEL_MAP_DATA))
+    assert next(result) == PARALLEL_MAP_DATA[0]
+    result.close()
+
+
+PARALLEL_REDUCE_DATA = [{'word': f'w{i * 7 % 11}', 'doc_id': i % 5, 'n': i} for i in range(200)]
+
+
+@pytest.mark.parametrize('reducer', [
+    ops.TermFrequency('doc_id'), ops.TopN('n', 2), ops.FirstReducer(), ops.Count('count')
+])
+@pytest.mark.parametrize('ordered', [True, False])
+def test_parallel_reduce(reducer: ops.Reducer, ordered: bool) -> None:
+    sorted_data = sorted(copy.deepcopy(PARALLEL_REDUCE_DATA), key=lambda row: row['word'])
+    expected = list(ops.Reduce(reducer, ('word',))(iter(sorted_data)))
+
+    result = list(ops.ParallelReduce(reducer, ('word',), workers=3, ordered=ordered)(iter(PARALLEL_REDUCE_DATA)))
+    if ordered:
+        assert result == expected
+    else:
+        key_func = _Key('word', 'doc_id', 'n', 'tf', 'count')
+        assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+def test_parallel_reduce_task_sorts_result_within_budget(monkeypatch: pytest.MonkeyPatch) -> None:
+    data = [{'doc_id': i % 10, 'text': f'w{i % 7}'} for i in range(70)]
+    expected = list(ops.Reduce(ops.TermFrequency('text'), ('doc_id',))(sorted(data, key=lambda row: row['doc_id'])))
+
+    spills = []
+    spill = SortedRuns._spill
+    monkeypatch.setattr(SortedRuns, '_spill', lambda self: spills.append(len(self._rows)) or spill(self))
+    # result of TermFrequency is as large as its input, so it is sorted in several runs
+    task = parallel.ReduceTask(ops.TermFrequency('text'), ('doc_id',), True, frozenset(), 500, None, 1000)
+    result = list(task._reduce((row, 50) for row in data))
+    assert spills
+    assert result == expected
+
+
+# word 'the' takes most rows, as in natural language
+SKEWED_DATA = [{'word': 'the' if i % 3 else f'w{i % 10}', 'doc_id': i % 4, 'n': i} for i in range(300)]
+
+
+def test_find_hot_keys() -> None:
+    assert parallel.find_hot_keys(SKEWED_DATA, ('word',), workers=3) == {('the',)}
+    assert parallel.find_hot_keys(SKEWED_DATA, ('word',), workers=1) == frozenset()
+    assert parallel.find_hot_keys(PARALLEL_REDUCE_DATA, ('word',), workers=3) == frozenset()
+
+
+@pytest.mark.parametrize('reducer', [
+    ops.Count('count'), ops.MultiAggregate([ops.Sum('n'), ops.Max('n', 'n_max')]), ops.TopN('n', 2)
+])
+@pytest.mark.parametrize('ordered', [True, False])
+def test_parallel_reduce_salted(reducer: ops.Reducer, ordered: bool) -> None:
+    sorted_data = sorted(copy.deepcopy(SKEWED_DATA), key=lambda row: row['word'])
+    expected = list(ops.Reduce(reducer, ('word',))(iter(sorted_data)))
+
+    result = list(ops.ParallelReduce(reducer, ('word',), workers=3, ordered=ordered, sample_size=50)(iter(SKEWED_DATA)))
+    if ordered:
+        assert result == expected
+    else:
+        key_func = _Key('word', 'doc_id', 'n', 'count')
+        assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+def test_parallel_reduce_without_keys() -> None:
+    result = list(ops.ParallelReduce(ops.Count('count'), (), workers=3)(iter(PARALLEL_REDUCE_DATA)))
+    assert result == [{'count': 200}]
+
+
+@pytest.mark.parametrize('equation', ['x**3 + x**2 + x + 1', '(a1 - x) ^ 3', '-a1 / 2', '42'])
+def test_math_mapper_batch(equation: str) -> None:
+    mapper = ops.MathMapper('y', equation)
+    data = [{'x': x, 'a1': 2 * x + 1} for x in range(5)]
+
+    expected = [row for data_row in data for row in mapper(data_row)]
+    assert mapper.map_batch(data) == expected
+    assert pickle.loads(pickle.dumps(mapper)).map_batch(data) == expected
+
+
+def test_math_mapper_rejects_calls() -> None:
+    with pytest.raises(TypeError):
+        ops.MathMapper('y', '__import__("os")')
+
+
 @dataclasses.dataclass
 class ReduceCase:
     reducer: ops.Reducer
@@ -177,3 +340,569 @@ def test_reducer(case: ReduceCase) -> None:
     result = ops.Reduce(case.reducer, case.reducer_keys)(iter(case.data))
     assert isinstance(result, tp.Iterator)
     assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+
+@dataclasses.dataclass
+class SortCase:
+    sort: ops.Sort
+    data: list[ops.TRow]
+    ground_truth: list[ops.TRow]
+
+
+SORT_DATA = [{'id': i, 'score': (i * 7) % 5} for i in range(20)]
+SORT_NAMED_DATA = [{'id': i, 'name': 'abc'[i % 3] * (i % 2 + 1), 'score': (i * 7) % 5} for i in range(20)]
+
+SORT_CASES = [
+    SortCase(
+        sort=ops.Sort(('score',), max_rows_in_memory=3),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: row['score'])
+    ),
+    SortCase(
+        sort=ops.Sort(('score',), reverse=True, max_rows_in_memory=3),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: row['score'], reverse=True)
+    ),
+    SortCase(
+        sort=ops.Sort(('score', 'id'), max_bytes_in_memory=100),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: (row['score'], row['id']))
+    ),
+    SortCase(
+        sort=ops.Sort(('score',), max_rows_in_memory=3),
+        data=[],
+        ground_truth=[]
+    ),
+    SortCase(
+        sort=ops.Sort(('score',), chunk_bytes=0),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: row['score'])
+    ),
+    SortCase(
+        sort=ops.Sort(('score',), workers=3, sample_size=7),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: row['score'])
+    ),
+    SortCase(
+        sort=ops.Sort(('score', 'id'), reverse=True, workers=4, sample_size=5, max_rows_in_memory=2),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: (row['score'], row['id']), reverse=True)
+    ),
+    SortCase(
+        sort=ops.Sort(('score',), reverse=True, workers=4),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: row['score'], reverse=True)
+    ),
+    SortCase(
+        sort=ops.Sort(('score',), workers=2),
+        data=[],
+        ground_truth=[]
+    ),
+    SortCase(
+        sort=ops.Sort(('score',), chunk_bytes=64),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: row['score'])
+    ),
+    SortCase(
+        sort=ops.Sort([('score', 'asc'), ('id', 'desc')], max_rows_in_memory=3),
+        data=SORT_DATA,
+        ground_truth=sorted(SORT_DATA, key=lambda row: (row['score'], -row['id']))
+    ),
+    SortCase(
+        sort=ops.Sort([('name', 'desc'), 'score'], workers=3, sample_size=6, max_rows_in_memory=4),
+        data=SORT_NAMED_DATA,
+        ground_truth=sorted(
+            sorted(SORT_NAMED_DATA, key=lambda row: row['score']), key=lambda row: row['name'], reverse=True
+        )
+    ),
+    SortCase(
+        sort=ops.Sort([('name', 'desc'), ('score', 'asc')], reverse=True),
+        data=SORT_NAMED_DATA,
+        ground_truth=sorted(
+            sorted(SORT_NAMED_DATA, key=lambda row: row['score'], reverse=True), key=lambda row: row['name']
+        )
+    ),
+]
+
+
+@pytest.mark.parametrize('keys,n,reverse', [
+    (['score'], 5, False),
+    (['score', 'id'], 3, True),
+    ([('name', 'desc'), ('score', 'asc')], 7, False),
+    (['score'], 100, False),
+    (['score'], 0, False),
+])
+def test_top(keys: list[ops.TSortKey], n: int, reverse: bool) -> None:
+    expected = list(ops.Sort(keys, reverse)(iter(SORT_NAMED_DATA)))[:n]
+    assert list(ops.Top(keys, n, reverse)(iter(SORT_NAMED_DATA))) == expected
+
+
+def test_top_n_reducer_is_stable() -> None:
+    data = [{'group': 1, 'id': i, 'score': (i * 7) % 5} for i in range(20)]
+    result = list(ops.Reduce(ops.TopN('score', 6), ['group'])(iter(data)))
+
+    assert result == sorted(data, key=lambda row: row['score'], reverse=True)[:6]
+
+
+def test_sort_rejects_unknown_direction() -> None:
+    with pytest.raises(ValueError):
+        ops.Sort([('score', 'descending')])
+
+
+@pytest.mark.parametrize('case', SORT_CASES)
+def test_sort(case: SortCase) -> None:
+    # comparing whole rows also checks that sort is stable
+    assert list(case.sort(iter(case.data))) == case.ground_truth
+
+
+def test_assume_sorted_check() -> None:
+    order = (('group', False), ('score', True))
+    data = [{'group': 1, 'score': 5}, {'group': 1, 'score': 5}, {'group': 1, 'score': 2}, {'group': 2, 'score': 7}]
+
+    assert list(ops.AssumeSorted(order, check=True)(iter(data))) == data
+    with pytest.raises(ValueError):
+        list(ops.AssumeSorted(order, check=True)(iter(data[::-1])))
+    assert list(ops.AssumeSorted(order)(iter(data[::-1]))) == data[::-1]
+
+
+def test_sorted_runs_spill() -> None:
+    runs = SortedRuns(('score',), max_rows_in_memory=4)
+    for row in SORT_DATA:
+        runs.add(row)
+    assert runs.runs_count == 5
+    assert list(runs) == sorted(SORT_DATA, key=lambda row: row['score'])
+
+
+def test_rows_sender_adapts_chunk() -> None:
+    local_endpoint, remote_endpoint = multiprocessing.Pipe()
+    sender = RowsSender(local_endpoint, chunk_bytes=1024)
+    for row in SORT_DATA:
+        sender.send(row)
+    sender.close()
+
+    chunks = [chunk for chunk, _ in recv_chunks(remote_endpoint)]
+    assert [row for chunk in chunks for row in chunk] == SORT_DATA
+    assert [len(chunk) for chunk in chunks] == [1, 2, 4, 8, 5]
+
+
+def test_sort_reuses_pool_worker() -> None:
+    pool = workers.get_pool()
+    pool.shutdown()
+
+    assert list(ops.Sort(('score',))(iter(SORT_DATA))) == sorted(SORT_DATA, key=lambda row: row['score'])
+    assert pool.idle_workers == 1
+    worker_pid = pool._idle[0].process.pid
+
+    assert list(ops.Sort(('id',))(iter(SORT_DATA))) == SORT_DATA
+    assert pool.idle_workers == 1
+    assert pool._idle[0].process.pid == worker_pid
+
+
+def test_sort_closed_early_discards_worker() -> None:
+    pool = workers.get_pool()
+    pool.shutdown()
+
+    result = ops.Sort(('score',))(iter(SORT_DATA))
+    assert next(result) == {'id': 0, 'score': 0}
+    result.close()
+    assert pool.idle_workers == 0
+
+    assert list(ops.Sort(('score',))(iter(SORT_DATA))) == sorted(SORT_DATA, key=lambda row: row['score'])
+    assert pool.idle_workers == 1
+
+
+def test_sort_raises_worker_error() -> None:
+    pool = workers.get_pool()
+    pool.shutdown()
+
+    # python can not compare str with int, it is raised by the worker which sorts
+    with pytest.raises(TypeError, match='not supported'):
+        list(ops.Sort(('score',))(iter([{'score': 1}, {'score': 'x'}])))
+    assert pool.idle_workers == 0
+    assert list(ops.Sort(('score',))(iter(SORT_DATA))) == sorted(SORT_DATA, key=lambda row: row['score'])
+
+
+class _FailingTask(workers.Task):
+    def run(self, endpoint: multiprocessing.connection.Connection) -> None:
+        raise ValueError('task failed')
+
+
+def test_worker_error_while_owner_sends() -> None:
+    with pytest.raises(ValueError, match='task failed'):
+        with workers.worker_session(_FailingTask()) as endpoint:
+            sender = RowsSender(endpoint, chunk_bytes=0)
+            for i in range(100000):
+                sender.send({'payload': 'x' * 100, 'i': i})
+
+
+def test_worker_sees_end_of_owner() -> None:
+    pool = workers.WorkerPool(max_idle_workers=2)
+    first, second = pool.acquire(), pool.acquire()
+    try:
+        # second worker is forked after the first one, it must not keep the first connection open
+        first.endpoint.close()
+        first.process.join(10)
+        assert not first.process.is_alive()
+    finally:
+        pool.discard(first)
+        pool.discard(second)
+
+
+def test_sort_in_script_without_main_guard(tmp_path: pathlib.Path) -> None:
+    script = tmp_path / 'script.py'
+    script.write_text(
+        'from compgraph import operations as ops\n'
+        "print(list(ops.Sort(['a'])(iter([{'a': 2}, {'a': 1}]))))\n"
+    )
+    root = pathlib.Path(__file__).parent.parent
+    result = subprocess.run(
+        [sys.executable, str(script)], capture_output=True, text=True, timeout=60,
+        env={**os.environ, 'PYTHONPATH': str(root)}
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout == "[{'a': 1}, {'a': 2}]\n"
+
+
+HASH_REDUCE_DATA = [{'word': f'w{(i * 7) % 11}', 'value': i} for i in range(50)]
+
+
+@pytest.mark.parametrize('reducer', [
+    ops.Count('count'), ops.Sum('value'), ops.TermFrequency('value'), ops.TopN('value', 2)
+])
+@pytest.mark.parametrize('max_groups_in_memory', [100, 3, 1])
+def test_hash_reduce(reducer: ops.Aggregator, max_groups_in_memory: int) -> None:
+    key_func = _Key('word')
+    sorted_data = sorted(HASH_REDUCE_DATA, key=lambda row: row['word'])
+    expected = list(ops.Reduce(reducer, ('word',))(iter(sorted_data)))
+
+    result = ops.HashReduce(
+        reducer, ('word',), max_groups_in_memory=max_groups_in_memory, partitions=2
+    )(iter(HASH_REDUCE_DATA))
+    assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+def test_hash_reduce_keeps_first_appearance_order() -> None:
+    data = [{'word': word} for word in ['b', 'a', 'b', 'c', 'a']]
+    result = ops.HashReduce(ops.Count('count'), ('word',))(iter(data))
+    assert list(result) == [{'word': 'b', 'count': 2}, {'word': 'a', 'count': 2}, {'word': 'c', 'count': 1}]
+
+
+def test_multi_aggregate() -> None:
+    data = [{'word': 'ab'[i % 2], 'value': i} for i in range(7)]
+    reducer = ops.MultiAggregate([
+        ops.Sum('value'), ops.Count('count'), ops.Min('value', 'min'), ops.Max('value', 'max'),
+        ops.Mean('value', 'mean')
+    ])
+
+    assert list(ops.Reduce(reducer, ('word',))(iter(sorted(data, key=lambda row: row['word'])))) == [
+        {'word': 'a', 'value': 12, 'count': 4, 'min': 0, 'max': 6, 'mean': 3.},
+        {'word': 'b', 'value': 9, 'count': 3, 'min': 1, 'max': 5, 'mean': 3.},
+    ]
+
+
+@pytest.mark.parametrize('reducer', [ops.TopN('value', 2), ops.TermFrequency('value'), ops.Sum('value')])
+def test_aggregator_merge(reducer: ops.Aggregator) -> None:
+    data = [{'word': 'a', 'value': (i * 7) % 5} for i in range(20)]
+    expected = list(ops.Reduce(reducer, ('word',))(iter(data)))
+
+    states = [reducer.init() for _ in range(3)]
+    for i, row in enumerate(data):
+        states[i * 3 // len(data)] = reducer.update(states[i * 3 // len(data)], row)
+    state = reducer.merge(reducer.merge(states[0], states[1]), states[2])
+    assert list(reducer.finalize(('word',), ('a',), state)) == expected
+
+
+@pytest.mark.parametrize('reducer', [
+    ops.Count('count'), ops.Sum('value'),
+    ops.MultiAggregate([ops.Mean('value', 'mean'), ops.Min('value', 'min'), ops.Count('count')])
+])
+def test_combine(reducer: ops.Aggregator) -> None:
+    data = [{'word': f'w{(i // 3) % 7}', 'value': i} for i in range(50)]
+    key_func = _Key('word')
+    expected = list(ops.HashReduce(reducer, ('word',))(iter(data)))
+
+    partial = list(ops.Combine(reducer, ('word',), max_groups_in_memory=4)(iter(data)))
+    assert len(expected) < len(partial) < len(data)
+
+    result = ops.HashReduce(ops.PartialMerge(reducer), ('word',))(iter(partial))
+    assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+COLUMNAR_DATA = [
+    {'word': f'w{i // 7 % 5}', 'text': 'a bb' if i % 3 else 'ccc', 'x': i % 13 + 1, 'y': (i % 7) * 0.5 + 0.25}
+    for i in range(200)
+]
+
+
+@pytest.mark.parametrize('mappers', [
+    [ops.MathMapper('z', 'x / y + 1'), ops.LogarithmMap('z'), ops.Product(['x', 'y', 'z'], 'p')],
+    [ops.Filter(lambda row: row['x'] % 2 == 1, ['x'], vectorized=True), ops.Rename('x', 'n'), ops.Project(['n', 'y'])],
+    [ops.MathMapper('z', 'x * 2'), ops.Split('text'), ops.LowerCase('word'), ops.Product(['z', 'y']),
+     ops.KeepColumns(['text', 'product'])],
+    [ops.MathMapper('z', '42'), ops.Product([], 'one'), ops.LogarithmMap('x', 2)],
+    [ops.Filter(lambda row: row['x'] > 100, ['x'], vectorized=True), ops.MathMapper('z', 'x + 1')]
+])
+@pytest.mark.parametrize('batch_rows', [64, 1])
+def test_batch_map(mappers: list[ops.Mapper], batch_rows: int) -> None:
+    expected = list(ops.Map(*mappers)(iter(copy.deepcopy(COLUMNAR_DATA))))
+
+    result = list(ops.BatchMap(*mappers, batch_rows=batch_rows)(iter(copy.deepcopy(COLUMNAR_DATA))))
+    assert result == [approx(row) for row in expected]
+    assert [list(row) for row in result] == [list(row) for row in expected]
+
+
+def test_batch_map_keeps_python_arithmetic() -> None:
+    data = [{'a': 'x', 'b': 'y'}, {'a': 2, 'b': -1}, {'a': 1, 'b': 0}]
+    assert list(ops.BatchMap(ops.MathMapper('c', 'a + b'))(iter(data[:1]))) == [{'a': 'x', 'b': 'y', 'c': 'xy'}]
+    assert list(ops.BatchMap(ops.MathMapper('d', 'a ** b'))(iter(data[1:2]))) == [{'a': 2, 'b': -1, 'd': 0.5}]
+    with pytest.raises(ZeroDivisionError):
+        list(ops.BatchMap(ops.MathMapper('c', 'a / b'))(iter(data[1:])))
+    with pytest.raises(ValueError):
+        list(ops.BatchMap(ops.LogarithmMap('b'))(iter(data[1:])))
+
+
+@pytest.mark.parametrize('mapper', [
+    ops.Product(['a', 'b']), ops.MathMapper('c', 'a * b'), ops.MathMapper('c', 'a * b / 2'),
+    ops.MathMapper('c', 'b ** 40'), ops.MathMapper('c', '-a - a')
+])
+def test_batch_map_keeps_python_integers(mapper: ops.Mapper) -> None:
+    # numpy int64 math would wrap around
+    data = [{'a': 2 ** 62, 'b': 4}, {'a': 3, 'b': 5}]
+    expected = list(ops.Map(mapper)(iter(copy.deepcopy(data))))
+    assert list(ops.BatchMap(mapper)(iter(copy.deepcopy(data)))) == expected
+
+
+def test_batch_map_mixed_columns() -> None:
+    data = [{'x': 1}, {'x': 2, 'y': 3}, {'y': 4, 'x': 5}, {'x': 6}]
+    result = list(ops.BatchMap(ops.MathMapper('z', 'x * 2'))(iter(copy.deepcopy(data))))
+    assert result == [{**row, 'z': row['x'] * 2} for row in data]
+
+
+def test_vectorized_filter_declares_columns() -> None:
+    with pytest.raises(ValueError):
+        ops.Filter(lambda row: row['x'] > 1, vectorized=True)
+    assert not ops.Filter(lambda row: row['x'] > 1, ['x']).vectorized
+
+
+@pytest.mark.parametrize('reducer', [
+    ops.Count('count'), ops.Sum('x'), ops.Sum('y'), ops.Sum('text'), ops.Min('y', 'min'), ops.Max('x', 'max'),
+    ops.Mean('y', 'mean'), ops.MultiAggregate([ops.Sum('x'), ops.Count('count'), ops.Mean('y', 'mean')])
+])
+@pytest.mark.parametrize('keys', [('word',), ('word', 'text'), ()])
+@pytest.mark.parametrize('batch_rows', [1000, 16, 1])
+def test_batch_reduce(reducer: ops.Aggregator, keys: tuple[str, ...], batch_rows: int) -> None:
+    assert reducer.vectorized
+    data = sorted(COLUMNAR_DATA, key=lambda row: [row[key] for key in keys])
+    expected = list(ops.Reduce(reducer, keys)(iter(data)))
+
+    result = list(ops.BatchReduce(reducer, keys, batch_rows=batch_rows)(iter(data)))
+    assert result == [approx(row) for row in expected]
+
+
+@pytest.mark.parametrize('reducer', [
+    ops.Sum('a'), ops.MultiAggregate([ops.Sum('a'), ops.Count('count')]), ops.Min('a', 'min'), ops.Max('a', 'max')
+])
+@pytest.mark.parametrize('batch_rows', [1000, 3])
+def test_batch_reduce_keeps_python_integers(reducer: ops.Aggregator, batch_rows: int) -> None:
+    # abs of int64 min is int64 min in numpy, so sums of such values must not be folded there
+    data = [{'g': i // 4, 'a': -2 ** 63 if i % 2 else i} for i in range(12)]
+    expected = list(ops.Reduce(reducer, ('g',))(iter(data)))
+    assert list(ops.BatchReduce(reducer, ('g',), batch_rows=batch_rows)(iter(data))) == expected
+
+
+@pytest.mark.parametrize('batch_rows', [1000, 4, 1])
+def test_batch_reduce_checks_order(batch_rows: int) -> None:
+    data = sorted(COLUMNAR_DATA, key=lambda row: (row['word'], row['x']))
+    descending = sorted(data, key=lambda row: row['word'], reverse=True)
+    keys = ('word', 'x')
+    expected = list(ops.Reduce(ops.Sum('y'), keys)(iter(descending)))
+    assert list(ops.BatchReduce(ops.Sum('y'), keys, batch_rows=batch_rows)(iter(descending))) == expected
+
+    with pytest.raises(AssertionError):
+        list(ops.BatchReduce(ops.Sum('y'), ('word',), batch_rows=batch_rows)(iter(COLUMNAR_DATA)))
+
+
+def test_batch_reduce_non_vectorized() -> None:
+    reducer = ops.TopN('x', 2)
+    data = sorted(COLUMNAR_DATA, key=lambda row: row['word'])
+    expected = list(ops.Reduce(reducer, ('word',))(iter(data)))
+    assert list(ops.BatchReduce(reducer, ('word',), batch_rows=5)(iter(data))) == expected
+
+
+@pytest.mark.parametrize('reducer', [
+    ops.Count('count'),
+    ops.MultiAggregate([ops.Mean('y', 'mean'), ops.Min('x', 'min'), ops.Count('count')])
+])
+@pytest.mark.parametrize('max_groups_in_memory', [100, 4])
+def test_batch_combine(reducer: ops.Aggregator, max_groups_in_memory: int) -> None:
+    key_func = _Key('word')
+    expected = list(ops.HashReduce(reducer, ('word',))(iter(COLUMNAR_DATA)))
+
+    partial = list(ops.BatchCombine(reducer, ('word',), max_groups_in_memory, batch_rows=32)(iter(COLUMNAR_DATA)))
+    assert len(partial) < len(COLUMNAR_DATA)
+
+    result = ops.HashReduce(ops.PartialMerge(reducer), ('word',))(iter(partial))
+    assert sorted(result, key=key_func) == [approx(row) for row in sorted(expected, key=key_func)]
+
+
+@pytest.mark.parametrize('case', correctness_operations.JOIN_CASES)
+def test_broadcast_join(case: correctness_operations.JoinCase) -> None:
+    key_func = _Key(*case.cmp_keys)
+    data_left = copy.deepcopy(case.data_left)
+    data_right = copy.deepcopy(case.data_right)
+
+    # unsorted inputs are fine for hash join
+    result = ops.BroadcastJoin(case.joiner, case.join_keys)(reversed(data_left), reversed(data_right))
+    assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+
+@pytest.mark.parametrize('max_rows_in_memory', [100, 1])
+@pytest.mark.parametrize('case', correctness_operations.JOIN_CASES)
+def test_grace_hash_join(case: correctness_operations.JoinCase, max_rows_in_memory: int) -> None:
+    key_func = _Key(*case.cmp_keys)
+    data_left = copy.deepcopy(case.data_left)
+    data_right = copy.deepcopy(case.data_right)
+
+    join = ops.GraceHashJoin(case.joiner, case.join_keys, max_rows_in_memory=max_rows_in_memory, partitions=2)
+    result = join(reversed(data_left), reversed(data_right))
+    assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.LeftJoiner(), ops.RightJoiner(), ops.OuterJoiner()])
+def test_grace_hash_join_matches_join(joiner: ops.Joiner) -> None:
+    data_left = [{'key': (i * 5) % 17, 'left': i} for i in range(60)]
+    data_right = [{'key': (i * 3) % 23, 'right': i} for i in range(40)]
+    key_func = _Key('key', 'left', 'right')
+
+    expected = ops.Join(joiner, ('key',))(
+        sorted(data_left, key=lambda row: row['key']), sorted(data_right, key=lambda row: row['key'])
+    )
+    result = ops.GraceHashJoin(joiner, ('key',), max_rows_in_memory=5, partitions=3)(
+        iter(data_left), iter(data_right)
+    )
+    assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.LeftJoiner(), ops.RightJoiner(), ops.OuterJoiner()])
+def test_grace_hash_join_hot_key_within_budget(joiner: ops.Joiner, monkeypatch: pytest.MonkeyPatch) -> None:
+    # one hot key can not be split by partitioning
+    data_left = [{'key': 'hot' if i % 4 else f'k{i}', 'left': i} for i in range(40)]
+    data_right = [{'key': 'hot' if i % 3 else f'k{i}', 'right': i} for i in range(30)]
+    key_func = _Key('key', 'left', 'right')
+
+    tables = []
+    build = ops.BroadcastJoin._build
+    monkeypatch.setattr(
+        ops.BroadcastJoin, '_build', lambda self, rows: tables.append(list(rows)) or build(self, tables[-1])
+    )
+    result = ops.GraceHashJoin(joiner, ('key',), max_rows_in_memory=5, partitions=2)(iter(data_left), iter(data_right))
+    result = sorted(result, key=key_func)
+    assert all(len(table) <= 5 for table in tables)
+
+    expected = ops.Join(joiner, ('key',))(
+        sorted(data_left, key=lambda row: row['key']), sorted(data_right, key=lambda row: row['key'])
+    )
+    assert result == sorted(expected, key=key_func)
+
+
+@pytest.mark.parametrize('case', correctness_operations.JOIN_CASES)
+def test_parallel_join(case: correctness_operations.JoinCase) -> None:
+    key_func = _Key(*case.cmp_keys)
+    data_left = copy.deepcopy(case.data_left)
+    data_right = copy.deepcopy(case.data_right)
+
+    result = ops.ParallelJoin(case.joiner, case.join_keys, workers=3)(reversed(data_left), reversed(data_right))
+    assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+
+@pytest.mark.parametrize('keys', [('key',), ()])
+@pytest.mark.parametrize('left_rows', [60, 0])
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.LeftJoiner(), ops.RightJoiner(), ops.OuterJoiner()])
+def test_parallel_join_matches_join(joiner: ops.Joiner, left_rows: int, keys: tuple[str, ...]) -> None:
+    data_left = [{'key': (i * 5) % 17, 'left': i} for i in range(left_rows)]
+    # keyless join broadcasts right table, so it is small then
+    data_right = [{'key': (i * 3) % 23, 'right': i} for i in range(40 if keys else 2)]
+    key_func = _Key('key', 'key_1', 'key_2', 'left', 'right')
+
+    def by_key(rows: list[ops.TRow]) -> list[ops.TRow]:
+        return sorted(rows, key=lambda row: tuple(row[key] for key in keys))
+
+    expected = list(ops.Join(joiner, keys)(by_key(data_left), by_key(data_right)))
+    result = list(ops.ParallelJoin(joiner, keys, workers=3, ordered=True)(iter(data_left), iter(data_right)))
+    if keys:
+        assert [row['key'] for row in result] == [row['key'] for row in expected]
+    assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.LeftJoiner(), ops.RightJoiner(), ops.OuterJoiner()])
+def test_parallel_join_salted(joiner: ops.Joiner) -> None:
+    data_right = [{'word': f'w{i}', 'right': i} for i in range(12)] + [{'word': 'the', 'right': -1}]
+    key_func = _Key('word', 'doc_id', 'n', 'right')
+
+    expected = ops.Join(joiner, ('word',))(
+        sorted(SKEWED_DATA, key=lambda row: row['word']), sorted(data_right, key=lambda row: row['word'])
+    )
+    join = ops.ParallelJoin(joiner, ('word',), workers=3, ordered=True, sample_size=50)
+    result = list(join(iter(SKEWED_DATA), iter(data_right)))
+    assert [row['word'] for row in result] == sorted(row['word'] for row in result)
+    assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+@pytest.mark.parametrize('case', correctness_operations.JOIN_CASES)
+def test_joiner_spills_large_groups(case: correctness_operations.JoinCase) -> None:
+    key_func = _Key(*case.cmp_keys)
+    joiner = type(case.joiner)(case.joiner._a_suffix, case.joiner._b_suffix, max_rows_in_memory=1)
+
+    result = ops.Join(joiner, case.join_keys)(iter(copy.deepcopy(case.data_left)), iter(copy.deepcopy(case.data_right)))
+    assert sorted(case.ground_truth, key=key_func) == sorted(result, key=key_func)
+
+
+@pytest.mark.parametrize('joiner', [ops.InnerJoiner(), ops.LeftJoiner(), ops.RightJoiner(), ops.OuterJoiner()])
+def test_broadcast_join_reuses_right_groups(joiner: ops.Joiner, monkeypatch: pytest.MonkeyPatch) -> None:
+    joiner = type(joiner)(max_rows_in_memory=1)
+    data_left = [{'key': i % 2, 'left': i} for i in range(10)]
+    data_right = [{'key': 0, 'right': i} for i in range(5)]
+    key_func = _Key('key', 'left', 'right')
+
+    appended = []
+    append = SpillList.append
+    monkeypatch.setattr(SpillList, 'append', lambda self, item: appended.append(item) or append(self, item))
+    # left keys alternate, so every right group is joined many times
+    result = list(ops.BroadcastJoin(joiner, ('key',))(iter(data_left), iter(data_right)))
+    assert appended == []
+
+    expected = ops.Join(joiner, ('key',))(
+        sorted(data_left, key=lambda row: row['key']), sorted(data_right, key=lambda row: row['key'])
+    )
+    assert sorted(result, key=key_func) == sorted(expected, key=key_func)
+
+
+@pytest.mark.parametrize('close', [True, False])
+def test_spilling_tee_drops_unused_branch(close: bool, monkeypatch: pytest.MonkeyPatch) -> None:
+    rows = [{'n': i} for i in range(10)]
+    tee = SpillingTee(iter(rows), 3, max_rows_in_memory=2)
+    first, second, third = tee.branches()
+    assert next(second) == rows[0]
+    # third consumer never starts
+    if close:
+        third.close()
+    else:
+        del third
+
+    appended = []
+    append = SpillQueue.append
+    monkeypatch.setattr(SpillQueue, 'append', lambda self, item: appended.append(item) or append(self, item))
+    assert list(first) == rows
+    # only the lagging second branch buffers rows
+    assert appended == rows[1:]
+    assert list(second) == rows[1:]
+
+
+def test_spill_list_replays_items() -> None:
+    items = SpillList[int](2)
+    items.extend(range(5))
+    assert items.spilled
+    assert len(items) == 5
+    assert [(a, b) for a in items for b in items] == [(a, b) for a in range(5) for b in range(5)]
+    items.close()
+    assert list(items) == []